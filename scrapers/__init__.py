@@ -5,7 +5,9 @@ related projects.
 
 fipe :
     Reads the market prices for vehicles sold in Brazil as published by
-    Fipe -- Fundação Instituto de Pesquisas Econômicas.
+    Fipe -- Fundação Instituto de Pesquisas Econômicas. The crawler is
+    complemented by `fipe_http` (transport policies), `fipe_db` (storage)
+    and `fipe_cli` (command-line interface and lookup server).
 
 
 Disclaimer
@@ -0,0 +1,7 @@
+"""Runs the Fipe command-line interface, see `scrapers.fipe_cli.main`."""
+import sys
+
+from .fipe_cli import main
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,19 +5,49 @@ sold in Brazil as published by  Fipe -- Fundação Instituto de Pesquisas
 Econômicas. Data is retrieved from Fipe's webpage and stored in a local
 SQLite database.
 
+Transport policies of requests live in `scrapers.fipe_http`, the database
+and other sinks of prices in `scrapers.fipe_db` and the command-line
+interface in `scrapers.fipe_cli`.
+
 """
+import logging
 import requests
-import sqlite3
+import sys
+import threading
+
+from abc import ABC
+from array import array
+from collections import Counter, OrderedDict, deque, namedtuple
+from collections.abc import Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from itertools import chain
+from math import isnan, nan
+from requests.adapters import HTTPAdapter
+from time import monotonic, sleep
+from urllib.parse import urlsplit
+from weakref import WeakValueDictionary
 
-from os.path import dirname
-from time import sleep
+from .fipe_http import (FipeRequestError, RetryPolicy, _request_key,
+                        _retry_after)
+
+logger = logging.getLogger(__name__)
 
 
 class Table():
-    """Fipe reference table object."""
+    """Fipe reference table object.
+
+    Use `Table.intern` to share a single instance per reference table.
+    Copies bound to a crawler with `Fipe.bind` crawl their makers, the
+    models of makers and prices lazily on first access.
+
+    """
+    __slots__ = ('id', 'year', 'month', 'client', '__weakref__')
     months = ['janeiro', 'fevereiro', 'março', 'abril', 'maio', 'junho',
               'julho', 'agosto', 'setembro', 'outubro', 'novembro',
               'dezembro']
+    _interned = WeakValueDictionary()
 
     def __init__(self, id=218, year=2017, month=10):
         self.id = id
@@ -28,14 +58,43 @@ class Table():
             self.month = self.months.index(month) + 1
         else:
             raise ValueError('Invalide month `{}`.'.format(month))
+        # Crawler of lazy navigation, see `Fipe.bind`.
+        self.client = None
 
     def __str__(self):
         return '{}: {}/{}'.format(self.id, self.months[self.month-1],
                                   self.year)
 
+    @property
+    def makers(self):
+        """Car makers of reference table, crawled on first access."""
+        return self._client().get_makers(self)
+
+    def _client(self):
+        """Returns the bound crawler."""
+        if self.client is None:
+            raise ValueError('Reference table {} is not bound to a '
+                             'crawler.'.format(self.id))
+        return self.client
+
+    @classmethod
+    def intern(cls, id=218, year=2017, month=10):
+        """Returns the shared reference table object."""
+        table = cls(id, year, month)
+        key = (table.id, table.year, table.month)
+        return cls._interned.setdefault(key, table)
+
 
 class CarMaker():
-    """Fipe car maker object."""
+    """Fipe car maker object.
+
+    Use `CarMaker.intern` to share a single instance per maker and
+    reference table.
+
+    """
+    __slots__ = ('id', 'name', 'table', 'vehicle_type', 'years',
+                 '__weakref__')
+    _interned = WeakValueDictionary()
 
     def __init__(self, id, name, table, vehicle_type=1):
         self.id = id
@@ -45,29 +104,71 @@ class CarMaker():
         else:
             raise TypeError('Invalid table `{}`.'.format(table))
         self.vehicle_type = vehicle_type
+        # List of `(build_year, fuel_type)` of all models, once crawled.
+        self.years = None
+
+    @property
+    def models(self):
+        """Car models of maker, crawled on first access."""
+        return self.table._client().get_models(self)
+
+    @classmethod
+    def intern(cls, id, name, table, vehicle_type=1):
+        """Returns the shared car maker object."""
+        key = (id, name, table, vehicle_type)
+        maker = cls._interned.get(key)
+        if maker is None:
+            maker = cls._interned.setdefault(key, cls(id, name, table,
+                                                      vehicle_type))
+        return maker
 
 
 class CarModel():
-    """Fipe car model object."""
+    """Fipe car model object.
+
+    Built years and prices are kept column-wise in a `PriceList`, exposed
+    as `prices`. Prices of models obtained by navigating a bound table are
+    crawled on first access instead, the model keeping its own copy of the
+    memoized prices.
+
+    """
+    __slots__ = ('id', 'name', 'maker', '_prices', '_lazy')
+    _lazy_lock = threading.Lock()
 
     def __init__(self, id, name, maker):
         self.id = id
         self.name = name
         self.maker = maker
-        self.prices = []
+        self._prices = PriceList()
+        # Whether prices are crawled on first access, see `Fipe.get_models`.
+        self._lazy = False
+
+    @property
+    def prices(self):
+        """Built years and prices of car model."""
+        if self._lazy:
+            prices = self.maker.table._client().get_prices(self)
+            with self._lazy_lock:
+                # Updates of the copy leave the memoized prices untouched.
+                if self._lazy:
+                    self._prices = PriceList(prices)
+                    self._lazy = False
+        return self._prices
 
     def add_price(self, year, fuel_type):
         """Add built year/price to car model."""
-        self.prices.append(CarPrice(year, fuel_type))
+        # Built years crawled explicitly replace the lazy ones.
+        self._lazy = False
+        self._prices.append(year, fuel_type)
 
     def update_price(self, i, **kwargs):
         """Update i-th price of car model."""
-        for key, value in kwargs.items():
-            setattr(self.prices[i], key, value)
+        self.prices.update(i, **kwargs)
 
 
-class CarPrice():
+class CarPrice(ABC):
     """Fipe car price by year and fuel type."""
+    __slots__ = ('build_year', 'fuel_type', 'price', 'fipe_code')
 
     def __init__(self, build_year, fuel_type, price=None, fipe_code=None):
         self.build_year = build_year
@@ -75,6 +176,145 @@ class CarPrice():
         self.price = price
         self.fipe_code = fipe_code
 
+    def __repr__(self):
+        return 'CarPrice({!r}, {!r}, price={!r}, fipe_code={!r})'.format(
+            self.build_year, self.fuel_type, self.price, self.fipe_code)
+
+
+class _PriceView():
+    """Car price item of a `PriceList`, reading and writing its arrays.
+
+    A virtual `CarPrice` subclass, holding its list and index only.
+
+    """
+    __slots__ = ('_list', '_i')
+
+    def __init__(self, prices, i):
+        self._list = prices
+        self._i = i
+
+    def _column(key):
+        def get(self):
+            return self._list._value(self._i, key)
+
+        def set(self, value):
+            self._list.update(self._i, **{key: value})
+
+        return property(get, set)
+
+    build_year = _column('build_year')
+    fuel_type = _column('fuel_type')
+    price = _column('price')
+    fipe_code = _column('fipe_code')
+    del _column
+    __repr__ = CarPrice.__repr__
+
+
+CarPrice.register(_PriceView)
+
+
+class PriceList(Sequence):
+    """Column-oriented list of car prices.
+
+    Built years, fuel types and prices are stored in typed arrays and Fipe
+    codes are interned, so a price takes a few bytes instead of a whole
+    object. Items are `CarPrice` views of the arrays, hence setting their
+    attributes updates the list.
+
+    """
+    __slots__ = ('build_years', 'fuel_types', 'values', 'fipe_codes')
+
+    def __init__(self, prices=()):
+        self.build_years = array('h')
+        self.fuel_types = array('b')
+        self.values = array('d')
+        self.fipe_codes = []
+        for price in prices:
+            self.append(price.build_year, price.fuel_type, price.price,
+                        price.fipe_code)
+
+    def __len__(self):
+        return len(self.build_years)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return _PriceView(self, range(len(self))[i])
+
+    def __setitem__(self, i, price):
+        self.update(i, build_year=price.build_year,
+                    fuel_type=price.fuel_type, price=price.price,
+                    fipe_code=price.fipe_code)
+
+    def __eq__(self, other):
+        # Car prices compare by identity, lists by their attributes.
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return len(self) == len(other) and all(
+            isinstance(b, CarPrice) and
+            (a.build_year, a.fuel_type, a.price, a.fipe_code) ==
+            (b.build_year, b.fuel_type, b.price, b.fipe_code)
+            for a, b in zip(self, other))
+
+    def __repr__(self):
+        return 'PriceList({!r})'.format(list(self))
+
+    def append(self, build_year, fuel_type=None, price=None,
+               fipe_code=None):
+        """Appends built year, fuel type and optional price.
+
+        A `CarPrice` may be given instead of its attributes.
+
+        """
+        if isinstance(build_year, CarPrice):
+            build_year, fuel_type, price, fipe_code = (
+                build_year.build_year, build_year.fuel_type,
+                build_year.price, build_year.fipe_code)
+        self.build_years.append(build_year)
+        self.fuel_types.append(fuel_type)
+        self.values.append(nan if price is None else price)
+        self.fipe_codes.append(None if fipe_code is None
+                               else sys.intern(fipe_code))
+
+    def update(self, i, **kwargs):
+        """Updates attributes of the i-th price."""
+        for key, value in kwargs.items():
+            if key == 'build_year':
+                self.build_years[i] = value
+            elif key == 'fuel_type':
+                self.fuel_types[i] = value
+            elif key == 'price':
+                self.values[i] = nan if value is None else value
+            elif key == 'fipe_code':
+                self.fipe_codes[i] = (None if value is None
+                                      else sys.intern(value))
+            else:
+                raise AttributeError('Invalid price attribute `{}`.'.format(
+                    key))
+
+    def _value(self, i, key):
+        """Returns attribute of the i-th price."""
+        if key == 'build_year':
+            return self.build_years[i]
+        if key == 'fuel_type':
+            return self.fuel_types[i]
+        if key == 'price':
+            value = self.values[i]
+            return None if isnan(value) else value
+        return self.fipe_codes[i]
+
+
+PriceRecord = namedtuple('PriceRecord', [
+    'table', 'vehicle_type', 'maker_id', 'maker', 'model_id', 'model',
+    'build_year', 'fuel_type', 'price', 'fipe_code'])
+PriceRecord.__doc__ = """Flat Fipe price record.
+
+The record holds the reference table id, vehicle type, maker and model
+ids and names, built year, fuel type, price and Fipe code of a single
+vehicle price.
+
+"""
+
 
 class Fipe():
     """Fipe web scraper.
@@ -90,15 +330,229 @@ class Fipe():
     >> car_models = fipe.crawl_models(car_makers[0])
     >> fipe.crawl_model_year(car_models[0])
     >> fipe.crawl_model_year(car_models[0])
+    >> fipe.close()
+
+    A single HTTP session with a pool of keep-alive connections is shared
+    by all requests, so the crawler may also be used as a context manager:
+
+    >> with Fipe(pool_maxsize=20, timeout=10) as fipe:
+    ..     tables = fipe.crawl_reference_tables()
+
+    Prices of many car models can be crawled concurrently:
+
+    >> fipe = Fipe(max_workers=16)
+    >> car_models = fipe.crawl_prices(car_models)
+
+    A whole reference table can be streamed as flat price records:
+
+    >> for record in fipe.iter_table(tables[0]):
+    ..     print(record.fipe_code, record.price)
+
+    Bound reference tables are navigated lazily, crawling only what is
+    accessed:
+
+    >> table = fipe.bind(tables[0])
+    >> prices = table.makers[0].models[0].prices
+
+    Parameters
+    ----------
+    pool_connections : integer, optional
+        Number of per-host connection pools to cache.
+    pool_maxsize : integer, optional
+        Maximum number of connections kept alive per host. Defaults to
+        `max_workers`, but not less than 10.
+    pool_block : boolean, optional
+        If `True`, block when all connections of a host pool are in use
+        instead of opening throw-away connections.
+    timeout : float or tuple, optional
+        Connect and read timeout in seconds, either as single value or
+        as `(connect, read)` tuple.
+    compress : boolean, optional
+        If `True` (default), asks the server for gzip/deflate compressed
+        responses.
+    max_workers : integer, optional
+        Maximum number of requests in flight of the concurrent crawl
+        methods. The default is to crawl serially. The `max_workers` of a
+        crawl method call raises the limit while the call runs.
+    retry : RetryPolicy, optional
+        Backoff and maximum number of attempts of failing requests before
+        giving up with `FipeRequestError`.
+    limiter : RateLimiter, optional
+        Adaptive rate limiter pacing all requests. The default is not to
+        pace requests.
+    breaker : CircuitBreaker, optional
+        Circuit breaker holding all requests back after consecutive
+        failures.
+    cache : ResponseCache, optional
+        Cache of responses, looked up before every request.
+    planner : RequestPlanner, optional
+        Request planner sparing built year requests and deduplicating
+        identical requests of a crawl.
+    stats : CrawlStats, optional
+        Statistics registry, or any object with `on_request` and
+        `on_stage` hooks, notified of every request and crawl stage.
+    base_url : string, optional
+        Root URL of the FIPE API, e.g. of a local stand-in server for
+        tests and benchmarks. The `Host` and `Referer` headers follow it.
+    nodes : integer, optional
+        Maximum number of makers lists, models lists and prices lists
+        memoized by lazy navigation.
 
     """
     base_url = 'http://veiculos.fipe.org.br'
+    default_headers = {
+        'Host': 'veiculos.fipe.org.br',
+        # 'User-Agent': 'nublia.scraper/0.1',
+        'User-Agent': ('Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:54.0) '
+                       'Gecko/20100101 Firefox/54.0'),
+        'Accept': 'application/json, text/javascript, */*; q=0.01',
+        'Accept-Language': 'en-US,en;q=0.5',
+        'Accept-Encoding': 'gzip, deflate',
+        'X-Requested-With': 'XMLHttpRequest',
+        'Referer': '{}/'.format(base_url),
+        'DNT': '1',
+        'Connection': 'keep-alive',
+    }
+    vehicle_types = {1: 'carro', 2: 'moto', 3: 'caminhao'}
 
-    def __init__(self):
-        pass
+    def __init__(self, pool_connections=4, pool_maxsize=None,
+                 pool_block=False, timeout=(5, 30), compress=True,
+                 max_workers=1, retry=None, limiter=None, breaker=None,
+                 cache=None, planner=None, stats=None, base_url=None,
+                 nodes=4096):
+        if base_url is not None:
+            self.base_url = base_url.rstrip('/')
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize or max(10, max_workers)
+        self.pool_block = pool_block
+        self.timeout = timeout
+        self.compress = compress
+        self.max_workers = max_workers
+        self.retry = retry or RetryPolicy()
+        self.limiter = limiter
+        self.breaker = breaker
+        self.cache = cache
+        self.planner = planner
+        self.stats = stats
+        self.nodes = LRUCache(nodes)
+        self._flight = SingleFlight()
+        # Requests in flight and `max_workers` of running concurrent maps.
+        self._slots = threading.Condition()
+        self._in_flight = 0
+        self._limits = Counter()
+        self.session = None
+        self.connect()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def connect(self):
+        """Opens the pooled HTTP session used by all requests."""
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize, pool_block=self.pool_block)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.clear()
+        self.session.headers.update(self.default_headers)
+        if self.base_url != Fipe.base_url:
+            self.session.headers['Host'] = urlsplit(self.base_url).netloc
+            self.session.headers['Referer'] = '{}/'.format(self.base_url)
+        if not self.compress:
+            self.session.headers['Accept-Encoding'] = 'identity'
+
+    def close(self):
+        """Closes the HTTP session and its pooled connections."""
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def bind(self, table):
+        """Binds reference table to crawler for lazy navigation.
+
+        Makers of the table, models of its makers and prices of their
+        models are then crawled on first access to `table.makers`,
+        `maker.models` and `model.prices`, see `get_makers`. The given
+        table is left unbound, as it may be shared by other crawlers.
+
+        Returns
+        -------
+        table : Table
+            Copy of the reference table bound to crawler.
+
+        """
+        bound = Table(table.id, table.year, table.month)
+        bound.client = self
+        return bound
+
+    def get_makers(self, table, vehicle_type=1):
+        """Returns memoized car makers of reference table.
+
+        Makers, models and prices of navigation are memoized in the bounded
+        least recently used cache `nodes`. Concurrent calls asking for the
+        same node share a single crawl, so each node costs exactly the
+        requests needed to crawl it once.
+
+        """
+        key = ('makers', table.id, vehicle_type)
+        return self._get_node(key, partial(self.crawl_makers, table,
+                                           vehicle_type))
+
+    def get_models(self, maker):
+        """Returns memoized car models of maker.
+
+        The models are navigation models, whose prices are crawled on
+        first access to `model.prices`.
+
+        """
+        def crawl():
+            models = self.crawl_models(maker)
+            for model in models:
+                model._lazy = True
+            return models
+
+        key = ('models', maker.table.id, maker.vehicle_type, maker.id)
+        return self._get_node(key, crawl)
+
+    def get_prices(self, model):
+        """Returns memoized built years and prices of car model."""
+        def crawl():
+            crawled = CarModel(model.id, model.name, model.maker)
+            self.crawl_model_year(crawled)
+            self.crawl_model_price(crawled)
+            return crawled.prices
+
+        maker = model.maker
+        key = ('prices', maker.table.id, maker.vehicle_type, model.id)
+        return self._get_node(key, crawl)
+
+    def _get_node(self, key, crawl):
+        """Returns cached node or crawls it once for concurrent callers."""
+        missing = object()
+        node = self.nodes.get(key, missing)
+        if node is not missing:
+            return node
+
+        def fetch():
+            node = self.nodes.get(key, missing)
+            if node is missing:
+                node = crawl()
+                # Cached before other callers may start a new flight.
+                self.nodes.set(key, node)
+            return node
+
+        return self._flight.do(key, fetch)
 
     def crawl_reference_tables(self):
-        """Returns a pandas.DataFrame of reference tables."""
+        """Returns a list of reference tables.
+
+        Use `to_dataframe` for columnar output of crawled prices.
+
+        """
         url = '{}/api/veiculos/ConsultarTabelaDeReferencia'.format(
             self.base_url)
         response = self._post_request(url)
@@ -106,20 +560,23 @@ class Fipe():
         tables = []
         for item in response:
             _month, _year = item['Mes'].split('/')
-            tables.append(Table(id=item['Codigo'], year=int(_year),
-                                month=_month))
-        # Finally, return the dataframe of reference tables.
+            tables.append(Table.intern(id=item['Codigo'], year=int(_year),
+                                       month=_month))
+        # Responses of all but the latest table are immutable.
+        if self.cache is not None and tables:
+            self.cache.latest_table = max(table.id for table in tables)
+        # Finally, return the list of reference tables.
         return tables
 
-    def crawl_makers(self, table=Table(), vehicle_type=1):
+    def crawl_makers(self, table=None, vehicle_type=1):
         """Crawls FIPE car makers.
 
         Parameters
         ----------
         table : Table, optional
-            Reference table.
+            Reference table. Defaults to `Table.intern()`.
         vehicle_type : integer, optional
-            Type of vehicle (1=car).
+            Type of vehicle (1=car, 2=motorcycle, 3=truck).
 
         Returns
         -------
@@ -127,6 +584,8 @@ class Fipe():
             List of car maker objects.
 
         """
+        if table is None:
+            table = Table.intern()
         url = '{}/api/veiculos/ConsultarMarcas'.format(self.base_url)
         data = {'codigoTabelaReferencia': table.id,
                 'codigoTipoVeiculo': vehicle_type}
@@ -134,13 +593,16 @@ class Fipe():
         # Converts raw data.
         makers = []
         for item in response:
-            makers.append(CarMaker(id=int(item['Value']), name=item['Label'],
-                          table=table, vehicle_type=vehicle_type))
-        # Finally, return the dataframe of car makers
+            makers.append(CarMaker.intern(
+                id=int(item['Value']), name=sys.intern(item['Label']),
+                table=table, vehicle_type=vehicle_type))
+        if self.stats is not None:
+            self.stats.on_stage('makers', len(makers))
+        # Finally, return the list of car makers
         return makers
 
     def crawl_models(self, maker):
-        """Returns a pandas.DataFrame of models by car maker.
+        """Returns a list of models by car maker.
 
         Parameters
         ----------
@@ -150,7 +612,8 @@ class Fipe():
         Returns
         -------
         lst : list
-            List of car model objects by maker.
+            List of car model objects by maker. Built years of all models
+            are stored as `maker.years`.
 
         """
         assert isinstance(maker, CarMaker)
@@ -171,7 +634,12 @@ class Fipe():
         for item in response['Modelos']:
             models.append(CarModel(id=int(item['Value']), name=item['Label'],
                                    maker=maker))
-        # Finally, return the dataframe of car makers
+        # Keeps built years of all models of maker, listed as `Anos`.
+        maker.years = [tuple(int(v) for v in item['Value'].split('-'))
+                       for item in response.get('Anos') or []]
+        if self.stats is not None:
+            self.stats.on_stage('models', len(models))
+        # Finally, return the list of car models
         return models
 
     def crawl_model_year(self, model):
@@ -204,6 +672,8 @@ class Fipe():
         for item in response:
             _year, _fuel_type = item['Value'].split('-')
             model.add_price(int(_year), int(_fuel_type))
+        if self.stats is not None:
+            self.stats.on_stage('years', len(response))
 
     def crawl_model_price(self, model, irange=None):
         """Crawls and updates car model prices.
@@ -221,127 +691,717 @@ class Fipe():
         Nothing.
 
         """
+        # Validates the vehicle type before any request is made.
+        self._vehicle_type_descriptor(model.maker.vehicle_type)
+        if model._lazy:
+            # Built years are enough, prices are crawled below.
+            self.crawl_model_year(model)
         if irange is None:
             irange = range(len(model.prices))
+        for _ in self._imap(lambda i: self._crawl_price(model, i), irange):
+            pass
+
+    def crawl_prices(self, models, max_workers=None):
+        """Crawls built years and prices of many car models concurrently.
+
+        Built years are crawled first for every model without prices,
+        then one price request per model and built year is fanned out to
+        the worker threads. Results are written to the same `CarModel` and
+        `CarPrice` objects as the serial methods and in the same order.
+
+        Parameters
+        ----------
+        models : iterable
+            Car model objects.
+        max_workers : integer, optional
+            Maximum number of requests in flight. Defaults to the
+            crawler's `max_workers`.
+
+        Returns
+        -------
+        lst : list
+            List of crawled car model objects.
+
+        """
+        models = list(models)
+        for model in models:
+            self._vehicle_type_descriptor(model.maker.vehicle_type)
+        # Fans out built year requests of models not crawled yet.
+        missing = [model for model in models
+                   if model._lazy or not model.prices]
+        for _ in self._imap(self.crawl_model_year, missing, max_workers):
+            pass
+        # Fans out price requests of all models and built years.
+        units = [(model, i) for model in models
+                 for i in range(len(model.prices))]
+        for _ in self._imap(self._crawl_unit, units, max_workers):
+            pass
+        return models
+
+    def iter_table(self, table, vehicle_type=1, max_workers=None,
+                   checkpoint=None, maker_ids=None):
+        """Crawls a whole reference table and yields its price records.
+
+        Makers, models, built years and prices are crawled by a pipeline
+        of generators, each stage fanning out up to `max_workers` requests.
+        Records are yielded as soon as they resolve, in the same order as
+        a serial crawl, and car model objects are released once all their
+        prices were yielded, so memory use does not grow with table size.
+        If the crawler has a request planner, it spares built year
+        requests whose outcome is already known.
 
-        if model.maker.vehicle_type == 1:
-            vehicle_type_descriptor = 'carro'
+        Several vehicle types are crawled in a single pass: their makers
+        are interleaved round-robin into the same pipeline, so requests of
+        all types share the connection pool, in-flight limit and rate
+        limiter of the crawler.
+
+        If a `checkpoint` database is given, the crawl can be resumed. Each
+        (table, maker, model, built year, fuel type) work unit is recorded
+        in it and marked as done once its record is ingested into it, see
+        `Fipe_db.ingest`, or as failed if its price request gave up. A
+        restarted crawl skips done units and does not crawl built years of
+        models already recorded.
+
+        Parameters
+        ----------
+        table : Table
+            Reference table.
+        vehicle_type : integer or sequence, optional
+            Type of vehicle (1=car, 2=motorcycle, 3=truck), or sequence of
+            types, e.g. `Fipe.vehicle_types` for all of them.
+        max_workers : integer, optional
+            Maximum number of requests in flight. Defaults to the
+            crawler's `max_workers`.
+        checkpoint : Fipe_db or DbWriter, optional
+            Database to record crawl progress in.
+        maker_ids : iterable, optional
+            Ids of makers to crawl. The default is to crawl all makers.
+
+        Yields
+        ------
+        record : PriceRecord
+            Flat price record.
+
+        """
+        if isinstance(vehicle_type, int):
+            vehicle_types = [vehicle_type]
+        else:
+            vehicle_types = list(vehicle_type)
+        for vehicle_type in vehicle_types:
+            self._vehicle_type_descriptor(vehicle_type)
+        if self.planner is not None:
+            self.planner.start(table.id)
+        makers = _roundrobin(self._imap(partial(self.crawl_makers, table),
+                                        vehicle_types, max_workers))
+        if maker_ids is not None:
+            maker_ids = set(maker_ids)
+            makers = (maker for maker in makers if maker.id in maker_ids)
+        models = chain.from_iterable(
+            self._imap(self._crawl_maker_models, makers, max_workers))
+        # With a checkpoint, every database access happens in this thread.
+        if checkpoint is None:
+            jobs = ((model, None) for model in models)
+            crawl_unit = self._crawl_unit
         else:
+            jobs = self._resume_jobs(models, checkpoint)
+            crawl_unit = self._try_crawl_unit
+        jobs = self._imap(partial(self._crawl_job_years,
+                                  skip_errors=checkpoint is not None),
+                          jobs, max_workers)
+        units = self._job_units(jobs, checkpoint)
+        for model, i, error in self._imap(crawl_unit, units, max_workers):
+            if error is not None:
+                checkpoint.set_crawl_status(
+                    [('failed', error) + self._unit_key(model, i)])
+                continue
+            yield self._price_record(model, i)
+
+    def work(self, work_queue, db, batch_size=None, max_workers=None, poll=5.):
+        """Crawls units of a shared work queue until none is left.
+
+        Units are leased in batches of `batch_size` and crawled with up to
+        `max_workers` requests in flight, while a heartbeat thread renews
+        their leases. Prices are ingested into `db` before their units are
+        completed, so units of a worker that dies are crawled again by
+        others. Leases still held when leaving are released.
+
+        Parameters
+        ----------
+        work_queue : WorkQueue
+            Shared work queue.
+        db : Fipe_db
+            Database to ingest prices into.
+        batch_size : integer, optional
+            Number of units leased at once. Defaults to four times
+            `max_workers`.
+        max_workers : integer, optional
+            Maximum number of requests in flight. Defaults to the
+            crawler's `max_workers`.
+        poll : float, optional
+            Seconds to wait for units leased by other workers, which may
+            add more units when completed.
+
+        Returns
+        -------
+        n : integer
+            Number of ingested price records.
+
+        """
+        max_workers = max_workers or self.max_workers
+        batch_size = batch_size or 4 * max_workers
+        leased = []
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(work_queue.lease_time / 3):
+                if leased:
+                    work_queue.heartbeat(list(leased))
+
+        thread = threading.Thread(target=heartbeat, daemon=True)
+        thread.start()
+        n = 0
+        try:
+            while True:
+                units = work_queue.lease(batch_size)
+                if not units:
+                    counts = work_queue.counts()
+                    if not counts.get('pending') and not counts.get('leased'):
+                        return n
+                    sleep(poll)
+                    continue
+                leased[:] = units
+                results = list(self._imap(self._work_unit, units,
+                                          max_workers))
+                db.add_tables([Table.intern(unit.table_id, unit.table_year,
+                                            unit.table_month)
+                               for unit in units if unit.level == 0])
+                n += db.ingest(record for _, _, records, _ in results
+                               for record in records)
+                work_queue.complete([unit for unit, _, _, error in results
+                                     if error is None],
+                                    [child for _, children, _, _ in results
+                                     for child in children])
+                for unit, _, _, error in results:
+                    if error is not None:
+                        work_queue.fail([unit], error)
+                leased[:] = []
+        finally:
+            stop.set()
+            thread.join()
+            work_queue.release()
+
+    def _work_unit(self, unit):
+        """Crawls work unit.
+
+        Returns the unit, its children units, its price records and an
+        error message if crawling failed.
+
+        """
+        table = Table.intern(unit.table_id, unit.table_year, unit.table_month)
+        maker = CarMaker.intern(unit.maker_id, unit.maker, table,
+                                unit.vehicle_type)
+        model = CarModel(unit.model_id, unit.model, maker)
+        children, records = [], []
+        try:
+            if unit.level == 0:
+                for maker in self.crawl_makers(table, unit.vehicle_type):
+                    children.append((1, table.id, maker.vehicle_type,
+                                     maker.id, maker.name, 0, None, 0, 0))
+            elif unit.level == 1:
+                for model in self.crawl_models(maker):
+                    children.append((2, table.id, maker.vehicle_type,
+                                     maker.id, maker.name, model.id,
+                                     model.name, 0, 0))
+            elif unit.level == 2:
+                self.crawl_model_year(model)
+                for price in model.prices:
+                    children.append((3, table.id, maker.vehicle_type,
+                                     maker.id, maker.name, model.id,
+                                     model.name, price.build_year,
+                                     price.fuel_type))
+            else:
+                model.add_price(unit.build_year, unit.fuel_type)
+                self._crawl_price(model, 0)
+                records.append(self._price_record(model, 0))
+        except FipeRequestError as e:
+            return unit, [], [], str(e)
+        return unit, children, records, None
+
+    def _crawl_maker_models(self, maker):
+        """Crawls models of car maker and plans their built years."""
+        models = self.crawl_models(maker)
+        if self.planner is not None:
+            self.planner.plan(maker, models)
+        return models
+
+    def _resume_jobs(self, models, checkpoint):
+        """Yields `(model, indices)` jobs of models left to be crawled.
+
+        Built years of models recorded in `checkpoint` are restored from
+        it and `indices` lists their units not done yet. For models not
+        recorded yet `indices` is `None`.
+
+        """
+        for model in models:
+            units = checkpoint.get_crawl_units(
+                model.maker.table.id, model.maker.vehicle_type,
+                model.maker.id, model.id)
+            if not units:
+                yield model, None
+                continue
+            indices = []
+            for i, (build_year, fuel_type, status) in enumerate(units):
+                model.add_price(build_year, fuel_type)
+                if status != 'done':
+                    indices.append(i)
+            if indices:
+                yield model, indices
+
+    def _crawl_job_years(self, job, skip_errors=False):
+        """Crawls built years of job's model if needed.
+
+        Returns the model, the indices of its prices to crawl and whether
+        its built years are new.
+
+        """
+        model, indices = job
+        if indices is not None:
+            return model, indices, False
+        if self.planner is None or not self.planner.apply(model):
+            try:
+                self.crawl_model_year(model)
+            except FipeRequestError:
+                if not skip_errors:
+                    raise
+                # Units of the model are not recorded, so it is crawled
+                # again on restart.
+                return model, [], False
+        return model, range(len(model.prices)), True
+
+    def _job_units(self, jobs, checkpoint=None):
+        """Yields `(model, i)` units of jobs, recording new ones."""
+        for model, indices, new in jobs:
+            if new and checkpoint is not None:
+                checkpoint.add_crawl_units(
+                    [self._unit_key(model, i) + (i,) for i in indices])
+            for i in indices:
+                yield model, i
+
+    def _price_record(self, model, i):
+        """Returns the i-th price of car model as flat record."""
+        price = model.prices[i]
+        return PriceRecord(model.maker.table.id, model.maker.vehicle_type,
+                           model.maker.id, model.maker.name, model.id,
+                           model.name, price.build_year, price.fuel_type,
+                           price.price, price.fipe_code)
+
+    @staticmethod
+    def _unit_key(model, i):
+        """Returns the work unit key of the i-th price of car model."""
+        return (model.maker.table.id, model.maker.vehicle_type,
+                model.maker.id, model.id, model.prices[i].build_year,
+                model.prices[i].fuel_type)
+
+    def _crawl_unit(self, unit):
+        """Crawls price of `(model, i)` unit and returns it."""
+        self._crawl_price(*unit)
+        return unit + (None,)
+
+    def _try_crawl_unit(self, unit):
+        """Crawls price of `(model, i)` unit and returns it with error."""
+        try:
+            self._crawl_price(*unit)
+        except FipeRequestError as e:
+            return unit + (str(e),)
+        return unit + (None,)
+
+    def _crawl_price(self, model, i):
+        """Crawls and updates the i-th price of car model."""
+        data = {'codigoTabelaReferencia': model.maker.table.id,
+                'codigoMarca': model.maker.id,
+                'codigoModelo': model.id,
+                'codigoTipoVeiculo': model.maker.vehicle_type,
+                'anoModelo': model.prices[i].build_year,
+                'codigoTipoCombustivel': model.prices[i].fuel_type,
+                'tipoVeiculo': self._vehicle_type_descriptor(
+                    model.maker.vehicle_type),
+                'modeloCodigoExterno': None,
+                'tipoConsulta': 'tradicional'
+                }
+        url = '{}/api/veiculos/ConsultarValorComTodosParametros'.format(
+            self.base_url)
+        response = self._post_request(url, data=data)
+        if not isinstance(response, dict) or 'Valor' not in response:
+            # Fipe answers with an error message for built years it does
+            # not list, the price is left empty.
+            logger.debug('No price of model %s, built year %s: %s',
+                         model.id, model.prices[i].build_year, response)
+            return
+        # Converts price string into float.
+        price = ''
+        for s in response['Valor']:
+            if s in '1234567890':
+                price += s
+            elif s == ',':
+                price += '.'
+        #
+        model.update_price(i, price=float(price),
+                           fipe_code=response['CodigoFipe'])
+        if self.stats is not None:
+            self.stats.on_stage('prices')
+
+    def _vehicle_type_descriptor(self, vehicle_type):
+        """Returns the vehicle type name used in price requests."""
+        try:
+            return self.vehicle_types[vehicle_type]
+        except KeyError:
             raise ValueError('Invalid vehicle type: {}'.format(
-                model.maker.vehicle_type))
-
-        for i in irange:
-            data = {'codigoTabelaReferencia': model.maker.table.id,
-                    'codigoMarca': model.maker.id,
-                    'codigoModelo': model.id,
-                    'codigoTipoVeiculo': model.maker.vehicle_type,
-                    'anoModelo': model.prices[i].build_year,
-                    'codigoTipoCombustivel': model.prices[i].fuel_type,
-                    'tipoVeiculo': vehicle_type_descriptor,
-                    'modeloCodigoExterno': None,
-                    'tipoConsulta': 'tradicional'
-                    }
-            url = '{}/api/veiculos/ConsultarValorComTodosParametros'.format(
-                self.base_url)
-            response = self._post_request(url, data=data)
-            # Finally, return the dataframe of car makers
-            price = ''
-            for s in response['Valor']:
-                if s in '1234567890':
-                    price += s
-                elif s == ',':
-                    price += '.'
-            #
-            model.update_price(i, price=float(price),
-                               fipe_code=response['CodigoFipe'])
+                vehicle_type)) from None
+
+    def _imap(self, func, iterable, max_workers=None):
+        """Maps `func` over `iterable` with bounded concurrency.
+
+        Results are yielded in input order. The iterable is consumed
+        lazily and at most `max_workers` calls run at the same time, while
+        finished results wait in a window of twice that size. Requests of
+        nested maps share the crawler's in-flight limit, which is the
+        largest `max_workers` of running maps.
+
+        """
+        max_workers = max_workers or self.max_workers
+        if max_workers <= 1:
+            for item in iterable:
+                yield func(item)
+            return
+        pending = deque()
+        with self._slots:
+            self._limits[max_workers] += 1
+            self._slots.notify_all()
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                try:
+                    for item in iterable:
+                        pending.append(executor.submit(func, item))
+                        if len(pending) >= 2 * max_workers:
+                            yield pending.popleft().result()
+                    while pending:
+                        yield pending.popleft().result()
+                finally:
+                    for future in pending:
+                        future.cancel()
+        finally:
+            with self._slots:
+                self._limits[max_workers] -= 1
+                if not self._limits[max_workers]:
+                    del self._limits[max_workers]
+
+    @contextmanager
+    def _slot(self):
+        """Holds one of the crawler's in-flight request slots."""
+        with self._slots:
+            while self._in_flight >= max([self.max_workers, *self._limits]):
+                self._slots.wait()
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._slots:
+                self._in_flight -= 1
+                self._slots.notify()
 
     def _post_request(self, url, headers=None, data=None):
-        """Makes post request and returns JSON data."""
-        default_headers = {
-            'Host': 'veiculos.fipe.org.br',
-            # 'User-Agent': 'nublia.scraper/0.1',
-            'User-Agent': ('Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:54.0) '
-                           'Gecko/20100101 Firefox/54.0'),
-            'Accept': 'application/json, text/javascript, */*; q=0.01',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Accept-Encoding': 'gzip, deflate',
-            'X-Requested-With': 'XMLHttpRequest',
-            'Referer': '{}/'.format(self.base_url),
-            'DNT': '1',
-            'Connection': 'keep-alive',
-        }
-        headers = headers or default_headers
-        n = 5
+        """Makes post request and returns JSON data.
+
+        The request is sent through the pooled session, hence `headers`
+        are merged with the session's default headers. If the crawler has
+        a request planner, identical requests are sent only once per
+        crawl. If it has a response cache, the cache is looked up first
+        and successful responses are stored in it.
+
+        """
+        if self.planner is not None:
+            return self.planner.request(url, data, partial(
+                self._request, url, headers, data))
+        return self._request(url, headers, data)
+
+    def _request(self, url, headers=None, data=None):
+        """Makes post request with retries and returns JSON data."""
+        endpoint = url.rsplit('/', 1)[-1]
+        if self.cache is not None:
+            cached = self.cache.get(url, data)
+            if cached is not None:
+                if self.stats is not None:
+                    self.stats.on_stage('cache_hits')
+                return cached
+        if self.session is None:
+            self.connect()
+        attempt = 0
         while True:
+            attempt += 1
+            if self.breaker is not None:
+                self.breaker.wait()
+            ok, minimum = False, 0.
             try:
-                response = requests.post(url, data=data, headers=headers)
-                return response.json()
-            except (requests.ConnectionError,
+                if self.limiter is not None:
+                    self.limiter.acquire()
+                start = monotonic()
+                result, response = self._send(url, headers, data)
+                ok = True
+            except (requests.ConnectionError, requests.Timeout,
                     requests.exceptions.ChunkedEncodingError) as e:
-                print('ConnectionError: I will try again in {:d} s.'
-                      .format(n))
-                sleep(n)
-                n *= 2
-                pass
-            except requests.models.complexjson.JSONDecodeError:
-                print('JSONDecodeError: I will try again in {:d} s.'
-                      .format(n))
-                sleep(n)
-                n *= 2
-                pass
-
-        raise RuntimeError('I am not supposed to be here!')
-
-
-class Fipe_db():
-    """
-    Fipe database.
+                error, message = e, 'ConnectionError'
+            except requests.HTTPError as e:
+                error, message = e, 'HTTPError {:d}'.format(
+                    e.response.status_code)
+                minimum = _retry_after(e.response)
+            except requests.models.complexjson.JSONDecodeError as e:
+                error, message = e, 'JSONDecodeError'
+            except requests.RequestException as e:
+                error, message = e, type(e).__name__
+            finally:
+                # Whatever is raised, a half-open circuit is not left
+                # waiting for the outcome of its probe.
+                if self.breaker is not None:
+                    self.breaker.record(ok)
+            if ok:
+                latency = monotonic() - start
+                if self.stats is not None:
+                    # Size of the body as transferred, i.e. compressed.
+                    nbytes = int(response.headers.get('Content-Length') or
+                                 len(response.content))
+                    self.stats.on_request(endpoint, latency, nbytes)
+                if self.limiter is not None:
+                    self.limiter.feedback(True, latency)
+                if (self.cache is not None and result is not None and
+                        not (isinstance(result, dict) and 'erro' in result)):
+                    self.cache.set(url, data, result)
+                return result
+            latency = monotonic() - start
+            exhausted = self.retry.exhausted(attempt)
+            if self.stats is not None:
+                self.stats.on_request(endpoint, latency, 0, message,
+                                      retry=not exhausted)
+            if self.limiter is not None:
+                self.limiter.feedback(False, latency)
+            if exhausted:
+                raise FipeRequestError('{} after {:d} attempts: {}'.format(
+                    message, attempt, url)) from error
+            delay = self.retry.delay(attempt, minimum)
+            logger.warning('%s: I will try again in %.1f s (attempt %d).',
+                           message, delay, attempt)
+            sleep(delay)
 
-    Class to manage vehicle marked prices in Brazil as published by
-    Fipe -- Fundação Instituto de Pesquisas Econômicas.
+    def _send(self, url, headers=None, data=None):
+        """Sends a single post request.
+
+        Raises `requests.HTTPError` for responses whose status code is
+        retried by the crawler's retry policy.
+
+        Returns
+        -------
+        result : object
+            JSON data.
+        response : requests.Response
+            Response object.
+
+        """
+        with self._slot():
+            response = self.session.post(url, data=data, headers=headers,
+                                         timeout=self.timeout)
+        if response.status_code in self.retry.statuses:
+            raise requests.HTTPError(response=response)
+        return response.json(), response
+
+
+class RequestPlanner():
+    """Request planner of table crawls.
+
+    The planner spares built year requests whose outcome is already known
+    and sends identical listing requests only once per reference table.
+    Built years of a model are known without request if its maker has a
+    single model, whose built years are then those listed with the
+    maker's models.
+
+    Built years listed for a maker of several models are the union of
+    their built years, which does not tell which model a built year
+    belongs to. Such models are always requested, also when their maker's
+    listing did not change since the previous table, since a model may
+    gain a built year another model already lists.
 
     Parameters
     ----------
-    db : string, optional
-        Path of the SQLite database. The default is to store data in
-        memory only. Remember to use absolute paths.
+    memo_size : integer, optional
+        Maximum number of listing responses memoized per table.
 
     Examples
     --------
-    >> fipe = Fipe(':memory:')
-    >> import os
-    >> fipe = Fipe(os.path.realpath('../dat/dataset.db'))
+    >> planner = RequestPlanner()
+    >> fipe = Fipe(planner=planner)
+    >> db.ingest(fipe.iter_table(Table.intern(218, 2017, 10)))
+    >> planner.saved
 
     """
-    module_dir = dirname(__file__)
-
-    def __init__(self, db=':memory:'):
-        self.connect(db)
-
-    def connect(self, db):
-        """Connects to SQLite database."""
-        # Connects to database
-        self.conn = sqlite3.connect(db, isolation_level='Exclusive')
-        # Sets cursor
-        self.cursor = self.conn.cursor()
-        # Some optimization (https://stackoverflow.com/questions/
-        # 16572399/python-sqlite-cache-in-memory)
-        # self.cursor.execute('PRAGMA synchronous = 0;')
-        # self.cursor.execute('PRAGMA journal_mode = OFF;')
-        # self.conn.commit()
-
-    def create_schema(self):
-        """Creates Fipe database schema."""
-        self._execute_script_from_file('{}/schemas/{}'.format(
-            self.module_dir, 'fipe_db_model.sql'))
+    dedupe_endpoints = ('ConsultarTabelaDeReferencia', 'ConsultarMarcas',
+                        'ConsultarModelos', 'ConsultarAnoModelo')
 
-    def close(self):
-        """Closes the database connection."""
-        self.cursor.close()
-        self.conn.close()
-
-    def _execute_script_from_file(self, url):
-        """Executes SQL script in file given by `url`."""
-        with open(url, 'r') as f:
-            self.cursor.executescript(''.join(f.readlines()))
-            self.conn.commit()
+    def __init__(self, memo_size=65536):
+        self.table_id = None
+        self.saved = 0
+        self._planned = {}
+        self._memo = LRUCache(memo_size)
+        self._flight = SingleFlight()
+        self._lock = threading.Lock()
+
+    def start(self, table_id):
+        """Starts planning requests of reference table."""
+        with self._lock:
+            if table_id == self.table_id:
+                return
+            self.table_id = table_id
+            self._planned.clear()
+        self._memo.clear()
+
+    def plan(self, maker, models):
+        """Plans built years of models of car maker."""
+        years = maker.years
+        if not years or len(models) != 1:
+            return
+        with self._lock:
+            self._planned[(maker.vehicle_type, models[0].id)] = list(years)
+
+    def apply(self, model):
+        """Adds planned built years to model, if any.
+
+        Returns
+        -------
+        applied : boolean
+            `True` if built years were planned and the request spared.
+
+        """
+        key = (model.maker.vehicle_type, model.id)
+        with self._lock:
+            years = self._planned.pop(key, None)
+            if years is None:
+                return False
+            self.saved += 1
+        for build_year, fuel_type in years:
+            model.add_price(build_year, fuel_type)
+        return True
+
+    def request(self, url, data, fetch):
+        """Returns response of request, fetching it at most once.
+
+        Only listing endpoints are deduplicated, concurrent identical
+        requests wait for the first one.
+
+        """
+        endpoint = url.rsplit('/', 1)[-1]
+        if endpoint not in self.dedupe_endpoints:
+            return fetch()
+        key = _request_key(url, data)
+        response = self._memo.get(key, self)
+        if response is not self:
+            with self._lock:
+                self.saved += 1
+            return response
+        response = self._flight.do(key, fetch)
+        self._memo.set(key, response)
+        return response
+
+
+class SingleFlight():
+    """Deduplicates concurrent calls with the same key.
+
+    While a call is running, further calls with the same key wait for it
+    and share its result or exception.
+
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """Calls `func` unless a call with same key is running."""
+        with self._lock:
+            future = self._calls.get(key)
+            owner = future is None
+            if owner:
+                future = self._calls[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class LRUCache():
+    """Thread-safe, bounded least recently used cache.
+
+    Parameters
+    ----------
+    maxsize : integer, optional
+        Maximum number of cached items.
+
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """Returns cached item of `key` or `default`."""
+        with self._lock:
+            try:
+                value = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Caches item, evicting the least recently used one if full."""
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        """Removes all cached items."""
+        with self._lock:
+            self._items.clear()
+
+
+def _roundrobin(iterables):
+    """Yields items of iterables taking turns, until all are exhausted."""
+    iterators = deque(iter(iterable) for iterable in iterables)
+    while iterators:
+        iterator = iterators.popleft()
+        for item in iterator:
+            yield item
+            iterators.append(iterator)
+            break
+
+
+# The database lived in this module before storage got its own module.
+from .fipe_db import Fipe_db  # noqa: E402,F401
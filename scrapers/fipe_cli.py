@@ -0,0 +1,553 @@
+"""Fipe command-line interface.
+
+This module implements the `fipe` command, which crawls Fipe prices into
+databases or files, and the read-only HTTP service looking prices up.
+
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+
+from contextlib import closing
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from time import monotonic
+from urllib.parse import parse_qs, urlsplit
+
+from .fipe import Fipe, LRUCache, RequestPlanner
+from .fipe_db import Fipe_db, _sink_format, open_sink
+from .fipe_http import (CrawlStats, FipeRequestError, RateLimiter,
+                        ResponseCache, RetryPolicy, StatsReporter)
+
+logger = logging.getLogger(__name__)
+
+
+class Progress():
+    """Live crawl progress with estimated time left.
+
+    The estimate extrapolates the time taken by the makers finished so
+    far to the makers left, whose number is read from the crawl's `makers`
+    stage counter.
+
+    Parameters
+    ----------
+    stats : CrawlStats
+        Statistics of the crawl.
+    stream : file, optional
+        Stream to write progress to. Defaults to `sys.stderr`.
+    interval : float, optional
+        Minimum seconds between progress lines.
+
+    """
+
+    def __init__(self, stats, stream=None, interval=1.):
+        self.stats = stats
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.start('')
+
+    def start(self, label, makers=None):
+        """Starts reporting progress of a crawl, e.g. of a table.
+
+        `makers` overrides the number of makers to crawl, if known.
+
+        """
+        self.label = label
+        self.makers = makers
+        self.count = 0
+        self._first_maker = self.stats.stages['makers']
+        self._seen = set()
+        self._started = self._shown = monotonic()
+
+    def update(self, record):
+        """Counts record, showing progress at most every `interval`."""
+        self.count += 1
+        self._seen.add((record.vehicle_type, record.maker_id))
+        if monotonic() - self._shown >= self.interval:
+            self.show()
+
+    def eta(self):
+        """Returns estimated seconds left, `None` if unknown yet."""
+        total = self.total_makers()
+        done = len(self._seen) - 1
+        if not total or done <= 0:
+            return None
+        elapsed = monotonic() - self._started
+        return max(0., elapsed * (total - done) / done)
+
+    def total_makers(self):
+        """Returns number of makers of the crawl."""
+        if self.makers is not None:
+            return self.makers
+        return self.stats.stages['makers'] - self._first_maker
+
+    def show(self, end=None):
+        """Writes a progress line."""
+        self._shown = now = monotonic()
+        eta = self.eta()
+        rate = self.count / max(now - self._started, 1e-9)
+        line = '{}: {:d} records, {:d}/{:d} makers, {:.1f} records/s, ' \
+            'ETA {}'.format(self.label, self.count, len(self._seen),
+                            self.total_makers(), rate,
+                            '?' if eta is None else timedelta(
+                                seconds=round(eta)))
+        if end is None:
+            end = '\r' if self.stream.isatty() else '\n'
+        self.stream.write(line + end)
+        self.stream.flush()
+
+    def finish(self):
+        """Writes the final progress line of the crawl."""
+        self.show(end='\n')
+
+
+class LookupServer():
+    """Read-only HTTP price lookup service over a Fipe database.
+
+    Lookups are answered by a pool of read-only connections, which read
+    the latest committed snapshot of a write-ahead logged database while
+    crawls keep ingesting into it. Recent lookups are cached in memory
+    until another connection commits changes to the database.
+
+    Endpoints answer JSON, prices are given in reais and are `null` where
+    not found. The table defaults to the latest reference table:
+
+    - `GET /price?fipe_code=&build_year=&fuel_type=&table=`
+    - `POST /prices` of `{"keys": [{"fipe_code": ..., "build_year": ...,
+      "fuel_type": ..., "table": ...}, ...]}`, keys may also be given as
+      `[fipe_code, build_year, fuel_type, table]` lists.
+    - `GET /history?fipe_code=&build_year=&fuel_type=`
+    - `GET /health`
+    - `GET /metrics`, request counts and latencies in Prometheus text
+      format.
+
+    Parameters
+    ----------
+    db : string
+        Path of an existing SQLite database.
+    host, port : optional
+        Address to bind, port 0 binds to a free port.
+    pool_size : integer, optional
+        Number of read-only connections, i.e. of lookups run in parallel.
+    cache_size : integer, optional
+        Number of price lookups kept in memory.
+    max_batch : integer, optional
+        Maximum number of keys of a batch lookup.
+    stats : CrawlStats, optional
+        Registry of requests and lookups. Defaults to one with sub-
+        millisecond latency buckets.
+
+    Examples
+    --------
+    >> with LookupServer(os.path.realpath('../dat/dataset.db')) as server:
+    ..     requests.post(server.url + '/prices', json={'keys': [
+    ..         ['025128-3', 2008, 1, 218], ['025128-3', 2008, 1, None]]})
+
+    """
+    latency_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                       0.025, 0.05, 0.1, 0.25, 1.)
+
+    def __init__(self, db, host='127.0.0.1', port=8080, pool_size=8,
+                 cache_size=65536, max_batch=10000, stats=None):
+        self.db = db
+        self.max_batch = max_batch
+        self.stats = stats or CrawlStats(buckets=self.latency_buckets)
+        self.cache = LRUCache(cache_size)
+        self._pool = queue.LifoQueue()
+        for _ in range(pool_size):
+            self._pool.put(Fipe_db(db, lookup_cache=0, read_only=True))
+        self._watcher = Fipe_db(db, lookup_cache=0, read_only=True)
+        self._lock = threading.Lock()
+        self._version = None
+        self._generation = 0
+        self._latest = None
+        self._httpd = _LookupHTTPServer((host, port), _LookupHandler)
+        self._httpd.service = self
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def url(self):
+        """Base URL of the service."""
+        host, port = self._httpd.server_address[:2]
+        return 'http://{}:{:d}'.format(host, port)
+
+    def start(self):
+        """Serves requests from a background thread."""
+        self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                        name='fipe-lookup', daemon=True)
+        self._thread.start()
+
+    def serve_forever(self):
+        """Serves requests until interrupted."""
+        self._httpd.serve_forever()
+
+    def stop(self):
+        """Stops serving and closes all connections."""
+        if self._thread is not None:
+            self._httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._httpd.server_close()
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+        self._watcher.close()
+
+    def get_prices(self, keys):
+        """Returns prices of many vehicles at once.
+
+        Parameters
+        ----------
+        keys : iterable
+            List of `(fipe_code, build_year, fuel_type, table_id)` tuples,
+            a `table_id` of `None` denoting the latest reference table.
+
+        Returns
+        -------
+        keys, prices : list
+            Keys with their table ids and prices, `None` where not found.
+
+        """
+        generation, latest = self._refresh()
+        keys = [tuple(key[:3]) + (latest if key[3] is None else key[3],)
+                for key in keys]
+        prices = [self.cache.get((generation,) + key, self) for key in keys]
+        missing = [key for key, price in zip(keys, prices) if price is self]
+        if missing:
+            db = self._pool.get()
+            try:
+                found = db.get_prices(missing)
+            finally:
+                self._pool.put(db)
+            for key, price in zip(missing, found):
+                self.cache.set((generation,) + key, price)
+            found = iter(found)
+            prices = [next(found) if price is self else price
+                      for price in prices]
+        self.stats.on_stage('lookups', len(keys))
+        self.stats.on_stage('cache_hits', len(keys) - len(missing))
+        return keys, prices
+
+    def get_price_history(self, fipe_code, build_year=None, fuel_type=None):
+        """Returns monthly price history of vehicle, see `Fipe_db`."""
+        db = self._pool.get()
+        try:
+            return db.get_price_history(fipe_code, build_year, fuel_type)
+        finally:
+            self._pool.put(db)
+
+    def answer(self, method, path, body=b''):
+        """Returns HTTP status and JSON data answering a request.
+
+        Raises `KeyError` for missing parameters and `ValueError` or
+        `TypeError` for invalid ones.
+
+        """
+        url = urlsplit(path)
+        endpoint = url.path.strip('/')
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if (method, endpoint) == ('GET', 'price'):
+            keys, prices = self.get_prices([self._key(params)])
+            result = dict(zip(('fipe_code', 'build_year', 'fuel_type',
+                               'table'), keys[0]), price=prices[0])
+            return 200, result
+        if (method, endpoint) == ('POST', 'prices'):
+            items = json.loads(body.decode('utf-8'))['keys']
+            if len(items) > self.max_batch:
+                raise ValueError('More than {:d} keys.'.format(
+                    self.max_batch))
+            keys, prices = self.get_prices([self._key(item)
+                                            for item in items])
+            return 200, {'tables': [key[3] for key in keys],
+                         'prices': prices}
+        if (method, endpoint) == ('GET', 'history'):
+            rows = self.get_price_history(
+                params['fipe_code'], self._int(params.get('build_year')),
+                self._int(params.get('fuel_type')))
+            fields = ('table', 'year', 'month', 'build_year', 'fuel_type',
+                      'price')
+            return 200, {'fipe_code': params['fipe_code'],
+                         'history': [dict(zip(fields, row))
+                                     for row in rows]}
+        if (method, endpoint) == ('GET', 'health'):
+            return 200, {'status': 'ok', 'latest_table': self._refresh()[1]}
+        return 404, {'error': 'Unknown endpoint {} {}.'.format(
+            method, url.path)}
+
+    def _refresh(self):
+        """Returns cache generation and latest reference table.
+
+        A new generation starts whenever the database changed. Keys of
+        cached lookups include their generation, so that lookups read
+        before a change and cached after it are never hit.
+
+        """
+        with self._lock:
+            cursor = self._watcher.conn.execute('PRAGMA data_version')
+            version = cursor.fetchone()[0]
+            if version != self._version:
+                self._version = version
+                self._generation += 1
+                self._latest = self._watcher.conn.execute(
+                    'SELECT MAX(id) FROM reference_table').fetchone()[0]
+                self.cache.clear()
+            return self._generation, self._latest
+
+    @classmethod
+    def _key(cls, item):
+        """Returns lookup key of query parameters or JSON item."""
+        if isinstance(item, dict):
+            item = [item['fipe_code'], item['build_year'],
+                    item['fuel_type'], item.get('table')]
+        elif len(item) == 3:
+            item = list(item) + [None]
+        fipe_code, build_year, fuel_type, table = item
+        return (str(fipe_code), int(build_year), int(fuel_type),
+                cls._int(table))
+
+    @staticmethod
+    def _int(value):
+        return None if value is None else int(value)
+
+
+class _LookupHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _LookupHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    wbufsize = -1
+    endpoints = ('price', 'prices', 'history', 'health', 'metrics')
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def _handle(self, method):
+        start = monotonic()
+        service = self.server.service
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        endpoint = urlsplit(self.path).path.strip('/')
+        error = None
+        content_type = 'application/json'
+        if endpoint == 'metrics':
+            status = 200
+            content = service.stats.to_prometheus('fipe_lookup')
+            content_type = 'text/plain; version=0.0.4'
+        else:
+            try:
+                status, content = service.answer(method, self.path, body)
+            except KeyError as e:
+                status, error = 400, 'Missing {}.'.format(e)
+            except (ValueError, TypeError) as e:
+                status, error = 400, str(e)
+            except Exception as e:
+                logger.exception('Lookup failed.')
+                status, error = 500, type(e).__name__
+            if error is not None:
+                content = {'error': error}
+            content = json.dumps(content)
+        content = content.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        service.stats.on_request(
+            endpoint if endpoint in self.endpoints else 'unknown',
+            monotonic() - start, len(content),
+            None if status < 400 else str(status))
+
+    def log_message(self, *args):
+        pass
+
+
+def main(argv=None):
+    """Runs the Fipe command-line interface.
+
+    Usage
+    -----
+      $ python3 -m scrapers tables
+      $ python3 -m scrapers crawl --latest 2 --vehicle-types 1 2 3 \\
+            --workers 16 --rate 20 --cache cache.db -o fipe.db --resume
+      $ python3 -m scrapers serve fipe.db --port 8080
+
+    Returns
+    -------
+    status : integer
+        Exit status.
+
+    """
+    parser = argparse.ArgumentParser(
+        prog='fipe', description='Crawls vehicle prices published by Fipe.')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='log more, repeat for debugging output')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    def client_options(command):
+        command.add_argument('--base-url', help='root URL of the Fipe API')
+        command.add_argument('--timeout', type=float, default=30.,
+                             help='read timeout in seconds')
+        command.add_argument('--retries', type=int, default=8,
+                             help='attempts of failing requests')
+        command.add_argument('--cache', metavar='PATH',
+                             help='SQLite response cache')
+
+    command = commands.add_parser('tables', help='list reference tables')
+    client_options(command)
+    command = commands.add_parser('crawl', help='crawl reference tables')
+    client_options(command)
+    selection = command.add_mutually_exclusive_group()
+    selection.add_argument('--tables', type=int, nargs='+', metavar='ID',
+                           help='ids of reference tables to crawl')
+    selection.add_argument('--latest', type=int, default=1, metavar='N',
+                           help='crawl the N latest reference tables')
+    command.add_argument('--vehicle-types', type=int, nargs='+', default=[1],
+                         choices=sorted(Fipe.vehicle_types),
+                         help='vehicle types crawled in a single pass')
+    command.add_argument('--makers', type=int, nargs='+', metavar='ID',
+                         help='ids of makers to crawl')
+    command.add_argument('--workers', type=int, default=8,
+                         help='maximum number of requests in flight')
+    command.add_argument('--rate', type=float,
+                         help='initial requests per second, adapted to '
+                         'the server')
+    command.add_argument('--max-rate', type=float, default=200.,
+                         help='maximum requests per second')
+    command.add_argument('--plan', action='store_true',
+                         help='spare requests of known built years')
+    command.add_argument('-o', '--output', default='-', metavar='PATH',
+                         help='output file, stdout by default')
+    command.add_argument('--format', choices=('sqlite', 'csv', 'jsonl'),
+                         help='output format, guessed from the extension')
+    command.add_argument('--storage', choices=('snapshot', 'changes'),
+                         help='price storage of SQLite output')
+    command.add_argument('--aggregates', action='store_true',
+                         help='maintain price indices and depreciation '
+                         'curves of SQLite output')
+    command.add_argument('--resume', action='store_true',
+                         help='record progress in SQLite output and '
+                         'resume interrupted crawls')
+    command.add_argument('--buffer', type=int, default=10000,
+                         help='maximum number of buffered records')
+    command.add_argument('--metrics', metavar='PATH',
+                         help='file exporting Prometheus metrics')
+    command.add_argument('-q', '--quiet', action='store_true',
+                         help='do not show progress')
+    command = commands.add_parser('serve', help='serve price lookups')
+    command.add_argument('db', help='SQLite database of crawled prices')
+    command.add_argument('--host', default='127.0.0.1',
+                         help='address to bind')
+    command.add_argument('--port', type=int, default=8080,
+                         help='port to bind')
+    command.add_argument('--pool', type=int, default=8,
+                         help='number of read-only connections')
+    command.add_argument('--cache-size', type=int, default=65536,
+                         help='number of cached lookups')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=max(logging.DEBUG, logging.WARNING -
+                                  10 * args.verbose),
+                        format='%(asctime)s %(levelname)s %(message)s')
+    if args.command == 'serve':
+        if not os.path.exists(args.db):
+            parser.error('database `{}` not found'.format(args.db))
+        server = LookupServer(os.path.realpath(args.db), host=args.host,
+                              port=args.port, pool_size=args.pool,
+                              cache_size=args.cache_size)
+        print('Serving lookups at {}'.format(server.url), file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.stop()
+        return 0
+
+    stats = CrawlStats()
+    options = dict(timeout=(5, args.timeout), stats=stats,
+                   retry=RetryPolicy(max_attempts=args.retries),
+                   base_url=args.base_url)
+    if args.cache:
+        options['cache'] = ResponseCache(os.path.realpath(args.cache))
+    if args.command == 'tables':
+        with Fipe(**options) as crawler:
+            for table in crawler.crawl_reference_tables():
+                print('{}\t{}-{:02d}'.format(table.id, table.year,
+                                             table.month))
+        return 0
+
+    if args.resume and _sink_format(args.output, args.format) != 'sqlite':
+        parser.error('--resume requires SQLite output')
+    sink = open_sink(args.output, args.format, args.buffer, args.storage,
+                     stats, args.aggregates)
+    if args.rate:
+        options['limiter'] = RateLimiter(rate=args.rate,
+                                         max_rate=args.max_rate)
+    reporter = None
+    if args.metrics:
+        reporter = StatsReporter(stats, path=args.metrics)
+        reporter.start()
+    progress = None if args.quiet else Progress(stats)
+    status = 0
+    try:
+        with sink, Fipe(max_workers=args.workers, **options) as crawler:
+            tables = crawler.crawl_reference_tables()
+            if args.tables:
+                tables = [table for table in tables
+                          if table.id in args.tables]
+            else:
+                tables = sorted(tables, key=lambda table: table.id,
+                                reverse=True)[:args.latest]
+            tables.sort(key=lambda table: table.id)
+            if args.plan:
+                crawler.planner = RequestPlanner()
+            sink.add_tables(tables)
+            for table in tables:
+                if progress is not None:
+                    progress.start('Table {}'.format(table), makers=(
+                        len(args.makers) * len(args.vehicle_types)
+                        if args.makers else None))
+                # Units are recorded by the writer thread and marked as
+                # done in the transactions committing their prices.
+                records = crawler.iter_table(
+                    table, args.vehicle_types,
+                    checkpoint=sink if args.resume else None,
+                    maker_ids=args.makers)
+                # The pipeline stops before the writer is closed.
+                with closing(records):
+                    for record in records:
+                        sink.write(record)
+                        if progress is not None:
+                            progress.update(record)
+                sink.flush()
+                if progress is not None:
+                    progress.finish()
+    except FipeRequestError as e:
+        logger.error('Crawl aborted: %s', e)
+        status = 1
+    except KeyboardInterrupt:
+        status = 130
+    finally:
+        if reporter is not None:
+            reporter.stop()
+    return status
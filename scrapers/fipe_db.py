@@ -0,0 +1,1821 @@
+"""Fipe price storage.
+
+This module implements the local SQLite database of Fipe prices, its
+background writer and the other sinks of crawled prices, columnar exports
+and the shared work queue of distributed crawls.
+
+"""
+import csv
+import json
+import logging
+import os
+import pandas as pd
+import queue
+import re
+import socket
+import sqlite3
+import sys
+import threading
+import unicodedata
+
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict, namedtuple
+from contextlib import contextmanager
+from itertools import islice
+from os.path import dirname
+from time import monotonic, time
+from urllib.parse import quote
+
+from .fipe import LRUCache, PriceRecord
+
+logger = logging.getLogger(__name__)
+
+
+class FipeDbError(RuntimeError):
+    """Raised when the background database writer failed."""
+
+
+ModelMatch = namedtuple('ModelMatch', [
+    'fipe_code', 'vehicle_type', 'maker_id', 'maker', 'model_id', 'model',
+    'first_year', 'last_year', 'score'])
+ModelMatch.__doc__ = """Candidate Fipe model of a searched title.
+
+The match holds the Fipe code, vehicle type, maker and model ids and
+names, the range of built years priced and a score between 0 and 1, the
+share of the model name tokens found in the title.
+
+"""
+
+
+def _search_tokens(text):
+    """Returns normalized search tokens of text.
+
+    Text is lower cased and stripped of diacritics. Decimals such as "1.6"
+    or "1,6" are kept as single tokens.
+
+    """
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return [token.replace(',', '.') for token in
+            re.findall(r'[a-z0-9]+(?:[.,][0-9]+)*', text)]
+
+
+def _trigrams(token):
+    """Returns trigrams of token padded with spaces."""
+    token = ' {} '.format(token)
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+
+WorkUnit = namedtuple('WorkUnit', [
+    'id', 'level', 'table_id', 'table_year', 'table_month', 'vehicle_type',
+    'maker_id', 'maker', 'model_id', 'model', 'build_year', 'fuel_type',
+    'attempts'])
+WorkUnit.__doc__ = """Leased unit of a work queue."""
+
+
+class WorkQueue():
+    """Work queue shared by crawlers on many processes or hosts.
+
+    Crawls are split into work units stored in a shared SQLite database.
+    Workers lease units for `lease_time` seconds, renew their leases with
+    heartbeats and complete or fail them. Units of workers that died are
+    leased again once their lease expired. Completing a unit that lists
+    makers, models or built years adds its children units, so a whole
+    reference table is crawled by enqueueing a single unit with
+    `add_table`. Units of deeper levels are leased first.
+
+    Other backends are used by `Fipe.work` if they implement `lease`,
+    `heartbeat`, `complete`, `fail`, `release` and `counts`.
+
+    Parameters
+    ----------
+    path : string
+        Path of the SQLite queue database, on a file system shared by all
+        workers.
+    worker : string, optional
+        Worker name. Defaults to host name and process id.
+    lease_time : float, optional
+        Seconds a lease lasts without heartbeat.
+    max_attempts : integer, optional
+        Number of leases of a failing unit before it is marked as failed,
+        whether it failed or its lease expired.
+
+    Examples
+    --------
+    >> queue = WorkQueue('/shared/queue.db')
+    >> queue.add_table(Table.intern(218, 2017, 10))
+    >> # On every worker:
+    >> Fipe(max_workers=8).work(WorkQueue('/shared/queue.db'),
+    ..                          Fipe_db('/local/fipe.db'))
+
+    """
+    module_dir = dirname(__file__)
+
+    def __init__(self, path, worker=None, lease_time=60., max_attempts=5):
+        self.worker = worker or '{}:{}'.format(socket.gethostname(),
+                                               os.getpid())
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode = WAL;')
+        self.conn.execute('PRAGMA synchronous = NORMAL;')
+        with open('{}/schemas/{}'.format(self.module_dir,
+                                         'fipe_queue.sql')) as f:
+            self.conn.executescript(f.read())
+
+    def add_table(self, table, vehicle_types=(1,)):
+        """Enqueues crawl of reference table for given vehicle types."""
+        with self._transaction():
+            self.conn.execute(
+                'INSERT OR REPLACE INTO work_table (id, year, month) '
+                'VALUES (?, ?, ?)', (table.id, table.year, table.month))
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO work_unit (level, table_id, '
+                'vehicle_type) VALUES (0, ?, ?)',
+                [(table.id, vehicle_type) for vehicle_type in vehicle_types])
+
+    def lease(self, n=1):
+        """Leases up to `n` pending or abandoned units.
+
+        Returns
+        -------
+        lst : list
+            List of leased `WorkUnit` tuples.
+
+        """
+        now = time()
+        with self._transaction():
+            # Units whose workers keep dying are given up like failed ones.
+            self.conn.execute(
+                'UPDATE work_unit SET status = \'failed\', error = '
+                '\'Lease expired.\', lease_expires = NULL WHERE status = '
+                '\'leased\' AND lease_expires < ? AND attempts >= ?',
+                (now, self.max_attempts))
+            ids = [row[0] for row in self.conn.execute(
+                'SELECT id FROM work_unit WHERE status = \'pending\' OR '
+                '(status = \'leased\' AND lease_expires < ?) '
+                'ORDER BY level DESC, id LIMIT ?', (now, n))]
+            self.conn.executemany(
+                'UPDATE work_unit SET status = \'leased\', worker = ?, '
+                'lease_expires = ?, attempts = attempts + 1 WHERE id = ?',
+                [(self.worker, now + self.lease_time, id) for id in ids])
+            units = [WorkUnit(*row) for row in self.conn.execute(
+                'SELECT work_unit.id, level, table_id, work_table.year, '
+                'work_table.month, vehicle_type, maker_id, maker, model_id, '
+                'model, build_year, fuel_type, attempts FROM work_unit JOIN '
+                'work_table ON work_table.id = work_unit.table_id '
+                'WHERE work_unit.id IN ({}) ORDER BY level DESC, '
+                'work_unit.id'.format(', '.join('?' * len(ids))), ids)]
+        return units
+
+    def heartbeat(self, units):
+        """Renews leases of units held by this worker."""
+        with self._transaction():
+            self.conn.executemany(
+                'UPDATE work_unit SET lease_expires = ? WHERE id = ? AND '
+                'worker = ? AND status = \'leased\'',
+                [(time() + self.lease_time, unit.id, self.worker)
+                 for unit in units])
+
+    def complete(self, units, children=()):
+        """Marks units held by this worker as done and adds children.
+
+        Parameters
+        ----------
+        units : list
+            Completed work units.
+        children : iterable
+            Child units as `(level, table_id, vehicle_type, maker_id,
+            maker, model_id, model, build_year, fuel_type)` tuples.
+
+        Returns
+        -------
+        n : integer
+            Number of units completed. Units whose lease was lost to
+            another worker are not counted.
+
+        """
+        with self._transaction():
+            n = 0
+            for unit in units:
+                n += self.conn.execute(
+                    'UPDATE work_unit SET status = \'done\', error = NULL, '
+                    'lease_expires = NULL WHERE id = ? AND worker = ? '
+                    'AND status = \'leased\'', (unit.id, self.worker)
+                ).rowcount
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO work_unit (level, table_id, '
+                'vehicle_type, maker_id, maker, model_id, model, build_year, '
+                'fuel_type) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', children)
+        return n
+
+    def fail(self, units, error=None):
+        """Returns units held by this worker to the queue.
+
+        Units already leased `max_attempts` times are marked as failed.
+
+        """
+        with self._transaction():
+            self.conn.executemany(
+                'UPDATE work_unit SET status = CASE WHEN attempts >= ? '
+                'THEN \'failed\' ELSE \'pending\' END, error = ?, '
+                'lease_expires = NULL WHERE id = ? AND worker = ? AND '
+                'status = \'leased\'',
+                [(self.max_attempts, error, unit.id, self.worker)
+                 for unit in units])
+
+    def release(self):
+        """Returns all units leased by this worker to the queue.
+
+        Attempts of units whose lease had not expired yet are refunded.
+
+        """
+        with self._transaction():
+            self.conn.execute(
+                'UPDATE work_unit SET status = \'pending\', '
+                'attempts = attempts - (lease_expires >= ?), '
+                'lease_expires = NULL WHERE worker = ? AND '
+                'status = \'leased\'', (time(), self.worker))
+
+    def retry_failed(self):
+        """Returns failed units to the queue."""
+        with self._transaction():
+            self.conn.execute(
+                'UPDATE work_unit SET status = \'pending\', attempts = 0 '
+                'WHERE status = \'failed\'')
+
+    def counts(self):
+        """Returns dictionary of number of units by status."""
+        with self._lock:
+            return dict(self.conn.execute(
+                'SELECT status, COUNT(*) FROM work_unit GROUP BY status'))
+
+    def close(self):
+        """Closes the queue database connection."""
+        self.conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        """Runs statements in an immediate transaction."""
+        with self._lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+
+class Fipe_db():
+    """
+    Fipe database.
+
+    Class to manage vehicle marked prices in Brazil as published by
+    Fipe -- Fundação Instituto de Pesquisas Econômicas.
+
+    Parameters
+    ----------
+    db : string, optional
+        Path of the SQLite database. The default is to store data in
+        memory only. Remember to use absolute paths.
+    pragmas : dictionary, optional
+        SQLite pragmas overriding `default_pragmas`.
+    lookup_cache : integer, optional
+        Number of price lookups kept in memory.
+    stats : CrawlStats, optional
+        Statistics registry notified of ingested rows.
+    storage : string, optional
+        Either 'snapshot', storing every price of every reference table,
+        or 'changes', storing a price version only when a price or Fipe
+        code changes from one reference table to the next. Defaults to the
+        storage of an existing database, or 'snapshot' for a new one.
+    read_only : boolean, optional
+        If `True`, opens an existing database read-only, e.g. to look up
+        prices while another connection ingests. The connection may then
+        be used from any thread, by one thread at a time.
+    aggregates : boolean, optional
+        If `True`, `create_schema` creates price aggregates. Once created,
+        aggregates are maintained by every `ingest`, which slows it down
+        several times, see `rebuild_aggregates` to build them once after
+        bulk ingests instead.
+
+    Examples
+    --------
+    >> fipe = Fipe(':memory:')
+    >> import os
+    >> fipe = Fipe(os.path.realpath('../dat/dataset.db'))
+
+    Crawled price records are ingested in bulk:
+
+    >> db = Fipe_db(os.path.realpath('../dat/dataset.db'))
+    >> db.create_schema()
+    >> db.add_tables(tables)
+    >> db.ingest(Fipe().iter_table(tables[0]))
+
+    Prices are looked up by Fipe code, built year, fuel type and table:
+
+    >> db.get_price('025128-3', 2008, 1, 218)
+    >> db.get_price_history('025128-3')
+
+    Price indices and depreciation curves of makers are read from
+    aggregates, built after the ingest:
+
+    >> db.rebuild_aggregates()
+    >> db.get_price_index(vehicle_type=1, maker_id=21)
+    >> db.get_depreciation(vehicle_type=1, maker_id=21)
+
+    Change-only storage answers the same queries, full snapshots of any
+    reference table being rebuilt from price versions, e.g. to compact a
+    snapshot database:
+
+    >> compact = Fipe_db(os.path.realpath('../dat/compact.db'),
+    ..                   storage='changes')
+    >> compact.create_schema()
+    >> compact.ingest(db.iter_records())
+    >> compact.iter_records(table_id=218)
+
+    """
+    module_dir = dirname(__file__)
+    default_pragmas = {
+        # Write-ahead logging lets readers run concurrently to a writer,
+        # which only needs to sync the log at checkpoints.
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        # 64 MiB page cache and 256 MiB memory mapped I/O.
+        'cache_size': -65536,
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY',
+    }
+
+    def __init__(self, db=':memory:', pragmas=None, lookup_cache=4096,
+                 stats=None, storage=None, read_only=False,
+                 aggregates=False):
+        self.pragmas = dict(self.default_pragmas, **(pragmas or {}))
+        self.read_only = read_only
+        self.aggregates = aggregates
+        if read_only:
+            # The journal mode is the writer's, reads see its snapshots.
+            self.pragmas.pop('journal_mode', None)
+            self.pragmas['query_only'] = 'ON'
+        self.lookups = LRUCache(lookup_cache)
+        self.stats = stats
+        self.connect(db)
+        if storage is None:
+            self.cursor.execute(
+                'SELECT COUNT(*) FROM sqlite_master WHERE type = \'table\' '
+                'AND name = \'price_version\'')
+            storage = 'changes' if self.cursor.fetchone()[0] else 'snapshot'
+        if storage not in ('snapshot', 'changes'):
+            raise ValueError('Invalid storage `{}`.'.format(storage))
+        self.storage = storage
+
+    def connect(self, db):
+        """Connects to SQLite database."""
+        # Connects to database
+        if self.read_only:
+            self.conn = sqlite3.connect(
+                'file:{}?mode=ro'.format(quote(os.path.abspath(db))),
+                isolation_level='DEFERRED', uri=True,
+                check_same_thread=False)
+        else:
+            self.conn = sqlite3.connect(db, isolation_level='DEFERRED')
+        # Sets cursor
+        self.cursor = self.conn.cursor()
+        # Some optimization (https://stackoverflow.com/questions/
+        # 16572399/python-sqlite-cache-in-memory)
+        for key, value in self.pragmas.items():
+            self.cursor.execute('PRAGMA {} = {};'.format(key, value))
+        self._makers = set()
+        self._models = set()
+        self._tables = set()
+        self._fipe_codes = {}
+        # Changes only when other connections commit, see `get_prices`.
+        self._data_version = None
+        # Search tokens with their number of entries, loaded on first use.
+        self._vocabulary = None
+        self._search_size = 0
+        self._corrections = LRUCache(65536)
+
+    def create_schema(self):
+        """Creates Fipe database schema.
+
+        With `aggregates`, price aggregates missing from the database are
+        built from its stored prices.
+
+        """
+        self._execute_script_from_file('{}/schemas/{}'.format(
+            self.module_dir, 'fipe_db_model.sql'))
+        if self.storage == 'changes':
+            self._execute_script_from_file('{}/schemas/{}'.format(
+                self.module_dir, 'fipe_db_history.sql'))
+        if self.aggregates and not self._has_aggregates():
+            self.rebuild_aggregates()
+        self.create_crawl_schema()
+
+    def add_tables(self, tables):
+        """Adds or updates reference tables.
+
+        Parameters
+        ----------
+        tables : iterable
+            Reference table objects.
+
+        """
+        rows = [(table.id, table.year, table.month) for table in tables]
+        self.cursor.executemany(
+            'INSERT INTO reference_table (id, year, month) VALUES (?, ?, ?) '
+            'ON CONFLICT (id) DO UPDATE SET year = excluded.year, '
+            'month = excluded.month', rows)
+        self.conn.commit()
+        self._tables.update(row[0] for row in rows)
+
+    def ingest(self, records, batch_size=10000):
+        """Bulk ingests price records.
+
+        Makers and models are added or updated the first time they are
+        seen by this connection. Prices are inserted in batches of
+        `batch_size` records, each batch in a single transaction, and
+        replace prices already stored for the same key.
+
+        With change-only storage, a price equal to the one of the
+        previous or next reference table extends the validity range of
+        that price version, while a changed price splits it. Tables may
+        thus be ingested in any order and ingested again.
+
+        Price aggregates, if created, are updated in the same transactions,
+        from the pairs of prices involving each batch's keys only, see
+        `rebuild_aggregates`. Crawl units of
+        the ingested prices are marked as done in them too, so a resumed
+        crawl skips exactly the prices already stored.
+
+        Parameters
+        ----------
+        records : iterable
+            Price records, e.g. as yielded by `Fipe.iter_table`.
+        batch_size : integer, optional
+            Number of records committed at once.
+
+        Returns
+        -------
+        n : integer
+            Number of ingested records.
+
+        """
+        n = 0
+        tables, makers, models, prices, units = [], [], [], [], []
+        for record in records:
+            if record.table not in self._tables:
+                self._tables.add(record.table)
+                tables.append((record.table,))
+            key = (record.vehicle_type, record.maker_id)
+            if key not in self._makers:
+                self._makers.add(key)
+                makers.append(key + (record.maker,))
+            key = (record.vehicle_type, record.model_id)
+            if key not in self._models:
+                self._models.add(key)
+                models.append(key + (record.maker_id, record.model))
+            prices.append((record.table, record.vehicle_type,
+                           record.model_id, record.build_year,
+                           record.fuel_type, self._cents(record.price),
+                           record.fipe_code))
+            units.append((record.table, record.vehicle_type,
+                          record.maker_id, record.model_id,
+                          record.build_year, record.fuel_type))
+            if len(prices) >= batch_size:
+                n += self._write_batch(tables, makers, models, prices,
+                                       units)
+                tables, makers, models, prices, units = [], [], [], [], []
+        n += self._write_batch(tables, makers, models, prices, units)
+        return n
+
+    def rebuild_aggregates(self):
+        """Creates or rebuilds price aggregates from all stored prices.
+
+        Aggregates are kept up to date by `ingest` once created, rebuilding
+        them is only needed after prices were changed by other means.
+        Building them once after bulk ingests is faster than maintaining
+        them along.
+
+        """
+        self._execute_script_from_file('{}/schemas/{}'.format(
+            self.module_dir, 'fipe_db_aggregate.sql'))
+        if not self.conn.in_transaction:
+            self.cursor.execute('BEGIN IMMEDIATE')
+        self.cursor.execute('DELETE FROM maker_price_change')
+        self.cursor.execute('DELETE FROM maker_depreciation')
+        self._stage_keys()
+        self._add_aggregates(1)
+        self.conn.commit()
+
+    def create_crawl_schema(self):
+        """Creates the schema recording crawl progress."""
+        self._execute_script_from_file('{}/schemas/{}'.format(
+            self.module_dir, 'fipe_db_crawl.sql'))
+
+    def get_crawl_units(self, table_id, vehicle_type, maker_id, model_id):
+        """Returns recorded work units of car model.
+
+        Returns
+        -------
+        lst : list
+            List of `(build_year, fuel_type, status)` tuples in crawl
+            order.
+
+        """
+        self.cursor.execute(
+            'SELECT build_year, fuel_type, status FROM crawl_unit '
+            'WHERE table_id = ? AND vehicle_type = ? AND maker_id = ? '
+            'AND model_id = ? ORDER BY position',
+            (table_id, vehicle_type, maker_id, model_id))
+        return self.cursor.fetchall()
+
+    def add_crawl_units(self, units):
+        """Records pending work units.
+
+        Parameters
+        ----------
+        units : list
+            List of `(table_id, vehicle_type, maker_id, model_id,
+            build_year, fuel_type, position)` tuples. Units already
+            recorded are left untouched.
+
+        """
+        self.cursor.executemany(
+            'INSERT OR IGNORE INTO crawl_unit (table_id, vehicle_type, '
+            'maker_id, model_id, build_year, fuel_type, position) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)', units)
+        self.conn.commit()
+
+    def set_crawl_status(self, units):
+        """Updates the status of work units.
+
+        Parameters
+        ----------
+        units : list
+            List of `(status, error, table_id, vehicle_type, maker_id,
+            model_id, build_year, fuel_type)` tuples, where status is
+            either 'pending', 'done' or 'failed'.
+
+        """
+        if not units:
+            return
+        self.cursor.executemany(
+            'UPDATE crawl_unit SET status = ?, error = ?, '
+            'attempts = attempts + 1, updated_at = julianday(\'now\') '
+            'WHERE table_id = ? AND vehicle_type = ? AND maker_id = ? '
+            'AND model_id = ? AND build_year = ? AND fuel_type = ?', units)
+        self.conn.commit()
+
+    def close(self):
+        """Closes the database connection."""
+        self.cursor.close()
+        self.conn.close()
+
+    def get_price(self, fipe_code, build_year, fuel_type, table_id):
+        """Returns price of vehicle in given reference table.
+
+        Parameters
+        ----------
+        fipe_code : string
+            Fipe code of vehicle.
+        build_year : integer
+            Built year, 32000 for brand new vehicles.
+        fuel_type : integer
+            Fuel type.
+        table_id : integer
+            Reference table id.
+
+        Returns
+        -------
+        price : float
+            Price or `None` if not found.
+
+        """
+        return self.get_prices([(fipe_code, build_year, fuel_type,
+                                 table_id)])[0]
+
+    def get_prices(self, keys):
+        """Returns prices of many vehicles at once.
+
+        Keys not found in the lookup cache are resolved by a few queries
+        joining chunks of keys with the price index. Cached lookups are
+        dropped whenever another connection committed changes.
+
+        Parameters
+        ----------
+        keys : iterable
+            List of `(fipe_code, build_year, fuel_type, table_id)` tuples.
+
+        Returns
+        -------
+        lst : list
+            List of prices in the order of `keys`, `None` where not found.
+
+        """
+        keys = [tuple(key) for key in keys]
+        version = self.conn.execute('PRAGMA data_version').fetchone()[0]
+        if version != self._data_version:
+            self._data_version = version
+            self.lookups.clear()
+        prices = [self.lookups.get(key, self) for key in keys]
+        missing = list(OrderedDict.fromkeys(
+            key for key, price in zip(keys, prices) if price is self))
+        if self.storage == 'changes':
+            sql = ('WITH k (fipe_code, build_year, fuel_type, table_id) AS '
+                   '(VALUES {}) SELECT k.fipe_code, k.build_year, '
+                   'k.fuel_type, k.table_id, v.price FROM k JOIN fipe_code '
+                   'ON fipe_code.code = k.fipe_code JOIN price_version AS v '
+                   'INDEXED BY price_version_fipe_code ON '
+                   'v.fipe_code_id = fipe_code.id AND '
+                   'v.build_year = k.build_year AND '
+                   'v.fuel_type = k.fuel_type AND '
+                   'v.valid_from <= k.table_id AND v.valid_to >= k.table_id')
+        else:
+            sql = ('WITH k (fipe_code, build_year, fuel_type, table_id) AS '
+                   '(VALUES {}) SELECT k.fipe_code, k.build_year, '
+                   'k.fuel_type, k.table_id, price.price FROM k JOIN price '
+                   'INDEXED BY price_fipe_code USING (fipe_code, build_year, '
+                   'fuel_type, table_id)')
+        found = {}
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            self.cursor.execute(
+                sql.format(', '.join(['(?, ?, ?, ?)'] * len(chunk))),
+                [value for key in chunk for value in key])
+            for row in self.cursor:
+                found[row[:4]] = self._reais(row[4])
+        for key in missing:
+            self.lookups.set(key, found.get(key))
+        return [found.get(key) if price is self else price
+                for key, price in zip(keys, prices)]
+
+    def get_price_history(self, fipe_code, build_year=None, fuel_type=None):
+        """Returns monthly price history of vehicle.
+
+        Parameters
+        ----------
+        fipe_code : string
+            Fipe code of vehicle.
+        build_year, fuel_type : integer, optional
+            Built year and fuel type. If `None`, histories of all built
+            years or fuel types are returned.
+
+        Returns
+        -------
+        lst : list
+            List of `(table_id, year, month, build_year, fuel_type,
+            price)` tuples ordered by built year, fuel type and table.
+
+        """
+        if self.storage == 'changes':
+            sql = ('SELECT reference_table.id, reference_table.year, '
+                   'reference_table.month, price.build_year, '
+                   'price.fuel_type, price.price FROM fipe_code '
+                   'JOIN price_version AS price INDEXED BY '
+                   'price_version_fipe_code ON '
+                   'price.fipe_code_id = fipe_code.id '
+                   'JOIN reference_table ON '
+                   'reference_table.id >= price.valid_from AND '
+                   'reference_table.id <= price.valid_to '
+                   'WHERE fipe_code.code = ?')
+        else:
+            sql = ('SELECT price.table_id, reference_table.year, '
+                   'reference_table.month, price.build_year, '
+                   'price.fuel_type, price.price FROM price INDEXED BY '
+                   'price_fipe_code JOIN reference_table ON '
+                   'reference_table.id = price.table_id '
+                   'WHERE price.fipe_code = ?')
+        params = [fipe_code]
+        if build_year is not None:
+            sql += ' AND price.build_year = ?'
+            params.append(build_year)
+        if fuel_type is not None:
+            sql += ' AND price.fuel_type = ?'
+            params.append(fuel_type)
+        sql += (' ORDER BY price.build_year, price.fuel_type, '
+                'reference_table.id')
+        self.cursor.execute(sql, params)
+        return [row[:5] + (self._reais(row[5]),) for row in self.cursor]
+
+    def get_price_index(self, vehicle_type=1, maker_id=None):
+        """Returns monthly price index of a maker or of all makers.
+
+        Month-over-month changes are ratios of summed prices of vehicles
+        priced in both a reference table and the previous one. They are
+        read from aggregates, see `rebuild_aggregates`, without scanning
+        prices, and chained into an index.
+
+        Parameters
+        ----------
+        vehicle_type : integer, optional
+            Vehicle type.
+        maker_id : integer, optional
+            Maker id. If `None`, prices of all makers are combined.
+
+        Returns
+        -------
+        lst : list
+            List of `(table_id, year, month, models, change, index)`
+            tuples ordered by table, where `models` is the number of
+            matched prices and `index` is relative to the reference table
+            preceding the first one listed.
+
+        """
+        sql = ('SELECT c.table_id, reference_table.year, '
+               'reference_table.month, SUM(c.models), SUM(c.price), '
+               'SUM(c.previous_price) FROM maker_price_change AS c '
+               'LEFT JOIN reference_table ON reference_table.id = c.table_id '
+               'WHERE c.vehicle_type = ?')
+        params = [vehicle_type]
+        if maker_id is not None:
+            sql += ' AND c.maker_id = ?'
+            params.append(maker_id)
+        sql += (' GROUP BY c.table_id HAVING SUM(c.models) > 0 AND '
+                'SUM(c.previous_price) > 0 ORDER BY c.table_id')
+        self.cursor.execute(sql, params)
+        lst, index = [], 1.
+        for table_id, year, month, models, price, previous in self.cursor:
+            change = price / previous
+            index *= change
+            lst.append((table_id, year, month, models, change, index))
+        return lst
+
+    def get_depreciation(self, vehicle_type=1, maker_id=None, table_id=None):
+        """Returns depreciation curve of a maker or of all makers.
+
+        The value retained over a year of age is the ratio of summed
+        prices of vehicles of a built year to summed prices of the same
+        models and fuel types built one year later, in the same reference
+        table. Retentions are read from aggregates, see
+        `rebuild_aggregates`, and accumulated by age, the year of the table
+        minus built year.
+
+        Parameters
+        ----------
+        vehicle_type : integer, optional
+            Vehicle type.
+        maker_id : integer, optional
+            Maker id. If `None`, prices of all makers are combined.
+        table_id : integer, optional
+            Reference table id. Defaults to the latest one of known year.
+
+        Returns
+        -------
+        lst : list
+            List of `(age, models, retention, value)` tuples ordered by
+            age, where `models` is the number of matched prices and `value`
+            is the cumulative retention, relative to vehicles one year
+            younger than the first age listed.
+
+        """
+        if table_id is None:
+            self.cursor.execute(
+                'SELECT MAX(d.table_id) FROM maker_depreciation AS d '
+                'JOIN reference_table ON reference_table.id = d.table_id '
+                'WHERE d.vehicle_type = ? AND d.models > 0 AND '
+                'reference_table.year IS NOT NULL', (vehicle_type,))
+            table_id = self.cursor.fetchone()[0]
+        sql = ('SELECT reference_table.year - d.build_year, SUM(d.models), '
+               'SUM(d.price), SUM(d.newer_price) FROM maker_depreciation '
+               'AS d LEFT JOIN reference_table ON '
+               'reference_table.id = d.table_id WHERE d.vehicle_type = ? '
+               'AND d.table_id = ?')
+        params = [vehicle_type, table_id]
+        if maker_id is not None:
+            sql += ' AND d.maker_id = ?'
+            params.append(maker_id)
+        sql += (' GROUP BY d.build_year HAVING SUM(d.models) > 0 AND '
+                'SUM(d.newer_price) > 0 ORDER BY d.build_year DESC')
+        self.cursor.execute(sql, params)
+        lst, value = [], 1.
+        for age, models, price, newer in self.cursor:
+            retention = price / newer
+            value *= retention
+            lst.append((age, models, retention, value))
+        return lst
+
+    def create_search_index(self):
+        """Builds the model-name search index from stored prices.
+
+        Every vehicle type, model and Fipe code becomes a search entry,
+        indexed by full-text search on its normalized model and maker
+        names. A previous index is replaced.
+
+        Returns
+        -------
+        n : integer
+            Number of search entries.
+
+        """
+        self._execute_script_from_file('{}/schemas/{}'.format(
+            self.module_dir, 'fipe_db_search.sql'))
+        if self.storage == 'changes':
+            source = ('SELECT v.vehicle_type, v.model_id, fipe_code.code '
+                      'AS fipe_code, v.build_year FROM price_version AS v '
+                      'LEFT JOIN fipe_code ON fipe_code.id = v.fipe_code_id')
+        else:
+            source = ('SELECT vehicle_type, model_id, fipe_code, build_year '
+                      'FROM price')
+        rows = self.conn.execute(
+            'SELECT price.vehicle_type, model.maker_id, price.model_id, '
+            'price.fipe_code, MIN(NULLIF(price.build_year, 32000)), '
+            'MAX(NULLIF(price.build_year, 32000)), model.name, maker.name '
+            'FROM ({}) AS price JOIN model ON '
+            'model.vehicle_type = price.vehicle_type AND '
+            'model.id = price.model_id JOIN maker ON '
+            'maker.vehicle_type = model.vehicle_type AND '
+            'maker.id = model.maker_id GROUP BY price.vehicle_type, '
+            'price.model_id, price.fipe_code'.format(source))
+        entries, documents, vocabulary = [], [], Counter()
+        for i, row in enumerate(rows, 1):
+            model = _search_tokens(row[6] or '')
+            maker = _search_tokens(row[7] or '')
+            entries.append((i,) + tuple(row) + (' '.join(model),))
+            documents.append((i, ' '.join(model), ' '.join(maker)))
+            vocabulary.update(set(model + maker))
+        self.cursor.execute('DELETE FROM search_entry')
+        self.cursor.execute('DELETE FROM search_fts')
+        self.cursor.execute('DELETE FROM search_token')
+        self.cursor.execute('DELETE FROM search_trigram')
+        self.cursor.executemany(
+            'INSERT INTO search_entry (id, vehicle_type, maker_id, model_id, '
+            'fipe_code, first_year, last_year, model, maker, tokens) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', entries)
+        self.cursor.executemany(
+            'INSERT INTO search_fts (rowid, model, maker) VALUES (?, ?, ?)',
+            documents)
+        self.cursor.executemany(
+            'INSERT INTO search_token (token, entries) VALUES (?, ?)',
+            vocabulary.items())
+        self.cursor.executemany(
+            'INSERT INTO search_trigram (trigram, token) VALUES (?, ?)',
+            [(trigram, token) for token in vocabulary
+             for trigram in _trigrams(token)])
+        # Ranks maker tokens half as much as model tokens.
+        self.cursor.execute(
+            'INSERT INTO search_fts (search_fts, rank) VALUES '
+            '(\'rank\', \'bm25(1.0, 0.5)\')')
+        self.cursor.execute(
+            'INSERT INTO search_fts (search_fts) VALUES (\'optimize\')')
+        self.conn.commit()
+        self._vocabulary = dict(vocabulary)
+        self._search_size = len(entries)
+        self._corrections.clear()
+        return len(entries)
+
+    def match_models(self, titles, makers=None, years=None, limit=3):
+        """Matches free-text titles, e.g. of used car listings, to models.
+
+        Titles are split into normalized tokens and tokens unknown to the
+        search index are corrected to the most similar known token, by
+        shared trigrams. Candidate entries are found by full-text search
+        on the tokens, leaving out tokens common to many entries, and are
+        ranked by the share of their model name tokens found in the title,
+        then by the number of these tokens and by BM25 rank. Use
+        `create_search_index` first.
+
+        Parameters
+        ----------
+        titles : iterable
+            Titles to match.
+        makers : iterable, optional
+            Maker hint of every title, either a maker id, a maker name or
+            `None`.
+        years : iterable, optional
+            Built year hint of every title or `None`.
+        limit : integer, optional
+            Maximum number of candidates per title.
+
+        Returns
+        -------
+        lst : list
+            List of `ModelMatch` lists, best candidates first, in the order
+            of `titles`.
+
+        """
+        titles = list(titles)
+        makers = [None] * len(titles) if makers is None else list(makers)
+        years = [None] * len(titles) if years is None else list(years)
+        if self._vocabulary is None:
+            self._vocabulary = dict(self.conn.execute(
+                'SELECT token, entries FROM search_token'))
+            self._search_size = self.conn.execute(
+                'SELECT COUNT(*) FROM search_entry').fetchone()[0]
+        cursor = self.conn.cursor()
+        try:
+            return [self._match_model(cursor, title, maker, year, limit)
+                    for title, maker, year in zip(titles, makers, years)]
+        finally:
+            cursor.close()
+
+    def _match_model(self, cursor, title, maker=None, year=None, limit=3):
+        """Returns ranked candidate models of title."""
+        tokens = self._known_tokens(_search_tokens(title))
+        if not tokens:
+            return []
+        # Tokens of more than 5% of entries, such as "1.0" or "flex",
+        # hardly single out candidates.
+        common = max(100, self._search_size // 20)
+        rare = [token for token in tokens
+                if self._vocabulary[token] <= common] or \
+            [min(tokens, key=self._vocabulary.get)]
+        query = ' OR '.join('"{}"'.format(token) for token in rare)
+        sql = ('SELECT e.fipe_code, e.vehicle_type, e.maker_id, e.maker, '
+               'e.model_id, e.model, e.first_year, e.last_year, e.tokens '
+               'FROM search_fts JOIN search_entry AS e ON '
+               'e.id = search_fts.rowid WHERE search_fts MATCH ?')
+        params = []
+        if isinstance(maker, int):
+            sql += ' AND e.maker_id = ?'
+            params.append(maker)
+        elif maker:
+            hint = self._known_tokens(_search_tokens(maker))
+            if hint:
+                query = '({}) AND maker : ({})'.format(query, ' OR '.join(
+                    '"{}"'.format(token) for token in hint))
+        if year is not None:
+            sql += (' AND (e.first_year IS NULL OR '
+                    '? BETWEEN e.first_year AND e.last_year)')
+            params.append(year)
+        sql += ' ORDER BY rank LIMIT ?'
+        cursor.execute(sql, [query] + params + [max(100, 10 * limit)])
+        title_tokens = set(tokens)
+        ranked = []
+        for rank, row in enumerate(cursor.fetchall()):
+            model = row[8].split()
+            found = len(title_tokens.intersection(model))
+            if found:
+                ranked.append((-found / len(model), -found, rank, row))
+        ranked.sort()
+        matches, seen = [], set()
+        for score, _, _, row in ranked:
+            if row[0] in seen:
+                continue
+            seen.add(row[0])
+            matches.append(ModelMatch(*row[:8], round(-score, 4)))
+            if len(matches) >= limit:
+                break
+        return matches
+
+    def _known_tokens(self, tokens):
+        """Returns tokens known to the index, correcting misspelled ones."""
+        known = []
+        for token in tokens:
+            if token not in self._vocabulary:
+                token = self._correct_token(token)
+            if token is not None and token not in known:
+                known.append(token)
+        return known
+
+    def _correct_token(self, token):
+        """Returns the known token most similar to `token`, if any."""
+        if len(token) < 4 or not token.isalpha():
+            return None
+        correction = self._corrections.get(token, self)
+        if correction is not self:
+            return correction
+        trigrams = _trigrams(token)
+        rows = self.conn.execute(
+            'SELECT token FROM search_trigram WHERE trigram IN ({}) '
+            'GROUP BY token ORDER BY COUNT(*) DESC LIMIT 10'.format(
+                ', '.join(['?'] * len(trigrams))), list(trigrams))
+        correction, best = None, 0.5
+        for candidate, in rows:
+            other = _trigrams(candidate)
+            similarity = len(trigrams & other) / len(trigrams | other)
+            if similarity >= best:
+                correction, best = candidate, similarity
+        self._corrections.set(token, correction)
+        return correction
+
+    def iter_records(self, table_id=None, vehicle_type=None):
+        """Yields stored prices as flat price records.
+
+        Parameters
+        ----------
+        table_id, vehicle_type : integer, optional
+            Reference table and vehicle type to select. If `None`, all
+            are selected.
+
+        Yields
+        ------
+        record : PriceRecord
+            Flat price record.
+
+        """
+        for rows in self._iter_rows(table_id, vehicle_type):
+            for row in rows:
+                yield PriceRecord(*row[:8], self._reais(row[8]), row[9])
+
+    def to_dataframe(self, table_id=None, vehicle_type=None,
+                     chunk_size=None):
+        """Returns stored prices as typed pandas.DataFrame.
+
+        Rows are read in chunks straight from the database, without
+        building price records.
+
+        Parameters
+        ----------
+        table_id, vehicle_type : integer, optional
+            Reference table and vehicle type to select. If `None`, all
+            are selected.
+        chunk_size : integer, optional
+            If given, returns an iterator of data frames with at most
+            `chunk_size` rows instead.
+
+        Returns
+        -------
+        df : pandas.DataFrame
+            Data frame with columns `table` (int16), `vehicle_type`
+            (int8), `maker_id` (int32), `maker` (category), `model_id`
+            (int32), `model` (category), `build_year` (int16),
+            `fuel_type` (int8), `price` (Int64, in cents, `pandas.NA` if
+            missing) and `fipe_code` (category), see `price_dtypes`.
+
+        """
+        frames = (_price_frame(rows) for rows in self._iter_rows(
+            table_id, vehicle_type, chunk_size or 100000))
+        if chunk_size is not None:
+            return frames
+        return _concat_frames(frames)
+
+    def _iter_rows(self, table_id=None, vehicle_type=None, size=10000):
+        """Yields lists of stored price rows with prices in cents."""
+        sql = ('SELECT price.table_id, price.vehicle_type, maker.id, '
+               'maker.name, model.id, model.name, price.build_year, '
+               'price.fuel_type, price.price, price.fipe_code '
+               'FROM {} AS price JOIN model ON '
+               'model.vehicle_type = price.vehicle_type AND '
+               'model.id = price.model_id JOIN maker ON '
+               'maker.vehicle_type = model.vehicle_type AND '
+               'maker.id = model.maker_id').format(
+                   'price_snapshot' if self.storage == 'changes' else 'price')
+        where, params = [], []
+        if table_id is not None:
+            where.append('price.table_id = ?')
+            params.append(table_id)
+        if vehicle_type is not None:
+            where.append('price.vehicle_type = ?')
+            params.append(vehicle_type)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += (' ORDER BY price.table_id, price.vehicle_type, '
+                'price.model_id, price.build_year, price.fuel_type')
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    def _write_batch(self, tables, makers, models, prices, units=()):
+        """Writes a batch of ingested rows in a single transaction.
+
+        Aggregates and price versions are read and written back in the
+        batch's immediate transaction, so concurrent writers do not lose
+        each other's changes.
+
+        """
+        if not self.conn.in_transaction:
+            self.cursor.execute('BEGIN IMMEDIATE')
+        # Checked in the transaction, aggregates may be created by others.
+        aggregates = bool(prices) and self._has_aggregates()
+        if aggregates:
+            # Removes pairs of the batch's keys before prices change.
+            self._stage_keys(prices)
+            self._add_aggregates(-1)
+        self.cursor.executemany(
+            'INSERT OR IGNORE INTO reference_table (id) VALUES (?)', tables)
+        self.cursor.executemany(
+            'INSERT INTO maker (vehicle_type, id, name) VALUES (?, ?, ?) '
+            'ON CONFLICT (vehicle_type, id) DO UPDATE SET '
+            'name = excluded.name', makers)
+        self.cursor.executemany(
+            'INSERT INTO model (vehicle_type, id, maker_id, name) '
+            'VALUES (?, ?, ?, ?) ON CONFLICT (vehicle_type, id) DO UPDATE '
+            'SET maker_id = excluded.maker_id, name = excluded.name', models)
+        if self.storage == 'changes':
+            self._write_versions(prices)
+        else:
+            self.cursor.executemany(
+                'INSERT OR REPLACE INTO price (table_id, vehicle_type, '
+                'model_id, build_year, fuel_type, price, fipe_code) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', prices)
+        if aggregates:
+            self._add_aggregates(1)
+        self._set_units_done(units)
+        self.conn.commit()
+        self.lookups.clear()
+        if self.stats is not None:
+            self.stats.on_stage('ingest', len(prices))
+        return len(prices)
+
+    def _has_aggregates(self):
+        """Returns whether the database has price aggregates."""
+        self.cursor.execute(
+            'SELECT COUNT(*) FROM sqlite_master WHERE type = \'table\' '
+            'AND name = \'maker_price_change\'')
+        return bool(self.cursor.fetchone()[0])
+
+    def _set_units_done(self, units):
+        """Marks crawl units not done yet as done."""
+        crawled = set()
+        for key in set(unit[:2] for unit in units):
+            # Most ingests are not part of a checkpointed crawl.
+            self.cursor.execute(
+                'SELECT EXISTS (SELECT 1 FROM crawl_unit WHERE table_id = ? '
+                'AND vehicle_type = ? AND status IN (\'pending\', '
+                '\'failed\'))', key)
+            if self.cursor.fetchone()[0]:
+                crawled.add(key)
+        self.cursor.executemany(
+            'UPDATE crawl_unit SET status = \'done\', error = NULL, '
+            'attempts = attempts + 1, updated_at = julianday(\'now\') '
+            'WHERE table_id = ? AND vehicle_type = ? AND maker_id = ? '
+            'AND model_id = ? AND build_year = ? AND fuel_type = ? '
+            'AND status != \'done\'',
+            [unit for unit in units if unit[:2] in crawled])
+
+    def _write_versions(self, prices):
+        """Merges price rows into versions next to their tables."""
+        if not prices:
+            return
+        codes = self._fipe_code_ids(row[6] for row in prices)
+        staged = OrderedDict()
+        for table_id, *key, price, fipe_code in prices:
+            staged.setdefault(tuple(key), []).append((table_id, (
+                price, None if fipe_code is None else codes[fipe_code])))
+        first = min(row[0] for row in prices) - 1
+        last = max(row[0] for row in prices) + 1
+        versions = {key: [] for key in staged}
+        keys = list(staged)
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            self.cursor.execute(
+                'WITH k (vehicle_type, model_id, build_year, fuel_type) AS '
+                '(VALUES {}) SELECT k.vehicle_type, k.model_id, '
+                'k.build_year, k.fuel_type, v.valid_from, v.valid_to, '
+                'v.price, v.fipe_code_id FROM k JOIN price_version AS v '
+                'USING (vehicle_type, model_id, build_year, fuel_type) '
+                'WHERE v.valid_to >= ? AND v.valid_from <= ?'.format(
+                    ', '.join(['(?, ?, ?, ?)'] * len(chunk))),
+                [value for key in chunk for value in key] + [first, last])
+            for row in self.cursor:
+                versions[row[:4]].append(row[4:])
+        deleted, inserted = [], []
+        for key, rows in staged.items():
+            original = set(versions[key])
+            ranges = versions[key]
+            for table_id, value in rows:
+                self._merge_version(ranges, table_id, value)
+            ranges = set(ranges)
+            deleted.extend(key + (version[0],)
+                           for version in original - ranges)
+            inserted.extend(key + version for version in ranges - original)
+        self.cursor.executemany(
+            'DELETE FROM price_version WHERE vehicle_type = ? AND '
+            'model_id = ? AND build_year = ? AND fuel_type = ? AND '
+            'valid_from = ?', deleted)
+        self.cursor.executemany(
+            'INSERT INTO price_version (vehicle_type, model_id, build_year, '
+            'fuel_type, valid_from, valid_to, price, fipe_code_id) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', inserted)
+
+    def _stage_keys(self, prices=None):
+        """Stages keys of price rows, or of all stored prices if `None`."""
+        self.cursor.execute(
+            'CREATE TEMP TABLE IF NOT EXISTS aggregate_key ('
+            'table_id INTEGER, vehicle_type INTEGER, model_id INTEGER, '
+            'build_year INTEGER, fuel_type INTEGER, PRIMARY KEY (table_id, '
+            'vehicle_type, model_id, build_year, fuel_type)) WITHOUT ROWID')
+        self.cursor.execute('DELETE FROM temp.aggregate_key')
+        sql = ('INSERT OR IGNORE INTO temp.aggregate_key (table_id, '
+               'vehicle_type, model_id, build_year, fuel_type) ')
+        if prices is not None:
+            self.cursor.executemany(sql + 'VALUES (?, ?, ?, ?, ?)',
+                                    (row[:5] for row in prices))
+        else:
+            self.cursor.execute(
+                sql + 'SELECT table_id, vehicle_type, model_id, build_year, '
+                'fuel_type FROM {}'.format('price_snapshot' if
+                                           self.storage == 'changes'
+                                           else 'price'))
+
+    def _add_aggregates(self, sign):
+        """Adds (`sign` 1) or removes (-1) price pairs of staged keys.
+
+        Pairs are those of a staged price with the price of the same key in
+        the previous or next reference table, and with the price of the
+        previous or next built year in the same reference table.
+
+        """
+        keys = ('SELECT table_id{}, vehicle_type, model_id, build_year{}, '
+                'fuel_type FROM temp.aggregate_key')
+        model = ('JOIN model ON model.vehicle_type = pair.vehicle_type AND '
+                 'model.id = pair.model_id')
+        self.cursor.execute(
+            'INSERT INTO maker_price_change (vehicle_type, maker_id, '
+            'table_id, models, price, previous_price) SELECT '
+            'pair.vehicle_type, model.maker_id, pair.table_id, ? * COUNT(*), '
+            '? * SUM(a.price), ? * SUM(b.price) FROM ({} UNION {}) AS pair '
+            '{} {} {} WHERE a.price IS NOT NULL AND b.price IS NOT NULL '
+            'GROUP BY pair.vehicle_type, model.maker_id, pair.table_id '
+            'ON CONFLICT (vehicle_type, maker_id, table_id) DO UPDATE SET '
+            'models = models + excluded.models, price = price + '
+            'excluded.price, previous_price = previous_price + '
+            'excluded.previous_price'.format(
+                keys.format('', ''), keys.format(' + 1', ''),
+                self._price_join('a', 'pair.table_id'),
+                self._price_join('b', 'pair.table_id - 1'), model),
+            (sign,) * 3)
+        self.cursor.execute(
+            'INSERT INTO maker_depreciation (vehicle_type, maker_id, '
+            'table_id, build_year, models, price, newer_price) SELECT '
+            'pair.vehicle_type, model.maker_id, pair.table_id, '
+            'pair.build_year, ? * COUNT(*), ? * SUM(a.price), '
+            '? * SUM(b.price) FROM ({} UNION {}) AS pair {} {} {} '
+            'WHERE a.price IS NOT NULL AND b.price IS NOT NULL '
+            'GROUP BY pair.vehicle_type, model.maker_id, pair.table_id, '
+            'pair.build_year ON CONFLICT (vehicle_type, maker_id, table_id, '
+            'build_year) DO UPDATE SET models = models + excluded.models, '
+            'price = price + excluded.price, '
+            'newer_price = newer_price + excluded.newer_price'.format(
+                keys.format('', ''), keys.format('', ' - 1'),
+                self._price_join('a', 'pair.table_id'),
+                self._price_join('b', 'pair.table_id',
+                                 'pair.build_year + 1'), model),
+            (sign,) * 3)
+
+    def _price_join(self, alias, table_id, build_year='pair.build_year'):
+        """Returns join of prices of a pair's key in a reference table."""
+        if self.storage == 'changes':
+            sql = ('JOIN price_version AS {0} ON {0}.valid_from <= {1} AND '
+                   '{0}.valid_to >= {1}')
+        else:
+            sql = 'JOIN price AS {0} ON {0}.table_id = {1}'
+        return (sql + ' AND {0}.vehicle_type = pair.vehicle_type AND '
+                '{0}.model_id = pair.model_id AND {0}.build_year = {2} AND '
+                '{0}.fuel_type = pair.fuel_type').format(
+                    alias, table_id, build_year)
+
+    @staticmethod
+    def _merge_version(ranges, table_id, value):
+        """Sets `(price, fipe_code_id)` value of key in reference table.
+
+        `ranges` is the list of `(valid_from, valid_to, price,
+        fipe_code_id)` versions of a key around `table_id`, updated in
+        place.
+
+        """
+        for version in ranges:
+            if version[0] <= table_id <= version[1]:
+                if version[2:] == value:
+                    return
+                # Splits the version around the changed table.
+                ranges.remove(version)
+                if version[0] < table_id:
+                    ranges.append((version[0], table_id - 1) + version[2:])
+                if version[1] > table_id:
+                    ranges.append((table_id + 1, version[1]) + version[2:])
+                break
+        start = end = table_id
+        for version in list(ranges):
+            if version[2:] != value:
+                continue
+            if version[1] == table_id - 1:
+                start = version[0]
+                ranges.remove(version)
+            elif version[0] == table_id + 1:
+                end = version[1]
+                ranges.remove(version)
+        ranges.append((start, end) + value)
+
+    def _fipe_code_ids(self, fipe_codes):
+        """Returns ids of Fipe codes, adding new ones."""
+        for fipe_code in set(fipe_codes) - set(self._fipe_codes):
+            if fipe_code is None:
+                continue
+            self.cursor.execute(
+                'INSERT OR IGNORE INTO fipe_code (code) VALUES (?)',
+                (fipe_code,))
+            self.cursor.execute('SELECT id FROM fipe_code WHERE code = ?',
+                                (fipe_code,))
+            self._fipe_codes[fipe_code] = self.cursor.fetchone()[0]
+        return self._fipe_codes
+
+    @staticmethod
+    def _cents(price):
+        """Converts price to integer cents."""
+        return None if price is None else int(round(price * 100))
+
+    @staticmethod
+    def _reais(cents):
+        """Converts integer cents to price."""
+        return None if cents is None else cents / 100
+
+    def _execute_script_from_file(self, url):
+        """Executes SQL script in file given by `url`."""
+        with open(url, 'r') as f:
+            self.cursor.executescript(''.join(f.readlines()))
+            self.conn.commit()
+
+
+# Column types of price data frames, prices are given in integer cents.
+price_dtypes = OrderedDict([
+    ('table', 'int16'), ('vehicle_type', 'int8'), ('maker_id', 'int32'),
+    ('maker', 'category'), ('model_id', 'int32'), ('model', 'category'),
+    ('build_year', 'int16'), ('fuel_type', 'int8'), ('price', 'Int64'),
+    ('fipe_code', 'category')])
+
+
+def to_dataframe(records, chunk_size=None):
+    """Converts price records into a typed pandas.DataFrame.
+
+    Makers, models and Fipe codes are categorical, ids and years are
+    small integers and prices are given in integer cents, with missing
+    prices as `pandas.NA`.
+
+    Parameters
+    ----------
+    records : iterable
+        Price records, e.g. as yielded by `Fipe.iter_table` or
+        `Fipe_db.iter_records`.
+    chunk_size : integer, optional
+        If given, returns an iterator of data frames with at most
+        `chunk_size` rows instead, converting records as they come.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        Data frame with columns as in `price_dtypes`.
+
+    """
+    def rows(records):
+        for record in records:
+            yield record[:8] + (Fipe_db._cents(record.price),
+                                record.fipe_code)
+
+    frames = (_price_frame(chunk) for chunk in _chunks(rows(records),
+                                                       chunk_size or 100000))
+    if chunk_size is not None:
+        return frames
+    return _concat_frames(frames)
+
+
+def write_parquet(records, path, chunk_size=100000, compression='zstd'):
+    """Streams price records into a Parquet file.
+
+    Records are converted and written one row group of `chunk_size`
+    records at a time, so the whole table is never held in memory.
+    Requires `pyarrow`.
+
+    Parameters
+    ----------
+    records : iterable
+        Price records.
+    path : string
+        Path of the Parquet file.
+    chunk_size : integer, optional
+        Number of records per row group.
+    compression : string, optional
+        Parquet compression codec.
+
+    Returns
+    -------
+    n : integer
+        Number of written records.
+
+    """
+    import pyarrow.parquet as pq
+    schema = _arrow_schema()
+    n = 0
+    with pq.ParquetWriter(path, schema, compression=compression) as writer:
+        for frame in to_dataframe(records, chunk_size):
+            writer.write_table(_arrow_table(frame, schema))
+            n += len(frame)
+    return n
+
+
+def write_arrow(records, path, chunk_size=100000):
+    """Streams price records into an Arrow IPC file.
+
+    Records are converted and written one record batch of `chunk_size`
+    records at a time. Requires `pyarrow`.
+
+    Parameters
+    ----------
+    records : iterable
+        Price records.
+    path : string
+        Path of the Arrow IPC file.
+    chunk_size : integer, optional
+        Number of records per record batch.
+
+    Returns
+    -------
+    n : integer
+        Number of written records.
+
+    """
+    import pyarrow as pa
+    schema = _arrow_schema()
+    n = 0
+    with pa.OSFile(path, 'wb') as sink, \
+            pa.ipc.new_file(sink, schema) as writer:
+        for frame in to_dataframe(records, chunk_size):
+            writer.write_table(_arrow_table(frame, schema))
+            n += len(frame)
+    return n
+
+
+class RecordSink(ABC):
+    """Buffered sink of price records.
+
+    Records are buffered and written in batches of at most `buffer_size`
+    records, so memory use stays bounded however long the crawl.
+
+    Parameters
+    ----------
+    buffer_size : integer, optional
+        Maximum number of buffered records.
+
+    """
+
+    def __init__(self, buffer_size=10000):
+        self.buffer_size = buffer_size
+        self.count = 0
+        self._buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add_tables(self, tables):
+        """Announces reference tables before their records."""
+
+    def write(self, record):
+        """Buffers record, writing the buffer once full."""
+        self._buffer.append(record)
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Writes buffered records."""
+        if self._buffer:
+            self._write(self._buffer)
+            self.count += len(self._buffer)
+            self._buffer = []
+
+    def close(self):
+        """Writes buffered records and releases the sink."""
+        self.flush()
+
+    @abstractmethod
+    def _write(self, records):
+        """Writes a batch of records."""
+
+
+# Message of the database writer thread, either calling a `Fipe_db` method
+# or committing queued records and setting event `done`, see `DbWriter`.
+_WriterControl = namedtuple('_WriterControl', ['method', 'args', 'done'])
+
+
+class DbWriter(RecordSink):
+    """Background writer ingesting price records into a `Fipe_db`.
+
+    The database is opened by a writer thread, the only one writing to
+    it. Records are passed through a bounded queue and committed in
+    transactions of up to `batch_size` records, or of the records received
+    within `max_delay` seconds, whichever comes first. When the queue is
+    full, `write` blocks, slowing crawlers down to the pace of the disk.
+    Errors of the writer thread are raised by the next call of `write`,
+    `flush` or `close`. Once closed, writing or flushing raises
+    `ValueError`.
+
+    The writer is also a checkpoint of resumable crawls, see
+    `Fipe.iter_table`. Crawl units are then recorded by the writer thread
+    too, and read through a read-only connection.
+
+    Parameters
+    ----------
+    db : string, optional
+        Path of the SQLite database, see `Fipe_db`.
+    batch_size : integer, optional
+        Maximum number of records committed at once.
+    max_delay : float, optional
+        Maximum seconds a record waits to be committed.
+    queue_size : integer, optional
+        Maximum number of queued records. Defaults to twice `batch_size`,
+        so that a batch is filled while another one is committed.
+    stats : CrawlStats, optional
+        Statistics registry notified of ingested rows and of writes
+        blocked by a full queue.
+    **kwargs
+        Further `Fipe_db` arguments, e.g. `storage`.
+
+    Examples
+    --------
+    >> with DbWriter(os.path.realpath('../dat/dataset.db')) as writer:
+    ..     writer.add_tables(tables)
+    ..     for record in Fipe().iter_table(tables[0]):
+    ..         writer.write(record)
+
+    """
+    _stop = object()
+
+    def __init__(self, db=':memory:', batch_size=10000, max_delay=1.,
+                 queue_size=None, stats=None, **kwargs):
+        super().__init__(batch_size)
+        self.path = db
+        self.max_delay = max_delay
+        self.stats = stats
+        self.error = None
+        self.closed = False
+        self._queue = queue.Queue(queue_size or 2 * batch_size)
+        # Read-only connection of checkpoints, opened on first use.
+        self._reader = None
+        ready = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(db, dict(kwargs, stats=stats), ready),
+            name='fipe-writer', daemon=True)
+        self._thread.start()
+        # The schema exists once the writer is ready.
+        ready.wait()
+        self._raise()
+
+    def add_tables(self, tables):
+        self._put(_WriterControl('add_tables', (list(tables),), None))
+
+    def get_crawl_units(self, table_id, vehicle_type, maker_id, model_id):
+        """Returns committed work units of car model, see `Fipe_db`."""
+        self._check()
+        if self._reader is None:
+            self._reader = Fipe_db(self.path, read_only=True)
+        return self._reader.get_crawl_units(table_id, vehicle_type,
+                                            maker_id, model_id)
+
+    def add_crawl_units(self, units):
+        """Queues work units to be recorded, see `Fipe_db`."""
+        self._put(_WriterControl('add_crawl_units', (list(units),), None))
+
+    def set_crawl_status(self, units):
+        """Queues status updates of work units, see `Fipe_db`."""
+        self._put(_WriterControl('set_crawl_status', (list(units),), None))
+
+    def write(self, record):
+        """Queues record, blocking while the queue is full."""
+        self._put(record)
+
+    def flush(self):
+        """Waits until all queued records are committed."""
+        self._check()
+        done = threading.Event()
+        self._put(_WriterControl(None, (), done))
+        done.wait()
+        self._raise()
+
+    def close(self):
+        """Commits queued records and stops the writer."""
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.put(self._stop)
+        self._thread.join()
+        self._thread = None
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        self._raise()
+
+    def _write(self, records):
+        for record in records:
+            self.write(record)
+
+    def _put(self, item):
+        self._check()
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            if self.stats is not None:
+                self.stats.on_stage('writer_blocked')
+            self._queue.put(item)
+
+    def _raise(self):
+        if self.error is not None:
+            raise FipeDbError('Database writer failed.') from self.error
+
+    def _check(self):
+        """Raises if the writer is closed or failed."""
+        if self.closed:
+            raise ValueError('DbWriter is closed')
+        self._raise()
+
+    def _run(self, path, kwargs, ready):
+        """Commits queued records until stopped."""
+        try:
+            db = Fipe_db(path, **kwargs)
+            db.create_schema()
+        except Exception as e:
+            self.error = e
+            ready.set()
+            return
+        ready.set()
+        batch = []
+        deadline = None
+        item = None
+        try:
+            while item is not self._stop:
+                timeout = None
+                if batch:
+                    timeout = max(0., deadline - monotonic())
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    # Commits the batch once its delay is over.
+                    item = _WriterControl(None, (), None)
+                if isinstance(item, _WriterControl) and item.method:
+                    # Units and tables precede their records, so batched
+                    # records are left pending.
+                    self._apply(getattr(db, item.method), *item.args)
+                    continue
+                if not (item is self._stop or
+                        isinstance(item, _WriterControl)):
+                    if not batch:
+                        deadline = monotonic() + self.max_delay
+                    batch.append(item)
+                    if len(batch) < self.buffer_size:
+                        continue
+                if batch:
+                    self.count += self._apply(db.ingest, batch,
+                                              len(batch)) or 0
+                batch = []
+                if (isinstance(item, _WriterControl) and
+                        item.done is not None):
+                    item.done.set()
+        except Exception as e:
+            self.error = e
+            logger.exception('Database writer failed.')
+            # Queued items are still consumed, so that producers never
+            # block on a failed writer.
+            while item is not self._stop:
+                if (isinstance(item, _WriterControl) and
+                        item.done is not None):
+                    item.done.set()
+                item = self._queue.get()
+        finally:
+            db.close()
+
+    def _apply(self, func, *args):
+        """Calls database method unless the writer failed before."""
+        if self.error is not None:
+            return None
+        try:
+            return func(*args)
+        except Exception as e:
+            # Queued items are still consumed, so that producers never
+            # block on a failed writer.
+            self.error = e
+            logger.exception('Database writer failed.')
+            return None
+
+
+class _FileSink(RecordSink):
+    """Sink writing price records to a text file, '-' for stdout."""
+
+    def __init__(self, path, buffer_size=10000):
+        super().__init__(buffer_size)
+        if path == '-':
+            self.file = sys.stdout
+        else:
+            self.file = open(path, 'w', newline='', encoding='utf-8')
+
+    def close(self):
+        self.flush()
+        if self.file is not sys.stdout:
+            self.file.close()
+
+    def _write(self, records):
+        self._write_records(records)
+        self.file.flush()
+
+
+class CsvSink(_FileSink):
+    """Sink writing price records as CSV with a header row."""
+
+    def __init__(self, path, buffer_size=10000):
+        super().__init__(path, buffer_size)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(PriceRecord._fields)
+
+    def _write_records(self, records):
+        self.writer.writerows(records)
+
+
+class JsonLinesSink(_FileSink):
+    """Sink writing price records as JSON Lines."""
+
+    def _write_records(self, records):
+        self.file.write(''.join(
+            json.dumps(record._asdict(), ensure_ascii=False) + '\n'
+            for record in records))
+
+
+def open_sink(path, fmt=None, buffer_size=10000, storage=None, stats=None,
+              aggregates=False):
+    """Opens price record sink.
+
+    Parameters
+    ----------
+    path : string
+        Output path, '-' for stdout.
+    fmt : string, optional
+        Either 'sqlite', 'csv' or 'jsonl'. Guessed from the extension of
+        `path` by default, falling back to JSON Lines.
+    buffer_size : integer, optional
+        Maximum number of buffered records.
+    storage : string, optional
+        Storage of new SQLite databases, see `Fipe_db`.
+    stats : CrawlStats, optional
+        Statistics registry of database writes.
+    aggregates : boolean, optional
+        Whether SQLite output maintains price aggregates, see `Fipe_db`.
+
+    Returns
+    -------
+    sink : RecordSink
+        Sink of price records.
+
+    """
+    fmt = _sink_format(path, fmt)
+    if fmt == 'sqlite':
+        if path == '-':
+            raise ValueError('SQLite output requires a path.')
+        return DbWriter(os.path.realpath(path), batch_size=buffer_size,
+                        storage=storage, stats=stats, aggregates=aggregates)
+    if fmt == 'csv':
+        return CsvSink(path, buffer_size)
+    if fmt == 'jsonl':
+        return JsonLinesSink(path, buffer_size)
+    raise ValueError('Invalid format `{}`.'.format(fmt))
+
+
+def _sink_format(path, fmt=None):
+    """Returns output format, guessed from extension of `path`."""
+    if fmt is not None:
+        return fmt
+    ext = os.path.splitext(path)[1].lower()
+    return {'.db': 'sqlite', '.sqlite': 'sqlite', '.sqlite3': 'sqlite',
+            '.csv': 'csv'}.get(ext, 'jsonl')
+
+
+def _chunks(iterable, size):
+    """Yields lists of at most `size` items of `iterable`."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _price_frame(rows):
+    """Returns typed data frame of price rows with prices in cents."""
+    df = pd.DataFrame.from_records(rows, columns=list(price_dtypes))
+    return df.astype(price_dtypes)
+
+
+def _concat_frames(frames):
+    """Concatenates price data frames, unifying categories."""
+    frames = list(frames)
+    if not frames:
+        return _price_frame([])
+    df = pd.concat(frames, ignore_index=True)
+    # Categories of different chunks are unified into plain objects.
+    return df.astype(price_dtypes)
+
+
+def _arrow_schema():
+    """Returns Arrow schema of price data frames."""
+    import pyarrow as pa
+    return pa.schema([
+        ('table', pa.int16()), ('vehicle_type', pa.int8()),
+        ('maker_id', pa.int32()), ('maker', pa.string()),
+        ('model_id', pa.int32()), ('model', pa.string()),
+        ('build_year', pa.int16()), ('fuel_type', pa.int8()),
+        ('price', pa.int64()), ('fipe_code', pa.string())])
+
+
+def _arrow_table(frame, schema):
+    """Converts price data frame into Arrow table of given schema."""
+    import pyarrow as pa
+    return pa.Table.from_pandas(frame, schema=schema, preserve_index=False)
@@ -0,0 +1,664 @@
+"""Fipe HTTP transport policies.
+
+This module implements the policies applied to requests to Fipe's webpage:
+rate limiting, bounded retries, circuit breaking and caching of responses,
+along with the statistics and reports of crawls.
+
+"""
+import hashlib
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import zlib
+
+from bisect import bisect_left
+from collections import Counter
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from math import inf
+from os.path import dirname
+from time import monotonic, sleep, time
+from urllib.parse import urlencode
+
+logger = logging.getLogger(__name__)
+
+
+class FipeRequestError(RuntimeError):
+    """Raised when a Fipe request still fails after all attempts."""
+
+
+class CircuitOpenError(FipeRequestError):
+    """Raised when a request is refused by an open circuit breaker."""
+
+
+class Histogram():
+    """Thread-safe histogram with fixed buckets.
+
+    Parameters
+    ----------
+    buckets : tuple, optional
+        Upper bounds of buckets in increasing order, an infinite bucket
+        is added.
+
+    """
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5,
+                       5., 10., 30.)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.default_buckets) + (inf,)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Adds value to histogram."""
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        """Estimates q-quantile by interpolating within its bucket."""
+        with self._lock:
+            if not self.count:
+                return None
+            rank = q * self.count
+            cumulative = 0
+            for i, n in enumerate(self.counts):
+                if cumulative + n >= rank and n:
+                    lower = self.buckets[i - 1] if i else 0.
+                    upper = self.buckets[i]
+                    if upper == inf:
+                        return lower
+                    return lower + (upper - lower) * (rank - cumulative) / n
+                cumulative += n
+            return self.buckets[-2]
+
+
+class CrawlStats():
+    """In-memory registry of crawl statistics.
+
+    Counts requests, response bytes, errors and retries by endpoint and
+    error type, keeps latency histograms by endpoint and counts items of
+    every crawl stage: 'makers', 'models', 'years', 'prices', 'ingest'
+    (rows written to the database) and 'cache_hits'. Statistics are
+    exported as JSON or in Prometheus text format.
+
+    Parameters
+    ----------
+    log_requests : boolean, optional
+        If `True`, logs every request as a JSON structured message at
+        debug level.
+    buckets : tuple, optional
+        Upper bounds of latency histogram buckets in seconds.
+
+    Examples
+    --------
+    >> stats = CrawlStats()
+    >> fipe = Fipe(stats=stats)
+    >> db = Fipe_db(stats=stats)
+    >> db.ingest(fipe.iter_table(table))
+    >> print(stats.to_prometheus())
+
+    """
+
+    def __init__(self, log_requests=False, buckets=None):
+        self.log_requests = log_requests
+        self.buckets = buckets
+        self.started = time()
+        self.requests = Counter()
+        self.bytes = Counter()
+        self.errors = Counter()
+        self.retries = Counter()
+        self.stages = Counter()
+        self.latency = {}
+        self._lock = threading.Lock()
+
+    def on_request(self, endpoint, latency, nbytes=0, error=None,
+                   retry=False):
+        """Records a request to `endpoint`.
+
+        Parameters
+        ----------
+        endpoint : string
+            Endpoint name.
+        latency : float
+            Seconds until the response was received or failed.
+        nbytes : integer, optional
+            Size of the response body.
+        error : string, optional
+            Error type of failed requests.
+        retry : boolean, optional
+            Whether the failed request is retried.
+
+        """
+        with self._lock:
+            histogram = self.latency.get(endpoint)
+            if histogram is None:
+                histogram = self.latency[endpoint] = Histogram(
+                    self.buckets)
+            self.requests[endpoint] += 1
+            self.bytes[endpoint] += nbytes
+            if error is not None:
+                self.errors[endpoint, error] += 1
+                if retry:
+                    self.retries[error] += 1
+        histogram.observe(latency)
+        if self.log_requests:
+            logger.debug(json.dumps({
+                'event': 'request', 'endpoint': endpoint,
+                'latency': round(latency, 6), 'bytes': nbytes,
+                'error': error, 'retry': retry}))
+
+    def on_stage(self, stage, n=1):
+        """Records `n` items crawled or written by `stage`."""
+        with self._lock:
+            self.stages[stage] += n
+
+    def snapshot(self):
+        """Returns dictionary of current statistics."""
+        elapsed = max(time() - self.started, 1e-9)
+        with self._lock:
+            endpoints = {}
+            for endpoint, histogram in self.latency.items():
+                endpoints[endpoint] = {
+                    'requests': self.requests[endpoint],
+                    'bytes': self.bytes[endpoint],
+                    'errors': {error: n for (e, error), n in
+                               self.errors.items() if e == endpoint},
+                    'latency_mean': histogram.sum / max(histogram.count, 1),
+                    'latency_p50': histogram.quantile(0.5),
+                    'latency_p99': histogram.quantile(0.99)}
+            requests = sum(self.requests.values())
+            return {'elapsed': elapsed, 'requests': requests,
+                    'requests_per_second': requests / elapsed,
+                    'rows_per_second': self.stages['ingest'] / elapsed,
+                    'endpoints': endpoints, 'retries': dict(self.retries),
+                    'stages': dict(self.stages)}
+
+    def to_json(self):
+        """Returns current statistics as JSON string."""
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+    def to_prometheus(self, prefix='fipe'):
+        """Returns current statistics in Prometheus text format."""
+        lines = []
+
+        def family(name, kind, samples):
+            lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+            for suffix, labels, value in samples:
+                lines.append('{}_{}{}{{{}}} {}'.format(
+                    prefix, name, suffix, ','.join(
+                        '{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                        for k, v in labels), _prometheus_value(value)))
+
+        with self._lock:
+            family('requests_total', 'counter', [
+                ('', [('endpoint', e)], n)
+                for e, n in sorted(self.requests.items())])
+            family('response_bytes_total', 'counter', [
+                ('', [('endpoint', e)], n)
+                for e, n in sorted(self.bytes.items())])
+            family('request_errors_total', 'counter', [
+                ('', [('endpoint', e), ('error', error)], n)
+                for (e, error), n in sorted(self.errors.items())])
+            family('request_retries_total', 'counter', [
+                ('', [('error', error)], n)
+                for error, n in sorted(self.retries.items())])
+            family('stage_items_total', 'counter', [
+                ('', [('stage', stage)], n)
+                for stage, n in sorted(self.stages.items())])
+            histograms = sorted(self.latency.items())
+        samples = []
+        for endpoint, histogram in histograms:
+            with histogram._lock:
+                cumulative = 0
+                for bound, n in zip(histogram.buckets, histogram.counts):
+                    cumulative += n
+                    samples.append(('_bucket', [('endpoint', endpoint),
+                                                ('le', _prometheus_value(
+                                                    bound))], cumulative))
+                samples.append(('_sum', [('endpoint', endpoint)],
+                                histogram.sum))
+                samples.append(('_count', [('endpoint', endpoint)],
+                                histogram.count))
+        family('request_duration_seconds', 'histogram', samples)
+        return '\n'.join(lines) + '\n'
+
+
+def _prometheus_value(value):
+    """Formats number in Prometheus text format."""
+    if value == inf:
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class StatsReporter():
+    """Periodically exports crawl statistics from a background thread.
+
+    Parameters
+    ----------
+    stats : CrawlStats
+        Statistics registry.
+    interval : float, optional
+        Seconds between exports.
+    path : string, optional
+        File the statistics are written to, atomically replaced at every
+        export, e.g. for the Prometheus node exporter textfile collector.
+    fmt : string, optional
+        Either 'prometheus' (default) or 'json'.
+    callback : callable, optional
+        Called with the exported text at every export.
+
+    Examples
+    --------
+    >> with StatsReporter(stats, 15, path='/var/lib/node/fipe.prom'):
+    ..     db.ingest(fipe.iter_table(table))
+
+    """
+
+    def __init__(self, stats, interval=15., path=None, fmt='prometheus',
+                 callback=None):
+        if fmt not in ('prometheus', 'json'):
+            raise ValueError('Invalid format `{}`.'.format(fmt))
+        self.stats = stats
+        self.interval = interval
+        self.path = path
+        self.fmt = fmt
+        self.callback = callback
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        """Starts exporting statistics."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops exporting statistics after a last export."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.export()
+
+    def export(self):
+        """Exports current statistics."""
+        if self.fmt == 'json':
+            text = self.stats.to_json() + '\n'
+        else:
+            text = self.stats.to_prometheus()
+        if self.path is not None:
+            tmp = '{}.tmp'.format(self.path)
+            with open(tmp, 'w') as f:
+                f.write(text)
+            os.replace(tmp, self.path)
+        if self.callback is not None:
+            self.callback(text)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.export()
+
+
+class RateLimiter():
+    """Adaptive token bucket pacing requests to Fipe.
+
+    Tokens are refilled at `rate` requests per second and every request
+    takes one, waiting if none is left. The rate adapts to the server
+    following an additive increase, multiplicative decrease scheme:
+    successful requests raise the rate by about `increase` requests per
+    second every second, while errors and responses slower than
+    `latency_target` multiply it by `decrease`, at most once every
+    `cooldown` seconds. The limiter is shared by all threads of a crawler.
+
+    Parameters
+    ----------
+    rate : float, optional
+        Initial rate in requests per second.
+    min_rate, max_rate : float, optional
+        Bounds of the adapted rate.
+    burst : float, optional
+        Bucket capacity, i.e. maximum number of requests sent at once.
+    increase : float, optional
+        Additive rate increase per second of successful requests.
+    decrease : float, optional
+        Multiplicative rate decrease factor on errors.
+    latency_target : float, optional
+        Latency in seconds above which a response counts as congestion.
+    cooldown : float, optional
+        Minimum time in seconds between two rate decreases.
+
+    """
+
+    def __init__(self, rate=10., min_rate=0.5, max_rate=200., burst=1.,
+                 increase=1., decrease=0.5, latency_target=None,
+                 cooldown=1.):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self._tokens = burst
+        self._updated = monotonic()
+        self._decreased = -cooldown
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Waits until a request may be sent."""
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            sleep(wait)
+
+    def feedback(self, ok, latency=None):
+        """Adapts the rate to the outcome of a request."""
+        congested = (not ok or (self.latency_target is not None and
+                                latency is not None and
+                                latency > self.latency_target))
+        with self._lock:
+            now = monotonic()
+            if not congested:
+                self.rate = min(self.max_rate,
+                                self.rate + self.increase / self.rate)
+            elif now - self._decreased >= self.cooldown:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self._decreased = now
+
+
+class RetryPolicy():
+    """Bounded retry policy with capped, jittered exponential backoff.
+
+    Parameters
+    ----------
+    max_attempts : integer, optional
+        Number of attempts before giving up. If `None`, retries forever.
+    base : float, optional
+        Backoff in seconds after the first failed attempt.
+    cap : float, optional
+        Maximum backoff in seconds, also bounding the waits asked for by
+        the server with `Retry-After`.
+    jitter : boolean, optional
+        If `True` (default), waits a random time between zero and the
+        backoff, so that concurrent callers do not retry in lockstep.
+    statuses : tuple, optional
+        HTTP status codes that are retried.
+
+    """
+
+    def __init__(self, max_attempts=8, base=1., cap=60., jitter=True,
+                 statuses=(429, 500, 502, 503, 504)):
+        self.max_attempts = max_attempts
+        self.base = base
+        self.cap = cap
+        self.jitter = jitter
+        self.statuses = statuses
+
+    def exhausted(self, attempt):
+        """Tells whether no attempt is left after `attempt` attempts."""
+        return self.max_attempts is not None and attempt >= self.max_attempts
+
+    def delay(self, attempt, minimum=0.):
+        """Returns seconds to wait after `attempt` failed attempts.
+
+        The delay is at least `minimum`, e.g. as asked for by the server,
+        and at most `cap`.
+
+        """
+        delay = min(self.cap, self.base * 2 ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return min(max(delay, minimum), self.cap)
+
+
+class CircuitBreaker():
+    """Circuit breaker shared by all requests of a crawler.
+
+    After `threshold` consecutive failed requests the circuit opens and
+    requests are held back for `cooldown` seconds. Then a single probe
+    request is let through, closing the circuit if it succeeds or opening
+    it again otherwise.
+
+    Parameters
+    ----------
+    threshold : integer, optional
+        Number of consecutive failures opening the circuit.
+    cooldown : float, optional
+        Seconds the circuit stays open.
+    block : boolean, optional
+        If `True` (default), requests wait while the circuit is open.
+        Otherwise they fail with `CircuitOpenError`.
+
+    """
+
+    def __init__(self, threshold=10, cooldown=30., block=True):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.block = block
+        self.failures = 0
+        self._opened = None
+        self._probing = False
+        self._cond = threading.Condition()
+
+    @property
+    def state(self):
+        """Circuit state, either 'closed', 'open' or 'half-open'."""
+        if self._opened is None:
+            return 'closed'
+        if self._probing or monotonic() - self._opened >= self.cooldown:
+            return 'half-open'
+        return 'open'
+
+    def wait(self):
+        """Waits until a request may be sent through the circuit."""
+        with self._cond:
+            while self._opened is not None:
+                remaining = self._opened + self.cooldown - monotonic()
+                if remaining <= 0 and not self._probing:
+                    self._probing = True
+                    return
+                if not self.block:
+                    raise CircuitOpenError(
+                        'Circuit open after {:d} failures.'.format(
+                            self.failures))
+                self._cond.wait(remaining if remaining > 0 else None)
+
+    def record(self, ok):
+        """Records the outcome of a request."""
+        with self._cond:
+            if ok:
+                self.failures = 0
+                self._opened = None
+            else:
+                self.failures += 1
+                if self._probing or self.failures >= self.threshold:
+                    if self._opened is None or self._probing:
+                        logger.warning('Circuit open for %.1f s after %d '
+                                       'failures.', self.cooldown,
+                                       self.failures)
+                    self._opened = monotonic()
+            self._probing = False
+            self._cond.notify_all()
+
+
+class ResponseCache():
+    """Persistent cache of Fipe responses.
+
+    Responses are stored in a SQLite database keyed by request URL and
+    normalized form data. Responses of reference tables older than
+    `latest_table` never change and are kept regardless of their age,
+    other responses expire after the time to live of their endpoint. The
+    least recently used responses are evicted once the cache grows beyond
+    `max_size`.
+
+    Parameters
+    ----------
+    path : string, optional
+        Path of the SQLite cache file. The default is to cache in memory
+        only.
+    ttl : dictionary, optional
+        Time to live in seconds by endpoint name, e.g.
+        `{'ConsultarMarcas': 3600}`. A value of `None` never expires.
+    default_ttl : float, optional
+        Time to live in seconds of endpoints not given in `ttl`.
+    max_size : integer, optional
+        Maximum size in bytes of compressed cached responses.
+    latest_table : integer, optional
+        Id of the latest, still open, reference table. Updated by
+        `Fipe.crawl_reference_tables`.
+
+    Examples
+    --------
+    >> cache = ResponseCache(os.path.realpath('../dat/cache.db'))
+    >> fipe = Fipe(cache=cache)
+    >> cache.hits, cache.misses
+
+    """
+    module_dir = dirname(__file__)
+    default_ttls = {'ConsultarTabelaDeReferencia': 86400}
+
+    def __init__(self, path=':memory:', ttl=None, default_ttl=86400,
+                 max_size=2 ** 30, latest_table=None):
+        self.ttl = dict(self.default_ttls, **(ttl or {}))
+        self.default_ttl = default_ttl
+        self.max_size = max_size
+        self.latest_table = latest_table
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode = WAL;')
+        self.conn.execute('PRAGMA synchronous = NORMAL;')
+        with open('{}/schemas/{}'.format(self.module_dir,
+                                         'fipe_cache.sql')) as f:
+            self.conn.executescript(f.read())
+        self.size, = self.conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM response').fetchone()
+
+    def get(self, url, data=None):
+        """Returns cached response or `None` if not cached or expired."""
+        key, endpoint, table_id = self._key(url, data)
+        now = time()
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT body, created FROM response WHERE key = ?',
+                (key,)).fetchone()
+            if row is not None and not self._expired(endpoint, table_id,
+                                                     now - row[1]):
+                self.conn.execute(
+                    'UPDATE response SET accessed = ? WHERE key = ?',
+                    (now, key))
+                self.hits += 1
+                return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+            self.misses += 1
+        return None
+
+    def set(self, url, data, response):
+        """Caches JSON `response` of request."""
+        key, endpoint, table_id = self._key(url, data)
+        body = zlib.compress(json.dumps(response).encode('utf-8'))
+        now = time()
+        with self._lock:
+            old = self.conn.execute('SELECT size FROM response WHERE key = ?',
+                                    (key,)).fetchone()
+            self.conn.execute(
+                'INSERT OR REPLACE INTO response (key, endpoint, table_id, '
+                'body, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, endpoint, table_id, body, len(body), now, now))
+            self.size += len(body) - (old[0] if old else 0)
+            if self.size > self.max_size:
+                self._evict()
+
+    def stats(self):
+        """Returns dictionary of cache statistics."""
+        with self._lock:
+            entries, = self.conn.execute(
+                'SELECT COUNT(*) FROM response').fetchone()
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': entries, 'size': self.size}
+
+    def clear(self):
+        """Removes all cached responses."""
+        with self._lock:
+            self.conn.execute('DELETE FROM response')
+            self.size = 0
+
+    def close(self):
+        """Closes the cache database connection."""
+        self.conn.close()
+
+    def _expired(self, endpoint, table_id, age):
+        """Tells whether a response of given age has expired."""
+        if (self.latest_table is not None and table_id is not None and
+                table_id < self.latest_table):
+            return False
+        ttl = self.ttl.get(endpoint, self.default_ttl)
+        return ttl is not None and age > ttl
+
+    def _evict(self):
+        """Evicts least recently used responses down to 90% of size."""
+        target = 0.9 * self.max_size
+        rows = self.conn.execute(
+            'SELECT key, size FROM response ORDER BY accessed')
+        keys = []
+        for key, size in rows:
+            if self.size <= target:
+                break
+            keys.append((key,))
+            self.size -= size
+        self.conn.executemany('DELETE FROM response WHERE key = ?', keys)
+
+    @staticmethod
+    def _key(url, data):
+        """Returns cache key, endpoint name and table id of request."""
+        table_id = (data or {}).get('codigoTabelaReferencia')
+        return (_request_key(url, data), url.rsplit('/', 1)[-1],
+                int(table_id) if table_id is not None else None)
+
+
+def _retry_after(response):
+    """Returns seconds of the `Retry-After` header of response, or 0."""
+    value = response.headers.get('Retry-After')
+    try:
+        return max(0., float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return 0.
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max(0., (date - datetime.now(timezone.utc)).total_seconds())
+
+
+def _request_key(url, data=None):
+    """Returns digest of URL and normalized form data of request."""
+    # Fields set to `None` are not sent by `requests`.
+    items = sorted((str(k), str(v)) for k, v in (data or {}).items()
+                   if v is not None)
+    return hashlib.sha1('{}?{}'.format(url, urlencode(items)).encode(
+        'utf-8')).digest()
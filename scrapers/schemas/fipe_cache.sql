@@ -0,0 +1,17 @@
+-- Fipe HTTP response cache.
+--
+-- Responses are stored as zlib compressed JSON, keyed by the SHA-1 digest
+-- of the request URL and normalized form data. `accessed` is used for
+-- least recently used eviction.
+
+CREATE TABLE IF NOT EXISTS response (
+    key BLOB PRIMARY KEY,
+    endpoint TEXT NOT NULL,
+    table_id INTEGER,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS response_accessed ON response (accessed);
@@ -0,0 +1,33 @@
+-- Fipe price aggregates.
+--
+-- Aggregates are sums over matched pairs of prices of the same vehicle
+-- type, model, built year and fuel type, kept per maker and reference
+-- table. Being sums, they are updated by adding and removing the pairs
+-- of ingested prices only. Prices are given in cents.
+
+-- Pairs of prices in a reference table and the previous one, the ratio
+-- of `price` to `previous_price` being the maker's month-over-month price
+-- change.
+CREATE TABLE IF NOT EXISTS maker_price_change (
+    vehicle_type INTEGER NOT NULL,
+    maker_id INTEGER NOT NULL,
+    table_id INTEGER NOT NULL REFERENCES reference_table (id),
+    models INTEGER NOT NULL,
+    price INTEGER NOT NULL,
+    previous_price INTEGER NOT NULL,
+    PRIMARY KEY (vehicle_type, maker_id, table_id)
+) WITHOUT ROWID;
+
+-- Pairs of prices of a built year and the next one in a reference table,
+-- the ratio of `price` to `newer_price` being the value retained by
+-- vehicles of the maker over one year of age.
+CREATE TABLE IF NOT EXISTS maker_depreciation (
+    vehicle_type INTEGER NOT NULL,
+    maker_id INTEGER NOT NULL,
+    table_id INTEGER NOT NULL REFERENCES reference_table (id),
+    build_year INTEGER NOT NULL,
+    models INTEGER NOT NULL,
+    price INTEGER NOT NULL,
+    newer_price INTEGER NOT NULL,
+    PRIMARY KEY (vehicle_type, maker_id, table_id, build_year)
+) WITHOUT ROWID;
@@ -0,0 +1,25 @@
+-- Fipe crawl progress.
+--
+-- Every (reference table, vehicle type, maker, model, built year, fuel type)
+-- work unit of a crawl is recorded with its status, which is either
+-- 'pending', 'done' or 'failed'. `position` keeps the order in which built
+-- years were listed by Fipe.
+
+CREATE TABLE IF NOT EXISTS crawl_unit (
+    table_id INTEGER NOT NULL,
+    vehicle_type INTEGER NOT NULL,
+    maker_id INTEGER NOT NULL,
+    model_id INTEGER NOT NULL,
+    build_year INTEGER NOT NULL,
+    fuel_type INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated_at REAL,
+    PRIMARY KEY (table_id, vehicle_type, maker_id, model_id, build_year,
+                 fuel_type)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS crawl_unit_status
+    ON crawl_unit (table_id, vehicle_type, status);
@@ -0,0 +1,43 @@
+-- Fipe change-only price history.
+--
+-- Instead of one price row per reference table, a price version is stored
+-- once for the range of consecutive reference tables `valid_from` to
+-- `valid_to` (inclusive) in which the price and Fipe code of a vehicle
+-- type, model, built year and fuel type did not change. Fipe codes are
+-- kept in their own dimension table. Prices are given in cents.
+
+CREATE TABLE IF NOT EXISTS fipe_code (
+    id INTEGER PRIMARY KEY,
+    code TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS price_version (
+    vehicle_type INTEGER NOT NULL,
+    model_id INTEGER NOT NULL,
+    build_year INTEGER NOT NULL,
+    fuel_type INTEGER NOT NULL,
+    valid_from INTEGER NOT NULL REFERENCES reference_table (id),
+    valid_to INTEGER NOT NULL REFERENCES reference_table (id),
+    price INTEGER,
+    fipe_code_id INTEGER REFERENCES fipe_code (id),
+    PRIMARY KEY (vehicle_type, model_id, build_year, fuel_type, valid_from),
+    FOREIGN KEY (vehicle_type, model_id) REFERENCES model (vehicle_type, id)
+) WITHOUT ROWID;
+
+-- Versions valid in a reference table, most snapshots are recent ones.
+CREATE INDEX IF NOT EXISTS price_version_valid
+    ON price_version (valid_to, valid_from);
+
+-- Covering index of price lookups and histories by Fipe code.
+CREATE INDEX IF NOT EXISTS price_version_fipe_code
+    ON price_version (fipe_code_id, build_year, fuel_type, valid_from,
+                      valid_to, price);
+
+-- Full snapshot of every reference table, with the columns of `price`.
+CREATE VIEW IF NOT EXISTS price_snapshot AS
+    SELECT reference_table.id AS table_id, v.vehicle_type, v.model_id,
+        v.build_year, v.fuel_type, v.price, fipe_code.code AS fipe_code
+    FROM reference_table
+    JOIN price_version AS v ON v.valid_to >= reference_table.id
+        AND v.valid_from <= reference_table.id
+    LEFT JOIN fipe_code ON fipe_code.id = v.fipe_code_id;
@@ -0,0 +1,44 @@
+-- Fipe database model.
+--
+-- Makers and models are shared by all reference tables, prices are stored
+-- once per reference table, vehicle type, model, built year and fuel type.
+-- Prices are given in cents. A built year of 32000 denotes brand new
+-- vehicles ("zero km").
+
+CREATE TABLE IF NOT EXISTS reference_table (
+    id INTEGER PRIMARY KEY,
+    year INTEGER,
+    month INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS maker (
+    vehicle_type INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    name TEXT,
+    PRIMARY KEY (vehicle_type, id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS model (
+    vehicle_type INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    maker_id INTEGER NOT NULL,
+    name TEXT,
+    PRIMARY KEY (vehicle_type, id),
+    FOREIGN KEY (vehicle_type, maker_id) REFERENCES maker (vehicle_type, id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS price (
+    table_id INTEGER NOT NULL REFERENCES reference_table (id),
+    vehicle_type INTEGER NOT NULL,
+    model_id INTEGER NOT NULL,
+    build_year INTEGER NOT NULL,
+    fuel_type INTEGER NOT NULL,
+    price INTEGER,
+    fipe_code TEXT,
+    PRIMARY KEY (table_id, vehicle_type, model_id, build_year, fuel_type),
+    FOREIGN KEY (vehicle_type, model_id) REFERENCES model (vehicle_type, id)
+) WITHOUT ROWID;
+
+-- Covering index of price lookups and histories by Fipe code.
+CREATE INDEX IF NOT EXISTS price_fipe_code
+    ON price (fipe_code, build_year, fuel_type, table_id, price);
@@ -0,0 +1,35 @@
+-- Fipe model-name search index.
+--
+-- Every (vehicle type, model, Fipe code) is a search entry with the range
+-- of built years it was priced for, brand new vehicles aside. Model and
+-- maker names are indexed as normalized tokens: lower case, without
+-- diacritics and with decimals such as "1.6" kept whole. Tokens and their
+-- trigrams are kept apart to correct misspelled tokens of searches.
+
+CREATE TABLE IF NOT EXISTS search_entry (
+    id INTEGER PRIMARY KEY,
+    vehicle_type INTEGER NOT NULL,
+    maker_id INTEGER NOT NULL,
+    model_id INTEGER NOT NULL,
+    fipe_code TEXT,
+    first_year INTEGER,
+    last_year INTEGER,
+    model TEXT NOT NULL,
+    maker TEXT NOT NULL,
+    tokens TEXT NOT NULL
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+    model, maker, tokenize = "unicode61 tokenchars '.'"
+);
+
+CREATE TABLE IF NOT EXISTS search_token (
+    token TEXT PRIMARY KEY,
+    entries INTEGER NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS search_trigram (
+    trigram TEXT NOT NULL,
+    token TEXT NOT NULL,
+    PRIMARY KEY (trigram, token)
+) WITHOUT ROWID;
@@ -0,0 +1,36 @@
+-- Fipe crawl work queue.
+--
+-- Work units are leased by workers for a limited time. Units whose lease
+-- expired are leased again by other workers. The level of a unit tells
+-- what it crawls: 0 lists makers of a reference table, 1 lists models of
+-- a maker, 2 lists built years of a model and 3 crawls a single price.
+-- Ids of levels below the unit's level are zero.
+
+CREATE TABLE IF NOT EXISTS work_table (
+    id INTEGER PRIMARY KEY,
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS work_unit (
+    id INTEGER PRIMARY KEY,
+    level INTEGER NOT NULL,
+    table_id INTEGER NOT NULL REFERENCES work_table (id),
+    vehicle_type INTEGER NOT NULL,
+    maker_id INTEGER NOT NULL DEFAULT 0,
+    maker TEXT,
+    model_id INTEGER NOT NULL DEFAULT 0,
+    model TEXT,
+    build_year INTEGER NOT NULL DEFAULT 0,
+    fuel_type INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    UNIQUE (table_id, vehicle_type, maker_id, model_id, build_year,
+            fuel_type)
+);
+
+CREATE INDEX IF NOT EXISTS work_unit_status
+    ON work_unit (status, level DESC, id);
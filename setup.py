@@ -0,0 +1,19 @@
+from setuptools import setup
+
+setup(
+    name='scrapers',
+    version='0.1.0',
+    description=('Collection of web scrapers for data science related '
+                 'projects.'),
+    author='Sebastian Krieger',
+    author_email='sebastian@nublia.com',
+    license='GNU GPL',
+    packages=['scrapers'],
+    package_data={'scrapers': ['schemas/*.sql']},
+    python_requires='>=3.6',
+    install_requires=['pandas', 'requests'],
+    extras_require={'arrow': ['pyarrow']},
+    entry_points={
+        'console_scripts': ['fipe = scrapers.fipe_cli:main'],
+    },
+)
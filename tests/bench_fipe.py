@@ -0,0 +1,236 @@
+"""Benchmarks full-table crawls against the local stand-in FIPE server.
+
+For every scale, a synthetic reference table of about that many prices is
+crawled with `Fipe.iter_table` and ingested into an in-memory `Fipe_db`.
+Reports requests per second, rows per second end-to-end and peak traced
+memory, so that performance regressions show up as numbers. With
+`--ingest`, only bulk ingest of synthetic records is measured, against
+plain SQLite inserts of the same rows.
+
+Usage
+-----
+  $ python3 -m tests.bench_fipe --scales 1000 10000 --workers 16 \\
+        --latency 0.005 --json bench.json
+  $ python3 -m tests.bench_fipe --ingest --scales 100000 --storage changes
+
+"""
+import argparse
+import gc
+import json
+import multiprocessing
+import sqlite3
+import sys
+import tracemalloc
+
+from time import perf_counter
+
+from scrapers import fipe, fipe_db, fipe_http
+from tests.fipe_server import FipeServer, SyntheticCatalog
+
+
+def serve(conn, catalog, options):
+    """Runs a stand-in server until `conn` receives anything."""
+    with FipeServer(catalog, **options) as server:
+        conn.send(server.url)
+        conn.recv()
+
+
+def run(rows, max_workers=8, latency=0., throttle=0., error=0., reset=0.,
+        malformed=0., compress=True, trace_memory=True, batch_size=10000,
+        vehicle_types=(1,), db=':memory:', writer=False):
+    """Crawls and ingests a synthetic table of about `rows` prices.
+
+    Each of `vehicle_types` holds `rows` prices, all crawled in one pass.
+    Prices are ingested into database `db` by the crawling thread, or by
+    a background `DbWriter` if `writer` is `True`.
+
+    The server runs in a child process, so that neither its work nor
+    memory tracing of the crawl skew each other.
+
+    Returns
+    -------
+    result : dict
+        Scale, requests, rows, elapsed seconds, throughputs, response
+        bytes, peak traced memory in bytes and number of failed requests.
+
+    """
+    catalog = SyntheticCatalog.for_rows(rows)
+    options = dict(latency=latency, throttle=throttle, error=error,
+                   reset=reset, malformed=malformed, compress=compress)
+    conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=serve, daemon=True,
+                                      args=(child_conn, catalog, options))
+    process.start()
+    try:
+        url = conn.recv()
+        retry = fipe_http.RetryPolicy(max_attempts=None, base=0.01, cap=0.5)
+        with fipe.Fipe(base_url=url, max_workers=max_workers, retry=retry,
+                       compress=compress) as crawler:
+            table = crawler.crawl_reference_tables()[0]
+            if writer:
+                sink = fipe_db.DbWriter(db, batch_size=batch_size)
+            else:
+                sink = fipe_db.Fipe_db(db)
+                sink.create_schema()
+            sink.add_tables([table])
+            stats = crawler.stats = fipe_http.CrawlStats()
+            gc.collect()
+            if trace_memory:
+                tracemalloc.start()
+            start = perf_counter()
+            records = crawler.iter_table(table, vehicle_types)
+            if writer:
+                for record in records:
+                    sink.write(record)
+                sink.close()
+                n = sink.count
+            else:
+                n = sink.ingest(records, batch_size=batch_size)
+                sink.close()
+            elapsed = perf_counter() - start
+            peak = None
+            if trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+    finally:
+        conn.send(None)
+        process.join()
+    requests = sum(stats.requests.values())
+    return {'scale': rows, 'requests': requests, 'rows': n,
+            'elapsed': elapsed, 'requests_per_second': requests / elapsed,
+            'rows_per_second': n / elapsed,
+            'bytes': sum(stats.bytes.values()), 'peak_memory': peak,
+            'errors': sum(stats.errors.values())}
+
+
+def ingest(rows, tables=2, storage='snapshot', aggregates=False,
+           batch_size=10000, repeat=3):
+    """Ingests about `rows` synthetic records into an in-memory database.
+
+    Records are spread over `tables` consecutive reference tables, with
+    prices changing from one table to the next. The best of `repeat` runs
+    is compared to plain SQLite inserts of the same rows, a rate about
+    independent of the machine.
+
+    Returns
+    -------
+    result : dict
+        Scale, rows, ingest and plain insert rows per second, and their
+        ratio.
+
+    """
+    catalog = SyntheticCatalog.for_rows(rows // tables)
+    records = [fipe.PriceRecord(table, 1, maker, 'Maker', model, 'Model',
+                                year, fuel, (1 + table % 2) * 1000. + model,
+                                '{:06d}-1'.format(model))
+               for table in range(218, 218 + tables)
+               for maker in catalog.maker_ids(1)
+               for model in catalog.model_ids(maker)
+               for year, fuel in catalog.model_years(model)]
+    rows_per_second = sqlite_rows_per_second = 0.
+    for _ in range(repeat):
+        db = fipe_db.Fipe_db(storage=storage, aggregates=aggregates)
+        db.create_schema()
+        start = perf_counter()
+        n = db.ingest(records, batch_size=batch_size)
+        rows_per_second = max(rows_per_second,
+                              n / (perf_counter() - start))
+        db.close()
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE price (table_id, vehicle_type, model_id, '
+                     'build_year, fuel_type, price, fipe_code, PRIMARY KEY '
+                     '(table_id, vehicle_type, model_id, build_year, '
+                     'fuel_type)) WITHOUT ROWID')
+        start = perf_counter()
+        conn.executemany('INSERT INTO price VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         ((r.table, r.vehicle_type, r.model_id, r.build_year,
+                           r.fuel_type, round(r.price * 100), r.fipe_code)
+                          for r in records))
+        conn.commit()
+        sqlite_rows_per_second = max(sqlite_rows_per_second,
+                                     n / (perf_counter() - start))
+        conn.close()
+    return {'scale': rows, 'rows': n, 'rows_per_second': rows_per_second,
+            'sqlite_rows_per_second': sqlite_rows_per_second,
+            'ratio': rows_per_second / sqlite_rows_per_second}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scales', type=int, nargs='+',
+                        default=[1000, 10000],
+                        help='approximate number of prices per table')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='maximum number of requests in flight')
+    parser.add_argument('--vehicle-types', type=int, nargs='+',
+                        default=[1], choices=sorted(fipe.Fipe.vehicle_types),
+                        help='vehicle types crawled in a single pass')
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='mean server latency in seconds')
+    parser.add_argument('--throttle', type=float, default=0.,
+                        help='probability of HTTP 429 responses')
+    parser.add_argument('--error', type=float, default=0.,
+                        help='probability of HTTP 500 responses')
+    parser.add_argument('--reset', type=float, default=0.,
+                        help='probability of connection resets')
+    parser.add_argument('--malformed', type=float, default=0.,
+                        help='probability of truncated JSON responses')
+    parser.add_argument('--no-compress', dest='compress',
+                        action='store_false',
+                        help='send and accept uncompressed responses')
+    parser.add_argument('--no-trace-memory', dest='trace_memory',
+                        action='store_false',
+                        help='skip tracemalloc, which slows crawls down')
+    parser.add_argument('--db', default=':memory:', metavar='PATH',
+                        help='SQLite database to ingest prices into')
+    parser.add_argument('--writer', action='store_true',
+                        help='ingest from a background writer thread')
+    parser.add_argument('--ingest', action='store_true',
+                        help='measure bulk ingest of synthetic records only')
+    parser.add_argument('--storage', choices=('snapshot', 'changes'),
+                        default='snapshot', help='price storage of --ingest')
+    parser.add_argument('--aggregates', action='store_true',
+                        help='maintain price aggregates on --ingest')
+    parser.add_argument('--json', metavar='PATH',
+                        help='also write results as JSON to PATH')
+    args = parser.parse_args(argv)
+
+    results = []
+    if args.ingest:
+        print('{:>8} {:>8} {:>10} {:>10} {:>7}'.format(
+            'scale', 'rows', 'rows/s', 'sqlite/s', 'ratio'))
+        for rows in args.scales:
+            result = ingest(rows, storage=args.storage,
+                            aggregates=args.aggregates)
+            results.append(result)
+            print('{scale:>8d} {rows:>8d} {rows_per_second:>10.1f} '
+                  '{sqlite_rows_per_second:>10.1f} {ratio:>7.2f}'.format(
+                      **result))
+    else:
+        print('{:>8} {:>8} {:>8} {:>9} {:>10} {:>10} {:>10} {:>7}'.format(
+            'scale', 'requests', 'rows', 'seconds', 'req/s', 'rows/s',
+            'peak MiB', 'errors'))
+        for rows in args.scales:
+            result = run(rows, max_workers=args.workers, latency=args.latency,
+                         throttle=args.throttle, error=args.error,
+                         reset=args.reset, malformed=args.malformed,
+                         compress=args.compress,
+                         trace_memory=args.trace_memory,
+                         vehicle_types=args.vehicle_types, db=args.db,
+                         writer=args.writer)
+            results.append(result)
+            peak = result['peak_memory']
+            print('{scale:>8d} {requests:>8d} {rows:>8d} {elapsed:>9.2f} '
+                  '{requests_per_second:>10.1f} {rows_per_second:>10.1f} '
+                  '{peak:>10} {errors:>7d}'.format(
+                      peak='-' if peak is None else '{:.1f}'.format(
+                          peak / 2 ** 20), **result))
+            sys.stdout.flush()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
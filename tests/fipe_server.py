@@ -0,0 +1,331 @@
+"""Local stand-in of the FIPE API for tests and benchmarks.
+
+Serves the `/api/veiculos/*` endpoints used by the Fipe scraper from a
+synthetic catalog of configurable size, and optionally injects latency,
+throttling, server errors, connection resets and malformed JSON.
+
+Example
+-------
+>> with FipeServer(SyntheticCatalog(makers=5), latency=0.01) as server:
+..     fipe = Fipe(base_url=server.url)
+..     tables = fipe.crawl_reference_tables()
+
+"""
+import gzip
+import json
+import random
+import socket
+import struct
+import threading
+import time
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+MONTHS = ('janeiro', 'fevereiro', 'março', 'abril', 'maio', 'junho',
+          'julho', 'agosto', 'setembro', 'outubro', 'novembro', 'dezembro')
+FUELS = {1: 'Gasolina', 2: 'Álcool', 3: 'Diesel'}
+VEHICLE_TYPES = {1: 'carro', 2: 'moto', 3: 'caminhao'}
+
+
+class SyntheticCatalog():
+    """Deterministic synthetic FIPE catalog.
+
+    Every reference table lists the same `makers` makers per vehicle
+    type, each with `models` models built in `years` consecutive years,
+    hence a table holds `makers * models * years` prices per vehicle type.
+    Prices drift from one table to the next.
+
+    Parameters
+    ----------
+    makers : integer, optional
+        Number of makers per vehicle type.
+    models : integer, optional
+        Number of models per maker.
+    years : integer, optional
+        Number of built years per model.
+    tables : integer, optional
+        Number of reference tables, the latest one is `first_table +
+        tables - 1`.
+    first_table : integer, optional
+        Code of the oldest reference table.
+    seed : integer, optional
+        Seed of synthetic prices.
+
+    """
+
+    def __init__(self, makers=10, models=10, years=5, tables=1,
+                 first_table=218, seed=0):
+        self.makers = makers
+        self.models = models
+        self.years = years
+        self.tables = tables
+        self.first_table = first_table
+        self.seed = seed
+
+    @classmethod
+    def for_rows(cls, rows, models=20, years=5, **kwargs):
+        """Returns a catalog of about `rows` prices per table."""
+        makers = max(1, -(-rows // (models * years)))
+        return cls(makers=makers, models=models, years=years, **kwargs)
+
+    @property
+    def rows(self):
+        """Number of prices per reference table and vehicle type."""
+        return self.makers * self.models * self.years
+
+    def reference_tables(self):
+        tables = []
+        for i in reversed(range(self.tables)):
+            month = (9 + i) % 12
+            tables.append({'Codigo': self.first_table + i,
+                           'Mes': '{}/{:d} '.format(MONTHS[month],
+                                                    2017 + (9 + i) // 12)})
+        return tables
+
+    def maker_ids(self, vehicle_type):
+        return [1000 * vehicle_type + i + 1 for i in range(self.makers)]
+
+    def makers_of(self, table, vehicle_type):
+        if not self._has_table(table):
+            return []
+        return [{'Label': 'Maker {:d}'.format(maker), 'Value': str(maker)}
+                for maker in self.maker_ids(vehicle_type)]
+
+    def model_ids(self, maker):
+        return [100 * maker + i + 1 for i in range(self.models)]
+
+    def model_years(self, model):
+        """Returns (year, fuel type) pairs of model, latest first."""
+        first = 1990 + model % 25
+        fuel = 3 if model % 7 == 0 else 1
+        return [(year, fuel) for year in
+                reversed(range(first, first + self.years))]
+
+    def models_of(self, table, vehicle_type, maker):
+        if not self._has_table(table) or \
+                maker not in self.maker_ids(vehicle_type):
+            return {'Modelos': [], 'Anos': []}
+        models = self.model_ids(maker)
+        years = sorted({pair for model in models
+                        for pair in self.model_years(model)}, reverse=True)
+        return {'Modelos': [{'Label': 'Model {:d}'.format(model),
+                             'Value': model} for model in models],
+                'Anos': [self._year_item(*pair) for pair in years]}
+
+    def years_of(self, table, vehicle_type, maker, model):
+        if not self._has_model(table, vehicle_type, maker, model):
+            return {'codigoRetorno': 0, 'erro': 'nadaencontrado'}
+        return [self._year_item(*pair) for pair in self.model_years(model)]
+
+    def price_of(self, table, vehicle_type, maker, model, year, fuel):
+        if not self._has_model(table, vehicle_type, maker, model) or \
+                (year, fuel) not in self.model_years(model):
+            return {'codigoRetorno': 0, 'erro': 'nadaencontrado'}
+        rng = random.Random(hash((self.seed, model, year)))
+        cents = rng.randrange(500000, 50000000)
+        cents += cents * (table - self.first_table) // 200
+        reais = '{:,d}'.format(cents // 100).replace(',', '.')
+        return {'Valor': 'R$ {},{:02d}'.format(reais, cents % 100),
+                'Marca': 'Maker {:d}'.format(maker),
+                'Modelo': 'Model {:d}'.format(model),
+                'AnoModelo': year,
+                'Combustivel': FUELS[fuel],
+                'CodigoFipe': '{:06d}-{:d}'.format(model % 1000000, fuel),
+                'MesReferencia': '',
+                'Autenticacao': '',
+                'TipoVeiculo': vehicle_type,
+                'SiglaCombustivel': FUELS[fuel][0],
+                'DataConsulta': ''}
+
+    def _has_table(self, table):
+        return self.first_table <= table < self.first_table + self.tables
+
+    def _has_model(self, table, vehicle_type, maker, model):
+        return (self._has_table(table) and
+                maker in self.maker_ids(vehicle_type) and
+                model in self.model_ids(maker))
+
+    @staticmethod
+    def _year_item(year, fuel):
+        return {'Label': '{:d} {}'.format(year, FUELS[fuel]),
+                'Value': '{:d}-{:d}'.format(year, fuel)}
+
+
+class FipeServer():
+    """Threaded HTTP server answering FIPE API requests.
+
+    Faults are drawn independently for every request, in this order:
+    connection reset, throttling (HTTP 429), server error (HTTP 500) and
+    malformed JSON.
+
+    Parameters
+    ----------
+    catalog : SyntheticCatalog, optional
+        Catalog served. Defaults to a small catalog.
+    latency : float, optional
+        Mean response latency in seconds.
+    jitter : float, optional
+        Latency varies uniformly by this fraction of its mean.
+    throttle : float, optional
+        Probability of answering with HTTP 429.
+    error : float, optional
+        Probability of answering with HTTP 500.
+    reset : float, optional
+        Probability of resetting the connection without answering.
+    malformed : float, optional
+        Probability of answering with truncated JSON.
+    compress : boolean, optional
+        If `True` (default), gzips responses of clients accepting it.
+    seed : integer, optional
+        Seed of injected faults.
+    host, port : optional
+        Address to bind, by default a free port of the loopback interface.
+
+    """
+
+    def __init__(self, catalog=None, latency=0., jitter=0.5, throttle=0.,
+                 error=0., reset=0., malformed=0., compress=True, seed=0,
+                 host='127.0.0.1', port=0):
+        self.catalog = catalog or SyntheticCatalog()
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle = throttle
+        self.error = error
+        self.reset = reset
+        self.malformed = malformed
+        self.compress = compress
+        self.requests = Counter()
+        self.faults = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.fipe = self
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def url(self):
+        """Base URL to pass to `Fipe(base_url=...)`."""
+        host, port = self._httpd.server_address[:2]
+        return 'http://{}:{:d}'.format(host, port)
+
+    def start(self):
+        """Serves requests from a background thread."""
+        self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                        name='fipe-server', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops serving and closes the listening socket."""
+        if self._thread is not None:
+            self._httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._httpd.server_close()
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests.clear()
+            self.faults.clear()
+
+    def answer(self, endpoint, params):
+        """Returns status and JSON data or the fault injected."""
+        with self._lock:
+            self.requests[endpoint] += 1
+            draws = [self._random.random() for _ in range(4)]
+            delay = self.latency * (1 + self.jitter * (
+                2 * self._random.random() - 1))
+        if delay > 0:
+            time.sleep(delay)
+        for fault, rate, draw in zip(
+                ('reset', 'throttle', 'error', 'malformed'),
+                (self.reset, self.throttle, self.error, self.malformed),
+                draws):
+            if draw < rate:
+                with self._lock:
+                    self.faults[fault] += 1
+                return fault, None
+        try:
+            return 200, self._dispatch(endpoint, params)
+        except (KeyError, ValueError):
+            return 400, None
+
+    def _dispatch(self, endpoint, params):
+        catalog = self.catalog
+        if endpoint == 'ConsultarTabelaDeReferencia':
+            return catalog.reference_tables()
+        table = int(params['codigoTabelaReferencia'])
+        vehicle_type = int(params['codigoTipoVeiculo'])
+        if endpoint == 'ConsultarMarcas':
+            return catalog.makers_of(table, vehicle_type)
+        maker = int(params['codigoMarca'])
+        if endpoint == 'ConsultarModelos':
+            return catalog.models_of(table, vehicle_type, maker)
+        model = int(params['codigoModelo'])
+        if endpoint == 'ConsultarAnoModelo':
+            return catalog.years_of(table, vehicle_type, maker, model)
+        if endpoint == 'ConsultarValorComTodosParametros':
+            if VEHICLE_TYPES[vehicle_type] != params['tipoVeiculo']:
+                raise ValueError('Vehicle type mismatch')
+            return catalog.price_of(table, vehicle_type, maker, model,
+                                    int(params['anoModelo']),
+                                    int(params['codigoTipoCombustivel']))
+        raise KeyError(endpoint)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body leave in one segment, without delayed ACK stalls.
+    disable_nagle_algorithm = True
+    wbufsize = -1
+    prefix = '/api/veiculos/'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8')
+        if not self.path.startswith(self.prefix):
+            return self._respond(404, b'')
+        params = {k: v[0] for k, v in parse_qs(body).items()}
+        server = self.server.fipe
+        status, result = server.answer(self.path[len(self.prefix):], params)
+        if status == 'reset':
+            # Closes with RST instead of FIN.
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                       struct.pack('ii', 1, 0))
+            self.close_connection = True
+            return
+        if status == 'throttle':
+            return self._respond(429, b'', {'Retry-After': '1'})
+        if status == 'error':
+            return self._respond(500, b'')
+        content = json.dumps(result).encode('utf-8')
+        if status == 'malformed':
+            status, content = 200, content[:len(content) // 2]
+        if status != 200:
+            return self._respond(status, b'')
+        headers = {'Content-Type': 'application/json; charset=utf-8'}
+        if server.compress and \
+                'gzip' in self.headers.get('Accept-Encoding', ''):
+            content = gzip.compress(content, 6)
+            headers['Content-Encoding'] = 'gzip'
+        self._respond(200, content, headers)
+
+    def _respond(self, status, content, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
@@ -1,14 +1,32 @@
 """This module test the Fipe scraper class.
 
 """
+import csv
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
+from concurrent.futures import ThreadPoolExecutor
 from unittest import mock
 
-from scrapers import fipe
+from scrapers import fipe, fipe_cli, fipe_db, fipe_http
+from tests import bench_fipe
+from tests.fipe_server import FipeServer, SyntheticCatalog
 
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 
-# The method bellow will be used by the mock to replace requests.post
+
+# The method bellow will be used by the mock to replace requests.Session.post
 def mocked_requests_post(*args, **kwargs):
     class MockResponse:
         def __init__(self, json_data, status_code):
@@ -48,6 +66,81 @@ def mocked_requests_post(*args, **kwargs):
         return MockResponse(None, 404)
 
 
+# Payload dependent responses with random latency, so that concurrent
+# requests finish out of order.
+def mocked_catalog_post(*args, **kwargs):
+    class MockResponse:
+        def __init__(self, json_data, status_code=200):
+            self.json_data = json_data
+            self.status_code = status_code
+            self.headers = {}
+            self.content = json.dumps(json_data).encode('utf-8')
+
+        def json(self):
+            return self.json_data
+
+    time.sleep(random.random() / 1000)
+    data = kwargs.get('data') or {}
+    if args[0].endswith('ConsultarMarcas'):
+        return MockResponse([{'Label': 'Maker {}'.format(i), 'Value': str(i)}
+                             for i in (1, 2)])
+    elif args[0].endswith('ConsultarModelos'):
+        return MockResponse({'Modelos': [
+            {'Label': 'Model {}'.format(i),
+             'Value': 100 * data['codigoMarca'] + i} for i in (1, 2, 3)],
+            'Anos': []})
+    elif args[0].endswith('ConsultarAnoModelo'):
+        return MockResponse([{'Label': '{} Gasolina'.format(year),
+                              'Value': '{}-1'.format(year)}
+                             for year in (2010, 2011, 2012)])
+    elif args[0].endswith('ConsultarValorComTodosParametros'):
+        value = 1000 * data['codigoModelo'] + data['anoModelo'] - 2000
+        return MockResponse({'Valor': 'R$ {},00'.format(value),
+                             'CodigoFipe': '{:06d}-1'.format(
+                                 data['codigoModelo'])})
+    else:
+        return MockResponse(None, 404)
+
+
+def mocked_failing_post(*args, **kwargs):
+    data = kwargs.get('data') or {}
+    if (data.get('codigoModelo') == 102 and data.get('anoModelo') == 2011):
+        raise fipe.requests.ConnectionError('Connection reset by peer')
+    return mocked_catalog_post(*args, **kwargs)
+
+
+def mocked_planner_post(*args, **kwargs):
+    """Catalog where maker 2 has one model and Anos lists all years."""
+    class MockResponse:
+        def __init__(self, json_data, status_code=200):
+            self.json_data = json_data
+            self.status_code = status_code
+
+        def json(self):
+            return self.json_data
+
+    data = kwargs.get('data') or {}
+    years = [{'Label': '{} Gasolina'.format(year),
+              'Value': '{}-1'.format(year)} for year in (2012, 2011, 2010)]
+    if args[0].endswith('ConsultarModelos'):
+        models = (1, 2, 3) if data['codigoMarca'] == 1 else (1,)
+        if data['codigoTabelaReferencia'] == 220 and \
+                data['codigoMarca'] == 1:
+            models += (4,)
+        return MockResponse({'Modelos': [
+            {'Label': 'Model {}'.format(i),
+             'Value': 100 * data['codigoMarca'] + i} for i in models],
+            'Anos': years})
+    elif args[0].endswith('ConsultarAnoModelo'):
+        return MockResponse(years)
+    elif (args[0].endswith('ConsultarValorComTodosParametros') and
+            data['codigoTabelaReferencia'] == 219 and
+            data['codigoModelo'] == 101 and data['anoModelo'] == 2010):
+        return MockResponse({'codigoRetorno': 0,
+                             'erro': 'nadaencontrado'})
+    return mocked_catalog_post(*args, **kwargs)
+
+
 class TestVariables(unittest.TestCase):
     def setUp(self):
         """Sets-up the test environment."""
@@ -82,6 +175,50 @@ class TestVariables(unittest.TestCase):
         self.assertEqual(self.car_model.maker.vehicle_type, 1)
         self.assertEqual(self.car_model.prices, [])
 
+    def test_price_list(self):
+        """Stores prices column-wise behind the car price interface."""
+        self.car_model.add_price(2008, 1)
+        self.car_model.add_price(32000, 3)
+        self.car_model.update_price(1, price=22923.0, fipe_code='025128-3')
+        prices = self.car_model.prices
+        self.assertEqual(len(prices), 2)
+        self.assertIsInstance(prices[0], fipe.CarPrice)
+        self.assertFalse(hasattr(prices[0], '__dict__'))
+        self.assertEqual(repr(prices[-1]),
+                         "CarPrice(32000, 3, price=22923.0, "
+                         "fipe_code='025128-3')")
+        # Car prices are hashable, comparing by identity.
+        self.assertEqual(len({prices[0], prices[0], fipe.CarPrice(2008, 1),
+                              fipe.CarPrice(2008, 1)}), 4)
+        self.assertEqual([p.build_year for p in prices], [2008, 32000])
+        self.assertEqual(prices, [fipe.CarPrice(2008, 1),
+                                  fipe.CarPrice(32000, 3, 22923.0,
+                                                '025128-3')])
+        # Items write through to the list, as list items of car prices.
+        prices[0].price = 1.5
+        prices[-1].fipe_code = None
+        prices.append(fipe.CarPrice(2010, 1, 2.5))
+        self.assertEqual(self.car_model.prices, [
+            fipe.CarPrice(2008, 1, 1.5), fipe.CarPrice(32000, 3, 22923.0),
+            fipe.CarPrice(2010, 1, 2.5)])
+        prices[2] = fipe.CarPrice(2011, 1)
+        self.assertEqual((prices[2].build_year, prices[2].price), (2011, None))
+        with self.assertRaises(IndexError):
+            prices[3]
+        with self.assertRaises(AttributeError):
+            self.car_model.update_price(0, foo=1)
+        with self.assertRaises(AttributeError):
+            self.car_model.foo = 1
+
+    def test_intern(self):
+        """Shares table and car maker objects."""
+        table = fipe.Table.intern(218, 2017, 'outubro')
+        self.assertIs(fipe.Table.intern(218, 2017, 10), table)
+        self.assertIsNot(fipe.Table.intern(219, 2017, 11), table)
+        maker = fipe.CarMaker.intern(1, 'Acura', table)
+        self.assertIs(fipe.CarMaker.intern(1, 'Acura', table), maker)
+        self.assertIsNot(fipe.CarMaker.intern(1, 'Acura', table, 2), maker)
+
     def tearDown(self):
         """Shuts down the test environment."""
         pass
@@ -100,9 +237,9 @@ class TestFipe(unittest.TestCase):
         self.expected_price = fipe.CarPrice(2008, 1, price=22923.0,
                                                      fipe_code='025128-3')
 
-    # We patch 'requests.post' with our own method. The mock object is passed
-    # in to our test case method.
-    @mock.patch('scrapers.fipe.requests.post',
+    # We patch 'requests.Session.post' with our own method. The mock object is
+    # passed in to our test case method.
+    @mock.patch('scrapers.fipe.requests.Session.post',
                 side_effect=mocked_requests_post)
     def test_crawl_reference_tables(self, mock_post):
         """Loads remote list of reference tables."""
@@ -114,7 +251,7 @@ class TestFipe(unittest.TestCase):
         self.assertEqual(tables[0].year, self.expected_table.year)
         self.assertEqual(tables[0].month, self.expected_table.month)
 
-    @mock.patch('scrapers.fipe.requests.post',
+    @mock.patch('scrapers.fipe.requests.Session.post',
                 side_effect=mocked_requests_post)
     def test_crawl_makers(self, mock_post):
         """Loads list of car makers."""
@@ -132,7 +269,7 @@ class TestFipe(unittest.TestCase):
         self.assertEqual(makers[0].vehicle_type,
                          self.expected_car_maker.vehicle_type)
 
-    @mock.patch('scrapers.fipe.requests.post',
+    @mock.patch('scrapers.fipe.requests.Session.post',
                 side_effect=mocked_requests_post)
     def test_crawl_models(self, mock_post):
         """Loads list of car models."""
@@ -143,12 +280,13 @@ class TestFipe(unittest.TestCase):
         self.assertEqual(models[0].id, self.expected_car_model.id)
         self.assertEqual(models[0].name, self.expected_car_model.name)
 
-    @mock.patch('scrapers.fipe.requests.post',
+    @mock.patch('scrapers.fipe.requests.Session.post',
                 side_effect=mocked_requests_post)
     def test_crawl_model_year(self, mock_post):
         """Loads list of make year by car models."""
         self.fipe.crawl_model_year(self.expected_car_model)
-        self.assertIsInstance(self.expected_car_model.prices, list)
+        self.assertIsInstance(self.expected_car_model.prices,
+                              fipe.PriceList)
         self.assertEqual(len(self.expected_car_model.prices), 1)
         self.assertIsInstance(self.expected_car_model.prices[0],
                               fipe.CarPrice)
@@ -157,13 +295,14 @@ class TestFipe(unittest.TestCase):
         self.assertEqual(self.expected_car_model.prices[0].fuel_type,
                          self.expected_price.fuel_type)
 
-    @mock.patch('scrapers.fipe.requests.post',
+    @mock.patch('scrapers.fipe.requests.Session.post',
                 side_effect=mocked_requests_post)
     def test_crawl_model_price(self, mock_post):
         """Loads list of car models."""
         self.fipe.crawl_model_year(self.expected_car_model)
         self.fipe.crawl_model_price(self.expected_car_model)
-        self.assertIsInstance(self.expected_car_model.prices, list)
+        self.assertIsInstance(self.expected_car_model.prices,
+                              fipe.PriceList)
         self.assertEqual(len(self.expected_car_model.prices), 1)
         self.assertIsInstance(self.expected_car_model.prices[0],
                               fipe.CarPrice)
@@ -176,9 +315,1260 @@ class TestFipe(unittest.TestCase):
         self.assertEqual(self.expected_car_model.prices[0].fipe_code,
                          self.expected_price.fipe_code)
 
+    @mock.patch('scrapers.fipe.requests.Session.post',
+                side_effect=mocked_requests_post)
+    def test_session_reuse(self, mock_post):
+        """Reuses the same pooled session across crawl methods."""
+        session = self.fipe.session
+        makers = self.fipe.crawl_makers(table=self.expected_table)
+        self.fipe.crawl_models(makers[0])
+        self.assertIs(self.fipe.session, session)
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertEqual(mock_post.call_args[1]['timeout'], self.fipe.timeout)
+
+    def test_context_manager(self):
+        """Closes the session when leaving the context."""
+        with fipe.Fipe(pool_maxsize=2, compress=False) as f:
+            self.assertEqual(f.session.headers['Accept-Encoding'], 'identity')
+            self.assertEqual(f.session.get_adapter(f.base_url)._pool_maxsize,
+                             2)
+        self.assertIsNone(f.session)
+
     def tearDown(self):
         """Shuts down the test environment."""
-        pass
+        self.fipe.close()
+
+
+class TestConcurrentCrawl(unittest.TestCase):
+    def setUp(self):
+        """Sets-up the test environment."""
+        self.fipe = fipe.Fipe(max_workers=8)
+        maker = fipe.CarMaker(1, 'Acura', fipe.Table())
+        self.models = [fipe.CarModel(i, str(i), maker) for i in range(1, 21)]
+
+    @mock.patch('scrapers.fipe.requests.Session.post',
+                side_effect=mocked_catalog_post)
+    def test_crawl_prices(self, mock_post):
+        """Crawls years and prices concurrently in deterministic order."""
+        models = self.fipe.crawl_prices(self.models)
+        self.assertEqual(models, self.models)
+        self.assertEqual(mock_post.call_count, 20 + 20 * 3)
+        for model in models:
+            self.assertEqual([p.build_year for p in model.prices],
+                             [2010, 2011, 2012])
+            self.assertEqual([p.price for p in model.prices],
+                             [1000. * model.id + y for y in (10, 11, 12)])
+            self.assertEqual(model.prices[0].fipe_code,
+                             '{:06d}-1'.format(model.id))
+
+    @mock.patch('scrapers.fipe.requests.Session.post',
+                side_effect=mocked_catalog_post)
+    def test_imap_bounded(self, mock_post):
+        """Keeps input order and bounds the number of calls in flight."""
+        state = {'running': 0, 'peak': 0}
+        lock = threading.Lock()
+
+        def work(i):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            time.sleep(random.random() / 1000)
+            with lock:
+                state['running'] -= 1
+            return i
+
+        result = list(self.fipe._imap(work, range(100), max_workers=4))
+        self.assertEqual(result, list(range(100)))
+        self.assertLessEqual(state['peak'], 4)
+
+    def test_call_workers(self):
+        """Raises the in-flight limit to the `max_workers` of a call."""
+        state = {'running': 0, 'peak': 0}
+        lock = threading.Lock()
+
+        def post(*args, **kwargs):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            time.sleep(0.005)
+            with lock:
+                state['running'] -= 1
+            return mocked_catalog_post(*args, **kwargs)
+
+        with mock.patch('scrapers.fipe.requests.Session.post',
+                        side_effect=post), fipe.Fipe() as f:
+            f.crawl_prices(self.models, max_workers=4)
+            self.assertEqual(state['peak'], 4)
+            state['peak'] = 0
+            f.crawl_prices(self.models[:2])
+            self.assertEqual(state['peak'], 1)
+
+    @mock.patch('scrapers.fipe.requests.Session.post',
+                side_effect=mocked_catalog_post)
+    def test_iter_table(self, mock_post):
+        """Streams flat price records of a whole reference table."""
+        records = self.fipe.iter_table(fipe.Table())
+        first = next(records)
+        self.assertIsInstance(first, fipe.PriceRecord)
+        self.assertEqual(first, (218, 1, 1, 'Maker 1', 101, 'Model 1', 2010,
+                                 1, 101010.0, '000101-1'))
+        records = [first] + list(records)
+        self.assertEqual(len(records), 2 * 3 * 3)
+        self.assertEqual([(r.model_id, r.build_year) for r in records],
+                         [(100 * i + j, y) for i in (1, 2) for j in (1, 2, 3)
+                          for y in (2010, 2011, 2012)])
+        self.assertEqual(mock_post.call_count, 1 + 2 + 6 + 18)
+
+    @mock.patch('scrapers.fipe.requests.Session.post',
+                side_effect=mocked_catalog_post)
+    def test_vehicle_types(self, mock_post):
+        """Interleaves makers of all vehicle types in a single pass."""
+        records = list(self.fipe.iter_table(
+            fipe.Table(), vehicle_type=fipe.Fipe.vehicle_types))
+        self.assertEqual(len(records), 3 * 2 * 3 * 3)
+        self.assertEqual([(r.vehicle_type, r.maker_id) for r in records[::9]],
+                         [(1, 1), (2, 1), (3, 1), (1, 2), (2, 2), (3, 2)])
+        descriptors = {(c[1]['data']['codigoTipoVeiculo'],
+                        c[1]['data']['tipoVeiculo'])
+                       for c in mock_post.call_args_list
+                       if 'tipoVeiculo' in (c[1]['data'] or {})}
+        self.assertEqual(descriptors, {(1, 'carro'), (2, 'moto'),
+                                       (3, 'caminhao')})
+        with self.assertRaises(ValueError):
+            next(self.fipe.iter_table(fipe.Table(), vehicle_type=(1, 4)))
+
+    def tearDown(self):
+        """Shuts down the test environment."""
+        self.fipe.close()
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        """Sets-up the test environment."""
+        self.fipe = fipe.Fipe(max_workers=4,
+                              retry=fipe_http.RetryPolicy(max_attempts=1))
+        self.db = fipe_db.Fipe_db()
+        self.db.create_schema()
+
+    @mock.patch('scrapers.fipe.requests.Session.post',
+                side_effect=mocked_catalog_post)
+    def test_resume_interrupted(self, mock_post):
+        """Resumes an interrupted crawl without repeating done units."""
+        records = self.fipe.iter_table(fipe.Table(), checkpoint=self.db)
+        first = [next(records) for _ in range(5)]
+        records.close()
+        self.db.ingest(first[:4])
+        mock_post.reset_mock()
+        rest = list(self.fipe.iter_table(fipe.Table(), checkpoint=self.db))
+        self.db.ingest(rest)
+        # The fifth record was not stored by the consumer.
+        self.assertEqual(rest[0], first[-1])
+        self.assertEqual(len(first) - 1 + len(rest), 18)
+        # Built years of recorded models are not crawled again.
+        urls = [call[0][0] for call in mock_post.call_args_list]
+        self.assertLess(sum(url.endswith('ConsultarAnoModelo')
+                            for url in urls), 6)
+        self.assertEqual(sum(url.endswith('ConsultarValorComTodosParametros')
+                             for url in urls), 14)
+        self.assertEqual(list(self.fipe.iter_table(fipe.Table(),
+                                                   checkpoint=self.db)), [])
+
+    def test_retry_failed(self):
+        """Records failed units and requests them on restart."""
+        with mock.patch('scrapers.fipe.requests.Session.post',
+                        side_effect=mocked_failing_post):
+            records = list(self.fipe.iter_table(fipe.Table(),
+                                                checkpoint=self.db))
+        self.assertEqual(len(records), 17)
+        units = self.db.get_crawl_units(218, 1, 1, 102)
+        self.assertEqual(units, [(2010, 1, 'pending'), (2011, 1, 'failed'),
+                                 (2012, 1, 'pending')])
+        self.db.ingest(records)
+        units = self.db.get_crawl_units(218, 1, 1, 102)
+        self.assertEqual(units, [(2010, 1, 'done'), (2011, 1, 'failed'),
+                                 (2012, 1, 'done')])
+        with mock.patch('scrapers.fipe.requests.Session.post',
+                        side_effect=mocked_catalog_post) as mock_post:
+            records = list(self.fipe.iter_table(fipe.Table(),
+                                                checkpoint=self.db))
+        self.assertEqual([(r.model_id, r.build_year) for r in records],
+                         [(102, 2011)])
+        self.assertEqual(mock_post.call_count, 1 + 2 + 1)
+
+    @mock.patch('scrapers.fipe.requests.Session.post',
+                side_effect=mocked_catalog_post)
+    def test_done_on_commit(self, mock_post):
+        """Marks units as done once their prices are committed."""
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'fipe.db')
+            # The writer is the only connection writing to the database.
+            with fipe_db.DbWriter(filename, max_delay=60.) as writer:
+                for record in self.fipe.iter_table(fipe.Table(),
+                                                   checkpoint=writer):
+                    writer.write(record)
+                self.assertNotIn('done', [
+                    status for *_, status in writer.get_crawl_units(
+                        218, 1, 1, 102)])
+                writer.flush()
+                self.assertEqual(writer.get_crawl_units(218, 1, 1, 102),
+                                 [(2010, 1, 'done'), (2011, 1, 'done'),
+                                  (2012, 1, 'done')])
+            mock_post.reset_mock()
+            with fipe_db.DbWriter(filename) as writer:
+                self.assertEqual(list(self.fipe.iter_table(
+                    fipe.Table(), checkpoint=writer)), [])
+            self.assertFalse(any(c[0][0].endswith('ComTodosParametros')
+                                 for c in mock_post.call_args_list))
+
+    def test_max_attempts(self):
+        """Gives up with a typed exception after all attempts."""
+        with mock.patch('scrapers.fipe.requests.Session.post',
+                        side_effect=mocked_failing_post):
+            model = fipe.CarModel(102, None, fipe.CarMaker(1, None,
+                                                           fipe.Table()))
+            model.add_price(2011, 1)
+            with self.assertRaises(fipe_http.FipeRequestError):
+                self.fipe.crawl_model_price(model)
+
+    def tearDown(self):
+        """Shuts down the test environment."""
+        self.fipe.close()
+        self.db.close()
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        """Sets-up the test environment."""
+        self.cache = fipe_http.ResponseCache()
+        self.url = 'http://veiculos.fipe.org.br/api/veiculos/ConsultarMarcas'
+
+    @mock.patch('scrapers.fipe.requests.Session.post',
+                side_effect=mocked_catalog_post)
+    def test_crawl_cached(self, mock_post):
+        """Serves repeated crawls from the cache."""
+        with fipe.Fipe(cache=self.cache) as f:
+            records = list(f.iter_table(fipe.Table()))
+            self.assertEqual(mock_post.call_count, 27)
+            self.assertEqual(list(f.iter_table(fipe.Table())), records)
+        self.assertEqual(mock_post.call_count, 27)
+        self.assertEqual(self.cache.hits, 27)
+        self.assertEqual(self.cache.misses, 27)
+        self.assertEqual(self.cache.stats()['entries'], 27)
+
+    def test_key_normalization(self):
+        """Ignores order of form data and fields set to `None`."""
+        self.cache.set(self.url, {'a': 1, 'b': None, 'c': 'x'}, [1])
+        self.assertEqual(self.cache.get(self.url, {'c': 'x', 'a': '1'}), [1])
+        self.assertIsNone(self.cache.get(self.url, {'a': 2, 'c': 'x'}))
+
+    def test_closed_tables_immutable(self):
+        """Expires responses of the latest table only."""
+        self.cache.ttl['ConsultarMarcas'] = 0
+        self.cache.latest_table = 219
+        self.cache.set(self.url, {'codigoTabelaReferencia': 218}, [218])
+        self.cache.set(self.url, {'codigoTabelaReferencia': 219}, [219])
+        time.sleep(0.01)
+        self.assertEqual(self.cache.get(
+            self.url, {'codigoTabelaReferencia': 218}), [218])
+        self.assertIsNone(self.cache.get(
+            self.url, {'codigoTabelaReferencia': 219}))
+
+    def test_lru_eviction(self):
+        """Evicts least recently used responses beyond maximum size."""
+        for i in range(10):
+            self.cache.set(self.url, {'i': i}, list(range(100)))
+            time.sleep(0.001)
+        size = self.cache.size
+        self.cache.max_size = size
+        self.cache.get(self.url, {'i': 0})
+        self.cache.set(self.url, {'i': 10}, list(range(100)))
+        self.assertLessEqual(self.cache.size, size)
+        self.assertIsNotNone(self.cache.get(self.url, {'i': 0}))
+        self.assertIsNone(self.cache.get(self.url, {'i': 1}))
+
+    def tearDown(self):
+        """Shuts down the test environment."""
+        self.cache.close()
+
+
+class TestPacing(unittest.TestCase):
+    def test_retry_policy(self):
+        """Caps and jitters backoff and bounds the number of attempts."""
+        retry = fipe_http.RetryPolicy(max_attempts=3, base=1., cap=4.)
+        for attempt in range(1, 10):
+            self.assertLessEqual(retry.delay(attempt),
+                                 min(4., 2 ** (attempt - 1)))
+        self.assertFalse(retry.exhausted(2))
+        self.assertTrue(retry.exhausted(3))
+        retry = fipe_http.RetryPolicy(base=1., cap=4., jitter=False)
+        self.assertEqual([retry.delay(i) for i in range(1, 6)],
+                         [1., 2., 4., 4., 4.])
+
+    def test_rate_limiter(self):
+        """Increases rate additively and decreases it multiplicatively."""
+        limiter = fipe_http.RateLimiter(rate=10., increase=1., cooldown=0.,
+                                        latency_target=1.)
+        for _ in range(10):
+            limiter.feedback(True, 0.1)
+        self.assertAlmostEqual(limiter.rate, 11., places=1)
+        limiter.feedback(True, 2.)
+        self.assertAlmostEqual(limiter.rate, 5.5, places=1)
+        limiter.feedback(False)
+        self.assertAlmostEqual(limiter.rate, 2.75, places=1)
+        limiter.rate = 200.
+        start = time.monotonic()
+        for _ in range(11):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.045)
+
+    def test_circuit_breaker(self):
+        """Opens after consecutive failures and probes after cooldown."""
+        breaker = fipe_http.CircuitBreaker(threshold=2, cooldown=0.05,
+                                           block=False)
+        breaker.record(False)
+        breaker.wait()
+        breaker.record(False)
+        self.assertEqual(breaker.state, 'open')
+        with self.assertRaises(fipe_http.CircuitOpenError):
+            breaker.wait()
+        time.sleep(0.06)
+        breaker.wait()
+        self.assertEqual(breaker.state, 'half-open')
+        with self.assertRaises(fipe_http.CircuitOpenError):
+            breaker.wait()
+        breaker.record(True)
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_retry_throttled(self):
+        """Retries throttled responses and feeds back to the limiter."""
+        responses = [mock.Mock(status_code=429), mock.Mock(status_code=503),
+                     mock.Mock(status_code=200, **{'json.return_value': []})]
+        limiter = fipe_http.RateLimiter(rate=1000., cooldown=0.)
+        retry = fipe_http.RetryPolicy(base=0.001)
+        with mock.patch('scrapers.fipe.requests.Session.post',
+                        side_effect=responses) as mock_post, \
+                fipe.Fipe(retry=retry, limiter=limiter) as f:
+            self.assertEqual(f.crawl_makers(table=fipe.Table()), [])
+        self.assertEqual(mock_post.call_count, 3)
+        self.assertLess(limiter.rate, 300.)
+
+    def test_breaker_unexpected_error(self):
+        """Records probes failing with any request error."""
+        error = fipe.requests.exceptions.ContentDecodingError('gzip')
+        responses = [error, error,
+                     mock.Mock(status_code=200, **{'json.return_value': []})]
+        retry = fipe_http.RetryPolicy(max_attempts=2, base=0.02, jitter=False)
+        breaker = fipe_http.CircuitBreaker(threshold=1, cooldown=0.01,
+                                           block=False)
+        with mock.patch('scrapers.fipe.requests.Session.post',
+                        side_effect=responses), \
+                fipe.Fipe(retry=retry, breaker=breaker) as f:
+            with self.assertRaises(fipe_http.FipeRequestError):
+                f.crawl_makers(table=fipe.Table())
+            time.sleep(0.02)
+            self.assertEqual(f.crawl_makers(table=fipe.Table()), [])
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_retry_after(self):
+        """Waits at least as long as throttled responses ask for."""
+        responses = [mock.Mock(status_code=429,
+                               headers={'Retry-After': '0.1'}),
+                     mock.Mock(status_code=200, **{'json.return_value': []})]
+        retry = fipe_http.RetryPolicy(base=0.001)
+        start = time.monotonic()
+        with mock.patch('scrapers.fipe.requests.Session.post',
+                        side_effect=responses), \
+                fipe.Fipe(retry=retry) as f:
+            self.assertEqual(f.crawl_makers(table=fipe.Table()), [])
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+        past = mock.Mock(headers={
+            'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+        self.assertEqual(fipe_http._retry_after(past), 0.)
+        self.assertEqual(retry.delay(1, 5.), 5.)
+        # Waits asked for by the server are bounded by the cap.
+        self.assertEqual(retry.delay(1, 86400.), 60.)
+
+
+class TestFipeDb(unittest.TestCase):
+    def setUp(self):
+        """Sets-up the test environment."""
+        self.db = fipe_db.Fipe_db()
+        self.db.create_schema()
+
+    def test_import(self):
+        """Keeps the database importable from the crawler module."""
+        self.assertIs(fipe.Fipe_db, fipe_db.Fipe_db)
+
+    @mock.patch('scrapers.fipe.requests.Session.post',
+                side_effect=mocked_catalog_post)
+    def test_ingest(self, mock_post):
+        """Ingests crawled price records in batches."""
+        with fipe.Fipe(max_workers=4) as f:
+            records = list(f.iter_table(fipe.Table()))
+        self.db.add_tables([fipe.Table()])
+        self.assertEqual(self.db.ingest(iter(records), batch_size=5), 18)
+        count = self.db.cursor.execute(
+            'SELECT (SELECT COUNT(*) FROM maker), (SELECT COUNT(*) FROM '
+            'model), (SELECT COUNT(*) FROM price)').fetchone()
+        self.assertEqual(count, (2, 6, 18))
+        self.assertEqual(self.db.cursor.execute(
+            'SELECT price, fipe_code FROM price WHERE model_id = 203 AND '
+            'build_year = 2011').fetchone(), (20301100, '000203-1'))
+        self.assertEqual(self.db.cursor.execute(
+            'SELECT year, month FROM reference_table').fetchall(),
+            [(2017, 10)])
+        # Ingesting again replaces prices.
+        self.db.ingest([records[0]._replace(price=1.5)])
+        self.assertEqual(self.db.cursor.execute(
+            'SELECT COUNT(*), MIN(price) FROM price').fetchone(), (18, 150))
+
+    def test_queries(self):
+        """Looks up prices and price histories by Fipe code."""
+        self.db.add_tables([fipe.Table(218, 2017, 10),
+                            fipe.Table(219, 2017, 11)])
+        self.db.ingest(fipe.PriceRecord(t, 1, 1, 'A', m, 'M', y, 1,
+                                        t * 10. + y - 2000,
+                                        '{:06d}-1'.format(m))
+                       for t in (218, 219) for m in (1, 2)
+                       for y in (2010, 2011))
+        self.assertEqual(self.db.get_price('000001-1', 2011, 1, 219), 2201.)
+        self.assertIsNone(self.db.get_price('000001-1', 2012, 1, 219))
+        self.assertEqual(self.db.get_price_history('000002-1', 2010),
+                         [(218, 2017, 10, 2010, 1, 2190.),
+                          (219, 2017, 11, 2010, 1, 2200.)])
+        self.assertEqual(len(self.db.get_price_history('000002-1')), 4)
+        keys = [('000002-1', 2011, 1, 218), ('000009-1', 2011, 1, 218),
+                ('000001-1', 2011, 1, 219)]
+        self.assertEqual(self.db.get_prices(keys), [2191., None, 2201.])
+        self.assertEqual(self.db.lookups.hits, 1)
+        self.assertEqual(self.db.get_prices(keys), [2191., None, 2201.])
+        self.assertEqual(self.db.lookups.hits, 4)
+        # Ingesting invalidates cached lookups.
+        self.db.ingest([fipe.PriceRecord(218, 1, 1, 'A', 9, 'M', 2011, 1, 1.,
+                                         '000009-1')])
+        self.assertEqual(len(self.db.lookups), 0)
+        self.assertEqual(self.db.get_prices(keys), [2191., 1., 2201.])
+
+    def test_reader_cache(self):
+        """Drops cached lookups of readers when a writer commits."""
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'fipe.db')
+            writer = fipe_db.Fipe_db(filename)
+            writer.create_schema()
+            reader = fipe_db.Fipe_db(filename)
+            record = fipe.PriceRecord(218, 1, 1, 'A', 1, 'M', 2010, 1, 1.,
+                                      '000001-1')
+            key = ('000001-1', 2010, 1, 218)
+            self.assertIsNone(reader.get_price(*key))
+            self.assertIsNone(reader.get_price(*key))
+            self.assertEqual(reader.lookups.hits, 1)
+            writer.ingest([record])
+            self.assertEqual(reader.get_price(*key), 1.)
+            writer.ingest([record._replace(price=2.)])
+            self.assertEqual(reader.get_price(*key), 2.)
+            reader.close()
+            writer.close()
+
+    def test_change_storage(self):
+        """Stores prices only when they change and rebuilds snapshots."""
+        tables = [fipe.Table(218 + i, 2017, 10 + i) for i in range(3)]
+        tables.append(fipe.Table(221, 2018, 1))
+        prices = {1: (100., 100., 150., 100.), 2: (200.,) * 4,
+                  3: (300., 300., None, 300.)}
+        records = [fipe.PriceRecord(t.id, 1, 1, 'A', m, 'M', 2010, 1,
+                                    p[i], '{:06d}-1'.format(m))
+                   for i, t in enumerate(tables)
+                   for m, p in sorted(prices.items())
+                   if p[i] is not None]
+        changes = fipe_db.Fipe_db(storage='changes')
+        changes.create_schema()
+        changes.add_tables(tables)
+        self.db.add_tables(tables)
+        self.db.ingest(records)
+        # Tables in any order, model 3 is missing from table 220.
+        order = sorted(records, key=lambda r: (r.table == 220, r.table))
+        self.assertEqual(changes.ingest(order, batch_size=4), 11)
+        count = 'SELECT COUNT(*) FROM price_version'
+        self.assertEqual(changes.cursor.execute(count).fetchone(), (6,))
+        for table in tables:
+            self.assertEqual(list(changes.iter_records(table.id)),
+                             list(self.db.iter_records(table.id)))
+        keys = [('{:06d}-1'.format(m), 2010, 1, t.id)
+                for m in prices for t in tables]
+        self.assertEqual(changes.get_prices(keys), self.db.get_prices(keys))
+        self.assertEqual(changes.get_price_history('000003-1'),
+                         self.db.get_price_history('000003-1'))
+        # A corrected table merges versions.
+        changes.ingest([records[6]._replace(price=100.)])
+        self.assertEqual(changes.cursor.execute(count).fetchone(), (4,))
+        self.assertEqual(changes.get_price('000001-1', 2010, 1, 220), 100.)
+        changes.close()
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'fipe.db')
+            fipe_db.Fipe_db(filename, storage='changes').create_schema()
+            self.assertEqual(fipe_db.Fipe_db(filename).storage, 'changes')
+
+    def test_aggregates(self):
+        """Maintains price indices and depreciation curves on ingest."""
+        tables = [fipe.Table(218, 2017, 10), fipe.Table(219, 2017, 11)]
+        prices = [(1, 1, 2015, (80., 88.)), (1, 1, 2016, (100., 110.)),
+                  (1, 2, 2016, (150., 150.)), (1, 2, 2017, (200., 200.)),
+                  (2, 3, 2016, (100., 50.))]
+        records = [fipe.PriceRecord(t.id, 1, maker, 'A', model, 'M', year, 1,
+                                    p[i], '{:06d}-1'.format(model))
+                   for i, t in enumerate(tables)
+                   for maker, model, year, p in prices]
+        snapshot = fipe_db.Fipe_db(aggregates=True)
+        changes = fipe_db.Fipe_db(storage='changes', aggregates=True)
+        for db in (snapshot, changes):
+            db.create_schema()
+            db.add_tables(tables)
+            db.ingest(records, batch_size=3)
+            self.assertEqual(db.get_price_index(maker_id=1),
+                             [(219, 2017, 11, 4, 548 / 530, 548 / 530)])
+            self.assertEqual(db.get_price_index(),
+                             [(219, 2017, 11, 5, 598 / 630, 598 / 630)])
+            self.assertEqual(db.get_depreciation(maker_id=1),
+                             [(1, 1, 0.75, 0.75), (2, 1, 0.8, 0.75 * 0.8)])
+            self.assertEqual(db.get_depreciation(table_id=218)[0][:3],
+                             (1, 1, 0.75))
+            # Ingesting again replaces the pairs of the prices changed.
+            db.ingest([records[-1]._replace(price=100.)])
+            self.assertEqual(db.get_price_index()[0][3:5], (5, 648 / 630))
+            index = db.get_price_index()
+            db.rebuild_aggregates()
+            self.assertEqual(db.get_price_index(), index)
+        changes.close()
+        # Aggregates are built for databases created without them.
+        snapshot.cursor.executescript('DROP TABLE maker_price_change; '
+                                      'DROP TABLE maker_depreciation;')
+        snapshot.create_schema()
+        self.assertEqual(snapshot.get_price_index(), index)
+        snapshot.close()
+        # Without aggregates, they are built once after ingest.
+        self.db.add_tables(tables)
+        self.db.ingest(records[:-1] + [records[-1]._replace(price=100.)])
+        self.assertFalse(self.db._has_aggregates())
+        self.db.rebuild_aggregates()
+        self.assertEqual(self.db.get_price_index(), index)
+        self.db.ingest(records[-1:])
+        self.assertEqual(self.db.get_price_index()[0][3:5], (5, 598 / 630))
+
+    def test_writer(self):
+        """Commits records in batches from a background thread."""
+        records = [fipe.PriceRecord(218, 1, 1, 'A', m, 'M', 2010, 1,
+                                    m * 100., '{:06d}-1'.format(m))
+                   for m in range(1, 24)]
+        stats = fipe_http.CrawlStats()
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'fipe.db')
+            with fipe_db.DbWriter(filename, batch_size=5, queue_size=2,
+                                  max_delay=0.05, stats=stats) as writer:
+                writer.add_tables([fipe.Table(218, 2017, 10)])
+                for record in records:
+                    writer.write(record)
+                writer.flush()
+                self.assertEqual(writer.count, 23)
+                # A lone record is committed after `max_delay`.
+                writer.write(records[0]._replace(table=219))
+                time.sleep(0.5)
+                reader = fipe_db.Fipe_db(filename)
+                self.assertEqual(len(list(reader.iter_records(219))), 1)
+            self.assertEqual(list(reader.iter_records(218)), records)
+            self.assertEqual(reader.cursor.execute(
+                'SELECT year, month FROM reference_table WHERE id = 218'
+            ).fetchone(), (2017, 10))
+            self.assertEqual(stats.stages['ingest'], 24)
+            reader.close()
+            # Closed writers refuse records instead of blocking.
+            writer.close()
+            with self.assertRaisesRegex(ValueError, 'closed'):
+                writer.write(records[0])
+            with self.assertRaisesRegex(ValueError, 'closed'):
+                writer.flush()
+            with self.assertRaises(TypeError):
+                fipe_db.RecordSink()
+            # Errors of the writer are raised in the producer.
+            writer = fipe_db.DbWriter(filename)
+            writer.write(records[0]._replace(price='x'))
+            with self.assertLogs(fipe_db.logger, 'ERROR'), \
+                    self.assertRaises(fipe_db.FipeDbError):
+                writer.flush()
+            with self.assertRaises(fipe_db.FipeDbError):
+                writer.close()
+            # Any item written is a record, even a tuple.
+            writer = fipe_db.DbWriter(filename)
+            writer.write(tuple(records[0][:2]))
+            with self.assertLogs(fipe_db.logger, 'ERROR'), \
+                    self.assertRaises(fipe_db.FipeDbError):
+                writer.flush()
+            with self.assertRaises(fipe_db.FipeDbError):
+                writer.close()
+            # Unexpected errors of the writer thread release producers.
+            writer = fipe_db.DbWriter(filename)
+            with mock.patch.object(writer, '_apply',
+                                   side_effect=RuntimeError('bug')):
+                writer.write(records[0])
+                with self.assertLogs(fipe_db.logger, 'ERROR'), \
+                        self.assertRaises(fipe_db.FipeDbError):
+                    writer.flush()
+            with self.assertRaises(fipe_db.FipeDbError):
+                writer.close()
+
+    def test_search(self):
+        """Matches listing titles to Fipe models."""
+        models = [(1, 'VW - VolksWagen', 1, 'Gol 1.0 Flex 4p', (2010, 2012)),
+                  (1, 'VW - VolksWagen', 2, 'Gol 1.6 Power 4p', (2008,)),
+                  (1, 'VW - VolksWagen', 3, 'Polo Comfortline 1.6', (2015,)),
+                  (2, 'GM - Chevrolet', 4, 'Onix 1.0 LT', (2016, 32000))]
+        self.db.ingest(fipe.PriceRecord(218, 1, maker_id, maker, model_id,
+                                        model, year, 1, 1000.,
+                                        '{:06d}-1'.format(model_id))
+                       for maker_id, maker, model_id, model, years in models
+                       for year in years)
+        self.assertEqual(self.db.create_search_index(), 4)
+        matches = self.db.match_models([
+            'VW Gol 1.6 Power 2012 completo', 'polo comfortlin 1,6',
+            'Chevrolet Onix LT único dono', 'carro 1.0', 'xyz'])
+        self.assertEqual(matches[0][0], fipe_db.ModelMatch(
+            '000002-1', 1, 1, 'VW - VolksWagen', 2, 'Gol 1.6 Power 4p',
+            2008, 2008, 0.75))
+        self.assertEqual([m.model_id for m in matches[0]], [2, 3, 1])
+        self.assertEqual(matches[1][0].model_id, 3)
+        self.assertEqual(matches[2][0].model_id, 4)
+        self.assertEqual(matches[2][0].last_year, 2016)
+        self.assertEqual({m.model_id for m in matches[3]}, {1, 4})
+        self.assertEqual(matches[4], [])
+        # Maker and year hints narrow candidates.
+        matches = self.db.match_models(['1.0', '1.0', 'gol'],
+                                       makers=['Chevrolet', 1, None],
+                                       years=[None, None, 2011], limit=5)
+        self.assertEqual([[m.model_id for m in lst] for lst in matches],
+                         [[4], [1], [1]])
+
+    def test_pragmas(self):
+        """Uses write-ahead logging on file databases."""
+        with tempfile.TemporaryDirectory() as path:
+            db = fipe_db.Fipe_db(os.path.join(path, 'fipe.db'),
+                                 pragmas={'synchronous': 'OFF'})
+            self.assertEqual(db.cursor.execute(
+                'PRAGMA journal_mode').fetchone(), ('wal',))
+            self.assertEqual(db.cursor.execute(
+                'PRAGMA synchronous').fetchone(), (0,))
+            db.close()
+
+    def tearDown(self):
+        """Shuts down the test environment."""
+        self.db.close()
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        """Sets-up the test environment."""
+        self.records = [
+            fipe.PriceRecord(218, 1, m // 10, 'Maker {}'.format(m // 10), m,
+                             'Model {}'.format(m), y, 1,
+                             None if m == 11 else m * 1000. + y + .5,
+                             '{:06d}-1'.format(m))
+            for m in (10, 11, 20) for y in (2010, 2011)]
+
+    def test_to_dataframe(self):
+        """Converts price records into a typed data frame."""
+        df = fipe_db.to_dataframe(iter(self.records))
+        self.assertEqual(len(df), 6)
+        self.assertEqual(dict(df.dtypes.astype(str)), fipe_db.price_dtypes)
+        self.assertEqual(list(df['maker'].cat.categories),
+                         ['Maker 1', 'Maker 2'])
+        self.assertEqual(df['price'][0], 1201050)
+        self.assertTrue(df['price'].isna()[2])
+        frames = list(fipe_db.to_dataframe(iter(self.records), chunk_size=4))
+        self.assertEqual([len(frame) for frame in frames], [4, 2])
+
+    def test_db_to_dataframe(self):
+        """Reads stored prices into a typed data frame."""
+        db = fipe_db.Fipe_db()
+        db.create_schema()
+        db.ingest(self.records)
+        self.assertEqual(list(db.iter_records()), self.records)
+        df = db.to_dataframe(table_id=218)
+        self.assertEqual(dict(df.dtypes.astype(str)), fipe_db.price_dtypes)
+        self.assertTrue(df.equals(fipe_db.to_dataframe(self.records)))
+        self.assertEqual(len(db.to_dataframe(table_id=219)), 0)
+        db.close()
+
+    @unittest.skipIf(pyarrow is None, 'requires pyarrow')
+    def test_write_parquet(self):
+        """Streams price records into Parquet and Arrow files."""
+        import pyarrow.parquet
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'prices.parquet')
+            n = fipe_db.write_parquet(iter(self.records), filename,
+                                      chunk_size=4)
+            self.assertEqual(n, 6)
+            parquet = pyarrow.parquet.ParquetFile(filename)
+            self.assertEqual(parquet.metadata.num_row_groups, 2)
+            table = parquet.read()
+            self.assertEqual(table.column('model_id').to_pylist(),
+                             [10, 10, 11, 11, 20, 20])
+            filename = os.path.join(path, 'prices.arrow')
+            self.assertEqual(fipe_db.write_arrow(iter(self.records), filename,
+                                                 chunk_size=4), 6)
+            with pyarrow.ipc.open_file(filename) as reader:
+                self.assertEqual(reader.num_record_batches, 2)
+                table = reader.read_all()
+            self.assertEqual(table.column('price').to_pylist()[:3],
+                             [1201050, 1201150, None])
+
+
+class TestRequestPlanner(unittest.TestCase):
+    def setUp(self):
+        """Sets-up the test environment."""
+        self.planner = fipe.RequestPlanner()
+        self.fipe = fipe.Fipe(max_workers=4, planner=self.planner)
+
+    def count(self, mock_post, endpoint):
+        return sum(call[0][0].endswith(endpoint)
+                   for call in mock_post.call_args_list)
+
+    @mock.patch('scrapers.fipe.requests.Session.post',
+                side_effect=mocked_planner_post)
+    def test_consecutive_tables(self, mock_post):
+        """Spares built year requests of known models."""
+        tables = [fipe.Table.intern(218 + i, 2017, 10 + i) for i in range(3)]
+        # Built years of single model makers are listed with the models.
+        records = list(self.fipe.iter_table(tables[0]))
+        self.assertEqual(len(records), 12)
+        self.assertEqual(self.count(mock_post, 'ConsultarAnoModelo'), 3)
+        self.assertEqual(self.planner.saved, 1)
+        # Models of makers with several models are always requested.
+        mock_post.reset_mock()
+        records = list(self.fipe.iter_table(tables[1]))
+        self.assertEqual(len(records), 12)
+        self.assertEqual(self.count(mock_post, 'ConsultarAnoModelo'), 3)
+        mock_post.reset_mock()
+        records = list(self.fipe.iter_table(tables[2]))
+        self.assertEqual(len(records), 15)
+        self.assertEqual(self.count(mock_post, 'ConsultarAnoModelo'), 4)
+
+    def test_gained_year(self):
+        """Crawls built years a model gains that a sibling model lists."""
+        years = {218: {101: (2017, 2016), 102: (2018,)},
+                 219: {101: (2018, 2017, 2016), 102: (2018,)}}
+
+        def post(*args, **kwargs):
+            data = kwargs['data']
+            table = years[data['codigoTabelaReferencia']]
+            if args[0].endswith('ConsultarModelos'):
+                listed = sorted({y for model in table.values()
+                                 for y in model}, reverse=True)
+                return mock.Mock(status_code=200, **{'json.return_value': {
+                    'Modelos': [{'Label': str(i), 'Value': i}
+                                for i in sorted(table)],
+                    'Anos': [{'Label': '{} Gasolina'.format(y),
+                              'Value': '{}-1'.format(y)} for y in listed]}})
+            if args[0].endswith('ConsultarAnoModelo'):
+                return mock.Mock(status_code=200, **{'json.return_value': [
+                    {'Label': '{} Gasolina'.format(y),
+                     'Value': '{}-1'.format(y)}
+                    for y in table[data['codigoModelo']]]})
+            return mocked_catalog_post(*args, **kwargs)
+
+        with mock.patch('scrapers.fipe.requests.Session.post',
+                        side_effect=post):
+            for table_id in (218, 219):
+                records = list(self.fipe.iter_table(
+                    fipe.Table.intern(table_id, 2017, 10), maker_ids=[1]))
+        self.assertEqual(sorted((r.model_id, r.build_year) for r in records),
+                         [(101, 2016), (101, 2017), (101, 2018),
+                          (102, 2018)])
+
+    @mock.patch('scrapers.fipe.requests.Session.post',
+                side_effect=mocked_planner_post)
+    def test_dedupe(self, mock_post):
+        """Sends identical listing requests once per table."""
+        maker = fipe.CarMaker(1, 'Maker 1', fipe.Table())
+        for _ in range(3):
+            self.fipe.crawl_models(maker)
+        self.assertEqual(mock_post.call_count, 1)
+        self.assertEqual(self.planner.saved, 2)
+
+    def test_single_flight(self):
+        """Shares the result of concurrent calls with the same key."""
+        flight = fipe.SingleFlight()
+        event = threading.Event()
+        calls = []
+
+        def func():
+            calls.append(1)
+            event.wait(1)
+            return 42
+
+        with ThreadPoolExecutor(4) as executor:
+            futures = [executor.submit(flight.do, 'key', func)
+                       for _ in range(4)]
+            time.sleep(0.05)
+            event.set()
+        self.assertEqual([future.result() for future in futures], [42] * 4)
+        self.assertEqual(len(calls), 1)
+
+    def tearDown(self):
+        """Shuts down the test environment."""
+        self.fipe.close()
+
+
+class TestWorkQueue(unittest.TestCase):
+    def setUp(self):
+        """Sets-up the test environment."""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'queue.db')
+        self.queue = fipe_db.WorkQueue(self.path, worker='w0')
+        self.queue.add_table(fipe.Table())
+
+    @mock.patch('scrapers.fipe.requests.Session.post',
+                side_effect=mocked_catalog_post)
+    def test_workers(self, mock_post):
+        """Crawls a table with many workers without duplicate requests."""
+        def work(i):
+            queue = fipe_db.WorkQueue(self.path, worker='w{}'.format(i + 1))
+            db = fipe_db.Fipe_db()
+            db.create_schema()
+            with fipe.Fipe(max_workers=2) as f:
+                n = f.work(queue, db, batch_size=2, poll=0.01)
+            rows = db.cursor.execute(
+                'SELECT model_id, build_year, price FROM price').fetchall()
+            queue.close()
+            db.close()
+            self.assertEqual(len(rows), n)
+            return rows
+
+        with ThreadPoolExecutor(3) as executor:
+            rows = sorted(row for rows in executor.map(work, range(3))
+                          for row in rows)
+        self.assertEqual(len(rows), 18)
+        self.assertEqual(len(set(rows)), 18)
+        self.assertEqual(rows[0], (101, 2010, 10101000))
+        self.assertEqual(mock_post.call_count, 1 + 2 + 6 + 18)
+        self.assertEqual(self.queue.counts(), {'done': 27})
+
+    def test_lease_expiry(self):
+        """Leases units of workers that died to other workers."""
+        self.queue.lease_time = 0.01
+        unit, = self.queue.lease(10)
+        self.assertEqual((unit.level, unit.table_id, unit.table_month),
+                         (0, 218, 10))
+        self.assertEqual(self.queue.lease(10), [])
+        time.sleep(0.02)
+        other = fipe_db.WorkQueue(self.path, worker='w1')
+        self.assertEqual([u.id for u in other.lease(10)], [unit.id])
+        self.assertEqual(self.queue.complete([unit]), 0)
+        self.assertEqual(other.complete([unit], [
+            (1, 218, 1, 1, 'Acura', 0, None, 0, 0)]), 1)
+        self.assertEqual(self.queue.counts(), {'done': 1, 'pending': 1})
+        other.close()
+
+    def test_expired_attempts(self):
+        """Gives up units whose leases keep expiring."""
+        self.queue.max_attempts = 2
+        self.queue.lease()
+        # Releasing a lease in time refunds its attempt, only.
+        self.queue.release()
+        self.queue.lease_time = 0.01
+        self.assertEqual(self.queue.lease()[0].attempts, 1)
+        time.sleep(0.02)
+        self.queue.release()
+        self.assertEqual(self.queue.lease()[0].attempts, 2)
+        time.sleep(0.02)
+        self.assertEqual(self.queue.lease(), [])
+        self.assertEqual(self.queue.counts(), {'failed': 1})
+
+    def test_fail(self):
+        """Marks units failing too often as failed."""
+        self.queue.max_attempts = 2
+        unit, = self.queue.lease()
+        self.queue.fail([unit], 'error')
+        self.assertEqual(self.queue.counts(), {'pending': 1})
+        unit, = self.queue.lease()
+        self.assertEqual(unit.attempts, 2)
+        self.queue.fail([unit], 'error')
+        self.assertEqual(self.queue.counts(), {'failed': 1})
+        self.queue.retry_failed()
+        self.assertEqual(self.queue.counts(), {'pending': 1})
+
+    def tearDown(self):
+        """Shuts down the test environment."""
+        self.queue.close()
+        self.tmp.cleanup()
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        """Sets-up the test environment."""
+        self.stats = fipe_http.CrawlStats()
+
+    @mock.patch('scrapers.fipe.requests.Session.post',
+                side_effect=mocked_catalog_post)
+    def test_crawl_stats(self, mock_post):
+        """Counts requests, bytes, latencies and stage items."""
+        db = fipe_db.Fipe_db(stats=self.stats)
+        db.create_schema()
+        with fipe.Fipe(max_workers=4, stats=self.stats) as f:
+            db.ingest(f.iter_table(fipe.Table()))
+        db.close()
+        snapshot = self.stats.snapshot()
+        self.assertEqual(snapshot['requests'], 27)
+        self.assertEqual(snapshot['stages'], {'makers': 2, 'models': 6,
+                                              'years': 18, 'prices': 18,
+                                              'ingest': 18})
+        endpoint = snapshot['endpoints']['ConsultarValorComTodosParametros']
+        self.assertEqual(endpoint['requests'], 18)
+        self.assertGreater(endpoint['bytes'], 18 * 40)
+        self.assertLess(endpoint['latency_p50'], 0.1)
+        self.assertEqual(json.loads(self.stats.to_json())['requests'], 27)
+        text = self.stats.to_prometheus()
+        self.assertIn('fipe_requests_total{endpoint="ConsultarMarcas"} 1\n',
+                      text)
+        self.assertIn('fipe_request_duration_seconds_bucket{endpoint='
+                      '"ConsultarMarcas",le="+Inf"} 1\n', text)
+        self.assertIn('fipe_stage_items_total{stage="ingest"} 18\n', text)
+
+    def test_retry_stats(self):
+        """Counts errors and retries by type."""
+        with mock.patch('scrapers.fipe.requests.Session.post',
+                        side_effect=fipe.requests.ConnectionError), \
+                fipe.Fipe(retry=fipe_http.RetryPolicy(max_attempts=3, base=0),
+                          stats=self.stats) as f:
+            with self.assertRaises(fipe_http.FipeRequestError):
+                f.crawl_makers(fipe.Table())
+        snapshot = self.stats.snapshot()
+        self.assertEqual(snapshot['endpoints']['ConsultarMarcas']['errors'],
+                         {'ConnectionError': 3})
+        self.assertEqual(snapshot['retries'], {'ConnectionError': 2})
+
+    def test_histogram(self):
+        """Estimates quantiles from buckets."""
+        histogram = fipe_http.Histogram((1., 2., 3.))
+        self.assertIsNone(histogram.quantile(0.5))
+        for value in (0.5, 1.5, 1.5, 2.5):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [1, 2, 1, 0])
+        self.assertEqual(histogram.quantile(0.5), 1.5)
+        self.assertEqual(histogram.quantile(1.), 3.)
+
+    def test_reporter(self):
+        """Exports statistics periodically to a file."""
+        self.stats.on_stage('prices', 3)
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'fipe.json')
+            exports = []
+            with fipe_http.StatsReporter(self.stats, 0.01, path=filename,
+                                         fmt='json', callback=exports.append):
+                time.sleep(0.05)
+            self.assertGreater(len(exports), 1)
+            with open(filename) as f:
+                self.assertEqual(json.load(f)['stages'], {'prices': 3})
+
+
+class TestNavigation(unittest.TestCase):
+    def setUp(self):
+        """Sets-up the test environment."""
+        self.server = FipeServer(SyntheticCatalog(makers=2, models=3,
+                                                  years=3), latency=0.005)
+        self.server.start()
+        self.fipe = fipe.Fipe(base_url=self.server.url, max_workers=4)
+
+    def test_lazy(self):
+        """Crawls just the nodes accessed, once."""
+        table = self.fipe.bind(fipe.Table(218, 2017, 10))
+        model = table.makers[1].models[2]
+        self.assertEqual(self.server.requests, {'ConsultarMarcas': 1,
+                                                'ConsultarModelos': 1})
+        prices = model.prices
+        self.assertEqual([p.build_year for p in prices],
+                         [y for y, _ in SyntheticCatalog(years=3).model_years(
+                             model.id)])
+        self.assertTrue(all(p.price > 0 for p in prices))
+        self.assertIs(table.makers[1].models[2].prices, prices)
+        self.assertEqual(self.server.requests, {
+            'ConsultarMarcas': 1, 'ConsultarModelos': 1,
+            'ConsultarAnoModelo': 1, 'ConsultarValorComTodosParametros': 3})
+        with self.assertRaises(ValueError):
+            fipe.Table(219).makers
+
+    def test_concurrent(self):
+        """Shares a single crawl among concurrent callers."""
+        table = self.fipe.bind(fipe.Table(218, 2017, 10))
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(
+                lambda _: table.makers[0].models[0].prices, range(8)))
+        self.assertTrue(all(prices is results[0] for prices in results))
+        self.assertEqual(self.server.requests['ConsultarModelos'], 1)
+        self.assertEqual(self.server.requests['ConsultarAnoModelo'], 1)
+
+    def test_bounded(self):
+        """Crawls evicted nodes again."""
+        self.fipe.nodes.maxsize = 2
+        table = self.fipe.bind(fipe.Table(218, 2017, 10))
+        maker = table.makers[0]
+        maker.models[0].prices
+        self.assertEqual(len(self.fipe.nodes), 2)
+        table.makers
+        self.assertEqual(self.server.requests['ConsultarMarcas'], 2)
+
+    def test_bind_copy(self):
+        """Binds a copy, leaving the shared table unbound."""
+        shared = fipe.Table.intern(218, 2017, 10)
+        table = self.fipe.bind(shared)
+        other = fipe.Fipe(base_url=self.server.url)
+        self.addCleanup(other.close)
+        self.assertIsNot(table, shared)
+        self.assertIsNone(shared.client)
+        self.assertIs(table.client, self.fipe)
+        self.assertIs(other.bind(shared).client, other)
+        self.assertIs(table.makers[0].table, table)
+        with self.assertRaises(ValueError):
+            shared.makers
+
+    def test_explicit_crawl(self):
+        """Crawls navigation models explicitly."""
+        table = self.fipe.bind(fipe.Table(218, 2017, 10))
+        models = table.makers[0].models
+        years = [y for y, _ in SyntheticCatalog(years=3).model_years(
+            models[0].id)]
+        self.fipe.crawl_prices(models[:2])
+        self.assertEqual([p.build_year for p in models[0].prices], years)
+        self.assertTrue(all(p.price > 0 for p in models[1].prices))
+        self.assertEqual(self.server.requests['ConsultarAnoModelo'], 2)
+        self.fipe.crawl_model_year(models[2])
+        self.assertEqual(len(models[2].prices), 3)
+        # Prices of navigation models are crawled once.
+        self.fipe.crawl_model_price(table.makers[1].models[0])
+        self.assertEqual(self.server.requests['ConsultarAnoModelo'], 4)
+        self.assertEqual(
+            self.server.requests['ConsultarValorComTodosParametros'], 9)
+        # Updates of lazily crawled prices are kept by the model only.
+        lazy = table.makers[1].models[1]
+        lazy.prices[0].price = -1.
+        self.assertEqual(lazy.prices[0].price, -1.)
+        self.assertGreater(self.fipe.get_prices(lazy)[0].price, 0.)
+
+    def tearDown(self):
+        """Shuts down the test environment."""
+        self.fipe.close()
+        self.server.stop()
+
+
+class TestCli(unittest.TestCase):
+    def setUp(self):
+        """Sets-up the test environment."""
+        self.catalog = SyntheticCatalog(makers=3, models=2, years=2,
+                                        tables=2)
+        self.server = FipeServer(self.catalog)
+        self.server.start()
+        self.path = tempfile.TemporaryDirectory()
+        self.args = ['crawl', '--base-url', self.server.url, '--workers',
+                     '4', '-q']
+
+    def test_csv(self):
+        """Crawls the latest tables into a CSV file."""
+        filename = os.path.join(self.path.name, 'prices.csv')
+        self.assertEqual(fipe_cli.main(self.args + [
+            '--latest', '2', '--buffer', '5', '-o', filename]), 0)
+        with open(filename) as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows[0], list(fipe.PriceRecord._fields))
+        self.assertEqual(len(rows), 1 + 2 * self.catalog.rows)
+        self.assertEqual([row[0] for row in rows[1::12]], ['218', '219'])
+
+    def test_sqlite(self):
+        """Crawls selected makers and vehicle types into a database."""
+        filename = os.path.join(self.path.name, 'fipe.db')
+        args = self.args + ['--tables', '219', '--vehicle-types', '1', '3',
+                            '--makers', '1001', '3002', '-o', filename,
+                            '--storage', 'changes', '--resume', '--plan']
+        self.assertEqual(fipe_cli.main(args), 0)
+        db = fipe_db.Fipe_db(filename)
+        self.assertEqual(db.storage, 'changes')
+        records = list(db.iter_records(219))
+        self.assertEqual({(r.vehicle_type, r.maker_id) for r in records},
+                         {(1, 1001), (3, 3002)})
+        self.assertEqual(db.cursor.execute(
+            'SELECT COUNT(*) FROM crawl_unit WHERE status = \'done\''
+        ).fetchone(), (8,))
+        db.close()
+        # Resuming a finished crawl skips all prices.
+        self.server.reset_counters()
+        self.assertEqual(fipe_cli.main(args), 0)
+        self.assertNotIn('ConsultarValorComTodosParametros',
+                         self.server.requests)
+
+    def test_module(self):
+        """Runs as `python -m scrapers` without warnings."""
+        result = subprocess.run(
+            [sys.executable, '-W', 'error', '-m', 'scrapers', '--help'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.dirname(__file__)))
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn(b'usage: fipe', result.stdout)
+        self.assertEqual(result.stderr, b'')
+
+    def test_progress(self):
+        """Shows progress with estimated time left."""
+        stats = fipe_http.CrawlStats()
+        stream = io.StringIO()
+        progress = fipe_cli.Progress(stats, stream, interval=0.)
+        progress.start('Table 218')
+        stats.on_stage('makers', 4)
+        self.assertIsNone(progress.eta())
+        for maker_id in (1, 1, 2):
+            progress.update(fipe.PriceRecord(218, 1, maker_id, *[None] * 7))
+        self.assertIsNotNone(progress.eta())
+        progress.finish()
+        self.assertIn('Table 218: 3 records, 2/4 makers', stream.getvalue())
+        self.assertIn('ETA 0:00:00', stream.getvalue())
+
+    def tearDown(self):
+        """Shuts down the test environment."""
+        self.server.stop()
+        self.path.cleanup()
+
+
+class TestStandInServer(unittest.TestCase):
+    def setUp(self):
+        """Sets-up the test environment."""
+        self.catalog = SyntheticCatalog(makers=3, models=4, years=3)
+
+    def test_crawl(self):
+        """Crawls and ingests a whole table served by the stand-in."""
+        with FipeServer(self.catalog) as server, \
+                fipe.Fipe(base_url=server.url, max_workers=4) as f:
+            self.assertEqual(f.session.headers['Host'],
+                             server.url.split('//')[1])
+            tables = f.crawl_reference_tables()
+            self.assertEqual([t.id for t in tables], [218])
+            records = list(f.iter_table(tables[0]))
+        self.assertEqual(len(records), self.catalog.rows)
+        self.assertTrue(all(r.price > 0 for r in records))
+        db = fipe_db.Fipe_db()
+        db.create_schema()
+        db.add_tables(tables)
+        self.assertEqual(db.ingest(records), 36)
+        record = records[0]
+        self.assertEqual(db.get_price(record.fipe_code, record.build_year,
+                                      record.fuel_type, record.table),
+                         record.price)
+
+    def test_faults(self):
+        """Recovers from injected throttling, resets and malformed JSON."""
+        retry = fipe_http.RetryPolicy(max_attempts=None, base=0.)
+        with FipeServer(self.catalog, throttle=0.05, error=0.05,
+                        reset=0.05, malformed=0.05, seed=1) as server, \
+                fipe.Fipe(base_url=server.url, max_workers=4,
+                          retry=retry) as f, \
+                self.assertLogs(fipe.logger, 'WARNING'):
+            records = list(f.iter_table(fipe.Table(218, 2017, 10)))
+            self.assertEqual(set(server.faults),
+                             {'throttle', 'error', 'reset', 'malformed'})
+        self.assertEqual(len(records), self.catalog.rows)
+        self.assertTrue(all(r.price > 0 for r in records))
+
+    def test_benchmark(self):
+        """Reports throughput and memory of a small benchmark run."""
+        result = bench_fipe.run(200, max_workers=4)
+        self.assertEqual(result['rows'], 200)
+        self.assertGreater(result['requests'], 200)
+        self.assertGreater(result['rows_per_second'], 0)
+        self.assertGreater(result['peak_memory'], 0)
+
+    def test_ingest_rate(self):
+        """Keeps bulk ingest within a few times plain SQLite inserts."""
+        result = bench_fipe.ingest(20000)
+        self.assertEqual(result['rows'], 20000)
+        self.assertGreater(result['ratio'], 0.3)
+
+
+class TestLookupServer(unittest.TestCase):
+    def setUp(self):
+        """Sets-up the test environment."""
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, 'fipe.db')
+        self.db = fipe_db.Fipe_db(self.filename)
+        self.db.create_schema()
+        self.tables = [fipe.Table(218, 2017, 10), fipe.Table(219, 2017, 11)]
+        self.db.add_tables(self.tables)
+        self.db.ingest(fipe.PriceRecord(t.id, 1, 1, 'A', 1, 'M', 2010, 1,
+                                        100. + i, '000001-1')
+                       for i, t in enumerate(self.tables))
+        self.server = fipe_cli.LookupServer(self.filename, port=0, pool_size=2)
+        self.server.start()
+
+    def tearDown(self):
+        """Stops the server and removes the database."""
+        self.server.stop()
+        self.db.close()
+        self.dir.cleanup()
+
+    def get(self, path, **params):
+        return fipe.requests.get(self.server.url + path, params=params)
+
+    def test_lookups(self):
+        """Looks up prices one by one and in batches."""
+        response = self.get('/price', fipe_code='000001-1', build_year=2010,
+                            fuel_type=1, table=218)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            'fipe_code': '000001-1', 'build_year': 2010, 'fuel_type': 1,
+            'table': 218, 'price': 100.})
+        response = fipe.requests.post(self.server.url + '/prices', json={
+            'keys': [['000001-1', 2010, 1], ['000001-1', 2010, 1, 218],
+                     {'fipe_code': '000002-1', 'build_year': 2010,
+                      'fuel_type': 1}]})
+        self.assertEqual(response.json(), {'tables': [219, 218, 219],
+                                           'prices': [101., 100., None]})
+        self.assertEqual(self.server.stats.stages,
+                         {'lookups': 4, 'cache_hits': 1})
+        self.assertEqual(self.get('/history', fipe_code='000001-1').json(),
+                         {'fipe_code': '000001-1', 'history': [
+                             {'table': 218, 'year': 2017, 'month': 10,
+                              'build_year': 2010, 'fuel_type': 1,
+                              'price': 100.},
+                             {'table': 219, 'year': 2017, 'month': 11,
+                              'build_year': 2010, 'fuel_type': 1,
+                              'price': 101.}]})
+        # Commits of other connections invalidate cached lookups.
+        self.db.add_tables([fipe.Table(220, 2017, 12)])
+        self.db.ingest([fipe.PriceRecord(219, 1, 1, 'A', 1, 'M', 2010, 1,
+                                         99., '000001-1')])
+        self.assertEqual(self.server.get_prices([
+            ('000001-1', 2010, 1, 219), ('000001-1', 2010, 1, None)]),
+            ([('000001-1', 2010, 1, 219), ('000001-1', 2010, 1, 220)],
+             [99., None]))
+        self.assertEqual(self.get('/health').json(),
+                         {'status': 'ok', 'latest_table': 220})
+        metrics = self.get('/metrics').text
+        self.assertIn('fipe_lookup_requests_total{endpoint="prices"} 1',
+                      metrics)
+        self.assertIn('fipe_lookup_request_duration_seconds_bucket{'
+                      'endpoint="price",le="0.0001"}', metrics)
+
+    def test_errors(self):
+        """Answers invalid requests with client errors."""
+        self.assertEqual(self.get('/price', fipe_code='000001-1',
+                                  build_year=2010).status_code, 400)
+        self.assertEqual(self.get('/price', fipe_code='000001-1',
+                                  build_year='x', fuel_type=1).status_code,
+                         400)
+        self.assertEqual(self.get('/prices').status_code, 404)
+        self.assertEqual(self.get('/unknown').status_code, 404)
+        url = self.server.url + '/prices'
+        self.assertEqual(fipe.requests.post(url, data='{').status_code, 400)
+        self.assertEqual(fipe.requests.post(url, json={
+            'keys': [['000001-1', 2010, 1]] * 10001}).status_code, 400)
+        self.assertEqual(self.server.stats.errors[('unknown', '404')], 1)
+        # Connections of the service cannot write.
+        db = fipe_db.Fipe_db(self.filename, read_only=True)
+        with self.assertRaises(fipe_db.sqlite3.OperationalError):
+            db.cursor.execute('DELETE FROM price')
+        db.close()
 
 
 if __name__ == '__main__':